@@ -20,7 +20,11 @@
 """
 
 from .asteval import Interpreter
-from .astutils import NameFinder, valid_symbol_name
+from .pool import InterpreterPool
+from .graph import ExpressionGraph
+from .diskcache import ProgramCache
+from .astutils import NameFinder, LRUCache, SymbolTable, valid_symbol_name
 
 __version__ = '0.9.5'
-__all__ = [Interpreter, NameFinder, valid_symbol_name]
+__all__ = [Interpreter, InterpreterPool, ExpressionGraph, NameFinder, LRUCache,
+           ProgramCache, SymbolTable, valid_symbol_name]
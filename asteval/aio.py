@@ -0,0 +1,90 @@
+"""
+asyncio support for asteval (Python 3.5 and higher)
+
+aeval() evaluates an expression in a worker thread, so that the event
+loop keeps running while a long script does.  The Interpreter calls
+its step_hook for every node (and for every loop iteration of compiled
+code), which here releases the GIL to the event loop thread every
+`yield_nodes` nodes or `yield_ms` milliseconds, whichever comes first.
+
+Cancelling the task awaiting aeval() aborts the evaluation with
+Interpreter.cancel(), and raises CancelledError in the task once the
+worker thread has stopped.  The step hook also raises RuntimeError once
+the task is cancelled, so that an evaluation which had not started yet
+when cancel() was called is stopped as well.
+
+An Interpreter must not run two evaluations at once: use one per task,
+or an InterpreterPool.
+"""
+import asyncio
+from functools import partial
+from time import sleep, time
+
+YIELD_NODES = 1000
+YIELD_MS = 5
+
+
+class Yielder(object):
+    """step hook that releases the GIL every few nodes or milliseconds"""
+
+    def __init__(self, yield_nodes=YIELD_NODES, yield_ms=YIELD_MS):
+        self.yield_nodes = yield_nodes
+        self.yield_time = yield_ms / 1000.0
+        self.count = 0
+        self.last = time()
+        self.cancelled = False
+
+    def __call__(self):
+        if self.cancelled:
+            raise RuntimeError("Execution cancelled")
+        self.count += 1
+        if (self.count >= self.yield_nodes or
+                time() - self.last >= self.yield_time):
+            sleep(0)
+            self.count = 0
+            self.last = time()
+
+
+def _eval_with_hook(interp, hook, expr, **kws):
+    """run Interpreter.eval() with a step hook, in a worker thread"""
+    if hook.cancelled:
+        return None
+    saved = interp.step_hook
+    interp.step_hook = hook
+    try:
+        return interp.eval(expr, **kws)
+    finally:
+        interp.step_hook = saved
+
+
+async def aeval(interp, expr, lineno=0, show_errors=True,
+                yield_nodes=YIELD_NODES, yield_ms=YIELD_MS, executor=None):
+    """evaluate an expression without blocking the event loop
+
+    :param interp: Interpreter
+    :param expr: expression text or Program
+    :param yield_nodes: nodes evaluated between yields to the event loop
+    :param yield_ms: milliseconds between yields to the event loop
+    :param executor: concurrent.futures executor for the worker thread
+                     (default: the event loop's default executor)
+
+    Returns the value of the expression, as Interpreter.eval().
+    """
+    loop = asyncio.get_event_loop()
+    hook = Yielder(yield_nodes=yield_nodes, yield_ms=yield_ms)
+    func = partial(_eval_with_hook, interp, hook, expr, lineno=lineno,
+                   show_errors=show_errors)
+    future = loop.run_in_executor(executor, func)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # eval() may not have started yet, and would then clear the
+        # cancel() of the Interpreter: the hook stops it too
+        hook.cancelled = True
+        interp.cancel()
+        # wait for the worker thread, so that the Interpreter is free
+        try:
+            await asyncio.shield(future)
+        except Exception:
+            pass
+        raise
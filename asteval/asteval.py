@@ -16,27 +16,132 @@ import ast
 import math
 from time import time
 
-import sys
-
 from .astutils import (FROM_PY, FROM_MATH, FROM_NUMPY, UNSAFE_ATTRS,
-                       LOCALFUNCS, NUMPY_RENAMES, op2func, RECURSION_LIMIT,
-                       ExceptionHolder, ReturnedNone, valid_symbol_name)
-
-HAS_NUMPY = False
-try:
-    # noinspection PyUnresolvedReferences
-    import numpy
-
-    HAS_NUMPY = True
-except ImportError:
-    # print("Warning: numpy not available... functionality will be limited.")
-    pass
+                       LOCALFUNCS, NUMPY_RENAMES, NUMPY_FILE_FUNCS, op2func,
+                       op2inplace, RECURSION_LIMIT,
+                       MAX_EXEC_TIME, PROGRAM_CACHE_SIZE, KERNEL_CACHE_SIZE,
+                       WATCHDOG,
+                       NODE_COSTS, ARRAY_NODES, ARRAY_STEP_SIZE,
+                       EvalError, ExceptionHolder,
+                       ReturnedNone, LRUCache, SymbolTable, HAS_NUMPY,
+                       file_functions, get_numpy, is_ndarray,
+                       valid_symbol_name,
+                       estimate_ast_bytes)
+from .compiler import Compiler, Frame, Program, RETURN
+from .optimizer import optimize, guards_hold
+from .fusion import (FUSE_MIN_OPS, FUSE_MIN_SIZE, THREAD_MIN_SIZE,
+                     build_kernel)
+from .codegen import compile_trusted
+from .vectorize import Batch
+
+INFINITY = float('inf')
 
 builtins = __builtins__
 if not isinstance(builtins, dict):
     builtins = builtins.__dict__
 
-MAX_EXEC_TIME = 2  # sec
+try:
+    from types import MappingProxyType
+except ImportError:
+    MappingProxyType = dict
+
+# shared read-only symbol tables of builtins, with and without numpy
+_BASE_SYMTABLES = {}
+
+
+class LazyNumpySymbols(object):
+    """read-only mapping of builtin symbols in which numpy is imported,
+    and its symbols looked up, only on the first lookup of a name that
+    numpy provides.  As without lazy_numpy, names such as 'sqrt' that
+    are also in Python's builtins or math are taken from numpy.
+
+    :param symbols: mapping of the symbols not taken from numpy
+    """
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.numpy_names = {}
+        for sym in FROM_NUMPY:
+            self.numpy_names[sym] = sym
+        self.numpy_names.update(NUMPY_RENAMES)
+        self.resolved = {}
+
+    def __getitem__(self, key):
+        if key in self.numpy_names:
+            if key not in self.resolved:
+                # self marks symbols missing from numpy
+                self.resolved[key] = getattr(get_numpy(),
+                                             self.numpy_names[key], self)
+            if self.resolved[key] is not self:
+                return self.resolved[key]
+        return self.symbols[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for key in self.symbols:
+            yield key
+        for key in self.numpy_names:
+            if key not in self.symbols and key in self:
+                yield key
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(self.__iter__())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def base_symtable(use_numpy=True, lazy_numpy=False):
+    """return the read-only mapping of builtin symbols shared by all
+    Interpreters: functions from Python's builtins and math, and
+    (if use_numpy is True and numpy is available) from numpy.
+    It is created on first use.
+
+    With lazy_numpy=True, numpy is not imported until one of its
+    symbols is looked up (see LazyNumpySymbols).
+    """
+    if lazy_numpy and use_numpy and HAS_NUMPY:
+        if 'lazy' not in _BASE_SYMTABLES:
+            symbols = base_symtable(use_numpy=False)
+            _BASE_SYMTABLES['lazy'] = LazyNumpySymbols(symbols)
+        return _BASE_SYMTABLES['lazy']
+
+    use_numpy = use_numpy and get_numpy() is not None
+    if use_numpy not in _BASE_SYMTABLES:
+        symtable = {}
+        for sym in FROM_PY:
+            if sym in builtins:
+                symtable[sym] = builtins[sym]
+
+        for symname, obj in LOCALFUNCS.items():
+            symtable[symname] = obj
+
+        for sym in FROM_MATH:
+            if hasattr(math, sym):
+                symtable[sym] = getattr(math, sym)
+
+        if use_numpy:
+            numpy = get_numpy()
+            for sym in FROM_NUMPY:
+                if hasattr(numpy, sym):
+                    symtable[sym] = getattr(numpy, sym)
+            for name, sym in NUMPY_RENAMES.items():
+                if hasattr(numpy, sym):
+                    symtable[name] = getattr(numpy, sym)
+        _BASE_SYMTABLES[use_numpy] = MappingProxyType(symtable)
+    return _BASE_SYMTABLES[use_numpy]
 
 
 # noinspection PyIncorrectDocstring
@@ -71,6 +176,24 @@ class Interpreter:
 
   If numpy is installed, many numpy functions are also imported.
 
+  Keyword arguments (see doc/api.rst for details):
+     symtable          dictionary of symbols (default: a new SymbolTable)
+     writer            file-like object for output (default: sys.stdout)
+     use_numpy         whether to import numpy functions
+     err_writer        file-like object for errors (default: sys.stderr)
+     max_time          time limit of an evaluation, in seconds, or None
+     parse_cache       LRUCache of parsed expressions, may be shared
+     use_compiler      whether eval() compiles expressions to closures
+     trusted_compile   whether compile() makes native code when safe
+     lazy_numpy        whether to import numpy on first use only
+     max_steps         step budget of an evaluation, or None
+     use_optimizer     whether to fold constant expressions and branches
+     file_root         directory of the files open() and loaders may read
+     fuse_arrays       whether to evaluate elementwise expressions blockwise
+     array_threads     number of threads for large array expressions
+     thread_min_size   smallest array split over array_threads threads
+     use_cse           whether the optimizer shares repeated subexpressions
+
   """
 
     supported_nodes = ('arg', 'assert', 'assign', 'attribute', 'augassign',
@@ -83,43 +206,70 @@ class Interpreter:
                        'slice', 'str', 'subscript', 'try', 'tuple', 'unaryop',
                        'while')
 
-    def __init__(self, symtable=None, writer=None, use_numpy=True, err_writer=None, max_time=MAX_EXEC_TIME):
+    def __init__(self, symtable=None, writer=None, use_numpy=True, err_writer=None, max_time=MAX_EXEC_TIME,
+                 parse_cache=None, use_compiler=False, trusted_compile=False,
+                 lazy_numpy=False, max_steps=None, use_optimizer=False,
+                 file_root=None, fuse_arrays=False, array_threads=1,
+                 thread_min_size=THREAD_MIN_SIZE, use_cse=False):
         self.writer = writer or stdout
         self.err_writer = err_writer or stderr
         self.start = 0
         self.max_time = max_time
-        self.old_recursion_limit = sys.getrecursionlimit()
-
+        self.node_costs = NODE_COSTS
+        self.steps = 0
+        self._next_check = 0
+        self._abort = None
+        self._watch = None
+        self.parse_cache = parse_cache
+        self.use_compiler = use_compiler
+        self.trusted_compile = trusted_compile
+        self.compiler = None
+        self.programs = LRUCache(maxsize=PROGRAM_CACHE_SIZE, maxbytes=None)
+        self.use_optimizer = use_optimizer
+        self.use_cse = use_cse
+        self.optimized = LRUCache(maxsize=PROGRAM_CACHE_SIZE, maxbytes=None)
+        self.fuse_arrays = fuse_arrays
+        self.array_threads = array_threads
+        self.thread_min_size = thread_min_size
+        self.kernels = LRUCache(maxsize=KERNEL_CACHE_SIZE, maxbytes=None)
+        self._max_steps = max_steps
+
+        lazy_numpy = lazy_numpy and symtable is None
+        if lazy_numpy:
+            self.use_numpy = HAS_NUMPY and use_numpy
+        else:
+            self.use_numpy = use_numpy and get_numpy() is not None
         if symtable is None:
-            symtable = {}
+            symtable = SymbolTable(base_symtable(self.use_numpy, lazy_numpy))
         self.symtable = symtable
+        self.frame = None
+        self.depth = 0
+        self.recursion_limit = RECURSION_LIMIT
+        self.step_hook = None
         self._interrupt = None
         self.error = []
         self.error_msg = None
         self.expr = None
         self.retval = None
         self.lineno = 0
-        self.use_numpy = HAS_NUMPY and use_numpy
 
         symtable['print'] = self._printer
-        for sym in FROM_PY:
-            if sym in builtins:
-                symtable[sym] = builtins[sym]
-
-        for symname, obj in LOCALFUNCS.items():
-            symtable[symname] = obj
-
-        for sym in FROM_MATH:
-            if hasattr(math, sym):
-                symtable[sym] = getattr(math, sym)
-
-        if self.use_numpy:
-            for sym in FROM_NUMPY:
-                if hasattr(numpy, sym):
-                    symtable[sym] = getattr(numpy, sym)
-            for name, sym in NUMPY_RENAMES.items():
-                if hasattr(numpy, sym):
-                    symtable[name] = getattr(numpy, sym)
+        if not isinstance(symtable, SymbolTable):
+            symtable.update(base_symtable(self.use_numpy))
+        self.file_root = file_root
+        if file_root is not None:
+            symtable.update(file_functions(file_root))
+            # hide the numpy file readers, without importing numpy
+            for name in NUMPY_FILE_FUNCS:
+                if isinstance(symtable, SymbolTable):
+                    dict.pop(symtable, name, None)
+                    symtable.deleted.add(name)
+                else:
+                    symtable.pop(name, None)
+        # symbols at creation, for no_deepcopy and reset()
+        self._initial_symbols = dict(dict.items(symtable))
+        self._initial_deleted = set(getattr(symtable, 'deleted', ()))
+        self._no_deepcopy = None
 
         self.node_handlers = dict(((node, getattr(self, "on_%s" % node))
                                    for node in self.supported_nodes))
@@ -128,17 +278,128 @@ class Interpreter:
         self.node_handlers['tryexcept'] = self.node_handlers['try']
         self.node_handlers['tryfinally'] = self.node_handlers['try']
 
-        self.no_deepcopy = []
-        for key, val in symtable.items():
-            if callable(val) or 'numpy.lib.index_tricks' in repr(val):
-                self.no_deepcopy.append(key)
-
-    @staticmethod
-    def set_recursion_limit():
-        sys.setrecursionlimit(RECURSION_LIMIT)
+    @property
+    def no_deepcopy(self):
+        """list of names of the functions (and numpy index tricks) present
+        when the Interpreter was created and not reassigned since: these
+        symbols should not be deep-copied.  Built on first use."""
+        if self._no_deepcopy is None:
+            symbols = self._initial_symbols
+            if isinstance(self.symtable, SymbolTable):
+                symbols = dict(self.symtable.base)
+                symbols.update(self._initial_symbols)
+            self._no_deepcopy = []
+            for key, val in symbols.items():
+                if self.symtable.get(key, self) is not val:
+                    continue
+                if callable(val) or 'numpy.lib.index_tricks' in repr(val):
+                    self._no_deepcopy.append(key)
+        return self._no_deepcopy
+
+    @no_deepcopy.setter
+    def no_deepcopy(self, value):
+        self._no_deepcopy = value
+
+    def remove_no_deepcopy(self, name):
+        """remove a reassigned name from no_deepcopy, if that was built"""
+        if self._no_deepcopy is not None and name in self._no_deepcopy:
+            self._no_deepcopy.remove(name)
+
+    def reset(self):
+        """reset the Interpreter to its state when created: clear the
+        error and evaluation state, and remove all symbols added since
+        then, restoring any builtins that were deleted or replaced."""
+        self.error = []
+        self.error_msg = None
+        self.expr = None
+        self.retval = None
+        self.lineno = 0
+        self.start = 0
+        self.steps = 0
+        self._next_check = 0
+        self._abort = None
+        self.frame = None
+        self.depth = 0
+        self._interrupt = None
+        if isinstance(self.symtable, SymbolTable):
+            self.symtable.reset(self._initial_symbols, self._initial_deleted)
+        else:
+            self.symtable.clear()
+            self.symtable.update(self._initial_symbols)
+        self._no_deepcopy = None
+
+    @property
+    def max_steps(self):
+        """step budget of an evaluation, or None for no budget"""
+        return self._max_steps
+
+    @max_steps.setter
+    def max_steps(self, value):
+        # with a budget, programs are compiled to count the steps for
+        # array results, and never to native code: compile them again
+        if (value is None) != (self._max_steps is None):
+            self.programs.invalidate()
+        self._max_steps = value
+
+    def set_recursion_limit(self, limit=RECURSION_LIMIT):
+        """set the maximum depth of nested Procedure calls"""
+        self.recursion_limit = limit
 
     def reset_recursion_limit(self):
-        sys.setrecursionlimit(self.old_recursion_limit)
+        """restore the default maximum depth of Procedure calls"""
+        self.recursion_limit = RECURSION_LIMIT
+
+    def cancel(self, msg="Execution cancelled"):
+        """stop the running evaluation, raising RuntimeError(msg) in it.
+        Can be called from any thread."""
+        self._abort = msg
+        # makes the next check of steps >= _next_check call check_limits()
+        self._next_check = -1
+
+    def _expire(self, entry):
+        """watchdog callback for the time limit"""
+        if self._watch is entry:
+            self.cancel("Execution exceeded time limit, max runtime is {}s".format(self.max_time))
+
+    def _start(self):
+        """reset the state of an evaluation, and start the time limit"""
+        self.error = []
+        self.start = time()
+        self.steps = 0
+        self._abort = None
+        self._next_check = INFINITY
+        if self._max_steps is not None:
+            self._next_check = self._max_steps + 1
+        if self.max_time is not None:
+            # the watchdog is armed by the first check, at a loop
+            # iteration or call: most short evaluations never need it
+            self._next_check = -1
+
+    def _stop(self):
+        """end the time limit of an evaluation"""
+        if self._watch is not None:
+            WATCHDOG.disarm(self._watch)
+            self._watch = None
+
+    def check_limits(self):
+        """raise RuntimeError if the evaluation was cancelled, or ran past
+        its step budget.  Called when steps >= _next_check: as the step
+        budget runs out, after cancel(), or at the first check of an
+        evaluation with a time limit, which arms the watchdog."""
+        if self._abort is not None:
+            # raise again at every check, until the evaluation unwinds,
+            # even if the script catches the error
+            self._next_check = -1
+            raise RuntimeError(self._abort)
+        if self._watch is None and self.max_time is not None:
+            self._watch = WATCHDOG.arm(self.start + self.max_time - time(),
+                                       self._expire)
+        self._next_check = INFINITY
+        if self._max_steps is not None:
+            self._next_check = self._max_steps + 1
+        if self._max_steps is not None and self.steps > self._max_steps:
+            raise RuntimeError("Execution exceeded step budget of %i steps"
+                               % self._max_steps)
 
     def unimplemented(self, node):
         """unimplemented nodes"""
@@ -175,24 +436,80 @@ class Interpreter:
     def parse(self, text):
         """parse statement/expression to Ast representation"""
         self.expr = text
+        cache = self.parse_cache
+        if cache is not None:
+            out = cache.get(text)
+            if out is not None:
+                return out
 
         # noinspection PyBroadException
         try:
-            self.set_recursion_limit()
-            return ast.parse(text)
+            out = ast.parse(text)
+            if cache is not None:
+                cache.put(text, out, nbytes=estimate_ast_bytes(out, text))
+            return out
         except SyntaxError:
             self.raise_exception(None, msg='Syntax Error', expr=text)
         except:
             self.raise_exception(None, msg='Runtime Error', expr=text)
-        finally:
-            self.reset_recursion_limit()
+
+    def optimize(self, node, source=None):
+        """return an optimized copy of a parsed Ast, see optimizer.optimize.
+        With the source text, the result is cached."""
+        return self._optimize(node, source)[0]
+
+    def _optimize(self, node, source):
+        """optimized Ast and guards, from the cache if still valid"""
+        if source is not None:
+            out = self.optimized.get(source)
+            if out is not None and guards_hold(out[1], self.symtable):
+                return out
+        out = optimize(node, self.symtable, cse=self.use_cse)
+        if source is not None:
+            self.optimized.put(source, out)
+        return out
+
+    def compile(self, expr):
+        """compile statement/expression text or Ast to a Program.
+        A Program that was pickled is compiled again from its AST."""
+        source = None
+        if isinstance(expr, Program):
+            if expr.func is not None and guards_hold(expr.guards,
+                                                     self.symtable):
+                return expr
+            source, expr = expr.source, expr.tree
+        elif isinstance(expr, str):
+            source, expr = expr, None
+        if source is not None:
+            self.expr = source
+            program = self.programs.get(source)
+            if (program is not None and
+                    guards_hold(program.guards, self.symtable)):
+                return program
+        if expr is None:
+            expr = self.parse(source)
+        if self.compiler is None:
+            self.compiler = Compiler(self)
+        tree, guards = expr, None
+        if self.use_optimizer:
+            tree, guards = self._optimize(expr, source)
+        program = None
+        # native code does not count steps
+        if self.trusted_compile and self._max_steps is None:
+            program = compile_trusted(tree, self, source=source)
+        if program is None:
+            program = self.compiler.module(tree, source=source)
+        program.tree, program.guards = expr, guards
+        if source is not None:
+            self.programs.put(source, program)
+        return program
 
     def run(self, node, expr=None, lineno=None, with_raise=True):
         """executes parsed Ast representation for an expression"""
         # Note: keep the 'node is None' test: internal code here may run
         #    run(None) and expect a None in return.
-        if time() - self.start > self.max_time:
-            raise RuntimeError("Execution exceeded time limit, max runtime is {}s".format(MAX_EXEC_TIME))
+        if self.step_hook is not None:
+            self.step_hook()
         if self.error:
             return
         if node is None:
@@ -204,13 +521,33 @@ class Interpreter:
         if expr is not None:
             self.expr = expr
 
+        if isinstance(node, Program):
+            if node.func is None or node.guards:
+                node = self.compile(node)
+            if expr is None and node.source is not None:
+                self.expr = node.source
+            # noinspection PyBroadException
+            try:
+                return node.func()
+            except:
+                if with_raise:
+                    self.raise_exception(None, expr=expr)
+                return
+
         # get handler for this node:
         #   on_xxx with handle nodes of type 'xxx', etc
+        nodename = node.__class__.__name__.lower()
         try:
-            handler = self.node_handlers[node.__class__.__name__.lower()]
+            handler = self.node_handlers[nodename]
         except KeyError:
             return self.unimplemented(node)
 
+        # count steps for a step budget
+        if self._max_steps is not None:
+            self.steps += self.node_costs.get(nodename, 1)
+            if self.steps >= self._next_check:
+                self.check_limits()
+
         # run the handler:  this will likely generate
         # recursive calls into this run method.
         # noinspection PyBroadException
@@ -218,6 +555,11 @@ class Interpreter:
             ret = handler(node)
             if isinstance(ret, enumerate):
                 ret = list(ret)
+            elif (self._max_steps is not None and nodename in ARRAY_NODES
+                  and is_ndarray(ret)):
+                self.steps += ret.size // ARRAY_STEP_SIZE
+                if self.steps >= self._next_check:
+                    self.check_limits()
             return ret
         except:
             if with_raise:
@@ -227,48 +569,154 @@ class Interpreter:
         return self.eval(expr, **kw)
 
     def eval(self, expr, lineno=0, show_errors=True):
-        """evaluates a single statement"""
+        """evaluates a single statement, given as text or as a Program"""
         self.lineno = lineno
-        self.error = []
-        self.start = time()
-
+        self._start()
         try:
             # noinspection PyBroadException
             try:
-                self.set_recursion_limit()
-                node = self.parse(expr)
+                if isinstance(expr, Program):
+                    if expr.func is None and not (self.use_compiler or
+                                                  self.trusted_compile):
+                        node = expr.tree
+                        if self.use_optimizer:
+                            node = self.optimize(node, expr.source)
+                    else:
+                        node = self.compile(expr)
+                    expr = expr.source
+                elif self.use_compiler or self.trusted_compile:
+                    node = self.compile(expr)
+                else:
+                    node = self.parse(expr)
+                    if self.use_optimizer:
+                        node = self.optimize(node, expr)
             except:
-                errmsg = exc_info()[1]
-                if self.error:
-                    errmsg = "\n".join(self.error[0].get_error())
-                if not show_errors:
-                    # noinspection PyBroadException
-                    try:
-                        exc = self.error[0].exc
-                    except:
-                        exc = RuntimeError
-                    raise exc(errmsg)
-                print(errmsg, file=self.err_writer)
+                self.report_error(show_errors)
                 return
             # noinspection PyBroadException
             try:
-                self.set_recursion_limit()
                 return self.run(node, expr=expr, lineno=lineno)
             except:
-                errmsg = exc_info()[1]
-                if self.error:
-                    errmsg = "\n".join(self.error[0].get_error())
-                if not show_errors:
-                    # noinspection PyBroadException
-                    try:
-                        exc = self.error[0].exc
-                    except:
-                        exc = RuntimeError
-                    raise exc(errmsg)
-                print(errmsg, file=self.err_writer)
+                self.report_error(show_errors)
+                return
+        finally:
+            self._stop()
+
+    def profile(self, timer=None):
+        """return a Profiler of this Interpreter, to use as a context
+        manager.  See profiler.Profiler."""
+        from .profiler import Profiler
+        if timer is None:
+            return Profiler(self)
+        return Profiler(self, timer=timer)
+
+    def aeval(self, expr, **kws):
+        """coroutine evaluating a statement in a worker thread, without
+        blocking the asyncio event loop (Python 3.5 and higher).  See
+        aio.aeval() for the options."""
+        from .aio import aeval
+        return aeval(self, expr, **kws)
+
+    def report_error(self, show_errors=True):
+        """print the error being handled to err_writer or, if show_errors
+        is False, raise it again.  Call from an except clause."""
+        errmsg = exc_info()[1]
+        if self.error:
+            errmsg = "\n".join(self.error[0].get_error())
+        if not show_errors:
+            # noinspection PyBroadException
+            try:
+                exc = self.error[0].exc
+            except:
+                exc = RuntimeError
+            raise exc(errmsg)
+        print(errmsg, file=self.err_writer)
+
+    def eval_batch(self, expr, columns, show_errors=True):
+        """evaluates a single expression for every row of a set of columns
+
+        columns maps symbol names to equal-length sequences.  When numpy
+        is available, the expression is evaluated once over the whole
+        columns, with if-expressions, comparisons and boolean operators
+        turned into their elementwise versions.  Expressions that can not
+        be evaluated this way are evaluated row by row.  Returns an array
+        (or list, without numpy) with one result per row.
+        """
+        self._start()
+        try:
+            # noinspection PyBroadException
+            try:
+                node = self.parse(expr)
+                batch = Batch(self, node, columns)
+            except:
+                self.report_error(show_errors)
+                return
+            # noinspection PyBroadException
+            try:
+                return batch.run()
+            except:
+                self.report_error(show_errors)
                 return
         finally:
-            self.reset_recursion_limit()
+            self._stop()
+
+    def eval_stream(self, expr, records, chunk_size=1000, names=None,
+                    show_errors=True):
+        """generator evaluating a single expression for every record of
+        an iterable, such as an unbounded stream, in chunks
+
+        Records are gathered into chunks of chunk_size, turned into
+        columns of the names read by the expression, and evaluated as
+        by eval_batch().  Records are mappings of names to values, or
+        sequences of values for the given names.  For each chunk, this
+        yields an array (or list, without numpy) with one result per
+        record or, if the chunk fails, an EvalError whose index is the
+        number of the chunk.  Only one chunk of records is held at a
+        time, and max_time applies to each chunk.  An expression that can
+        not be parsed is reported as by eval_batch(), and yields nothing.
+        """
+        self._start()
+        try:
+            # noinspection PyBroadException
+            try:
+                batch = Batch(self, self.parse(expr))
+            except:
+                self.report_error(show_errors)
+                return
+        finally:
+            self._stop()
+        chunk = []
+        index = 0
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield self._eval_chunk(batch, chunk, index, names, expr)
+                chunk = []
+                index += 1
+        if chunk:
+            yield self._eval_chunk(batch, chunk, index, names, expr)
+
+    def _eval_chunk(self, batch, records, index, names, expr):
+        """results of eval_stream() for one chunk of records"""
+        self._start()
+        # noinspection PyBroadException
+        try:
+            if names is None:
+                columns = dict((name, [record[name] for record in records])
+                               for name in batch.names if name in records[0])
+            else:
+                columns = dict((name, [record[i] for record in records])
+                               for i, name in enumerate(names)
+                               if name in batch.names)
+            batch.load(columns)
+            return batch.run()
+        except:
+            if not self.error:
+                self.error.append(ExceptionHolder(None, expr=expr))
+            return EvalError.from_interpreter(index, self, expr)
+        finally:
+            self.error = []
+            self._stop()
 
     @staticmethod
     def dump(node, **kw):
@@ -298,8 +746,13 @@ class Interpreter:
     def on_module(self, node):  # ():('body',)
         """module def"""
         out = None
-        for tnode in node.body:
-            out = self.run(tnode)
+        try:
+            for tnode in node.body:
+                out = self.run(tnode)
+        finally:
+            # temporaries left by optimizer.CommonSubexpressions
+            for name in getattr(node, 'temporaries', ()):
+                self.symtable.pop(name, None)
         return out
 
     # noinspection PyMethodMayBeStatic,PyUnusedLocal
@@ -361,11 +814,14 @@ class Interpreter:
         if ctx in (ast.Param, ast.Del):
             return str(node.id)
         else:
-            if node.id in self.symtable:
+            if self.frame is not None and node.id in self.frame:
+                return self.frame[node.id]
+            try:
                 return self.symtable[node.id]
-            else:
-                msg = "name '%s' is not defined" % node.id
-                self.raise_exception(node, exc=NameError, msg=msg)
+            except KeyError:
+                pass
+            msg = "name '%s' is not defined" % node.id
+            self.raise_exception(node, exc=NameError, msg=msg)
 
     # noinspection PyMethodMayBeStatic
     def on_nameconstant(self, node):
@@ -380,9 +836,11 @@ class Interpreter:
             if not valid_symbol_name(node.id):
                 errmsg = "invalid symbol name (reserved word?) %s" % node.id
                 self.raise_exception(node, exc=NameError, msg=errmsg)
+            if self.frame is not None:
+                self.frame[node.id] = val
+                return
             self.symtable[node.id] = val
-            if node.id in self.no_deepcopy:
-                self.no_deepcopy.remove(node.id)
+            self.remove_no_deepcopy(node.id)
 
         elif node.__class__ == ast.Attribute:
             if node.ctx.__class__ == ast.Load:
@@ -441,11 +899,32 @@ class Interpreter:
         return
 
     def on_augassign(self, node):  # ('target', 'op', 'value')
-        """augmented assign"""
-        return self.on_assign(ast.Assign(targets=[node.target],
-                                         value=ast.BinOp(left=node.target,
-                                                         op=node.op,
-                                                         right=node.value)))
+        """augmented assign, with the in-place operator: the target is
+        read and assigned back, but its value and slice are run once"""
+        tnode = node.target
+        if tnode.__class__ == ast.Subscript:
+            sym = self.run(tnode.value)
+            xslice = self.run(tnode.slice)
+            current = sym[xslice]
+        elif tnode.__class__ == ast.Attribute:
+            sym = self.run(tnode.value)
+            if tnode.attr in UNSAFE_ATTRS:
+                msg = "cannnot access attribute '%s' for %s" % (tnode.attr, sym)
+                self.raise_exception(tnode, exc=AttributeError, msg=msg)
+            current = getattr(sym, tnode.attr)
+        elif tnode.__class__ == ast.Name:
+            current = self.on_name(tnode)
+        else:
+            return self.unimplemented(tnode)
+        val = op2inplace(node.op)(current, self.run(node.value))
+        if self._max_steps is not None and is_ndarray(val):
+            self.steps += val.size // ARRAY_STEP_SIZE
+        if tnode.__class__ == ast.Subscript:
+            sym[xslice] = val
+        elif tnode.__class__ == ast.Attribute:
+            setattr(sym, tnode.attr, val)
+        else:
+            self.node_assign(tnode, val)
 
     def on_slice(self, node):  # ():('lower', 'upper', 'step')
         """simple slice"""
@@ -484,17 +963,63 @@ class Interpreter:
             if tnode.__class__ == ast.Name:
                 children.append(tnode.id)
                 children.reverse()
-                self.symtable.pop('.'.join(children))
+                name = '.'.join(children)
+                # as for lookups, names not in the frame are global
+                if self.frame is not None and name in self.frame:
+                    self.frame.pop(name)
+                else:
+                    self.symtable.pop(name)
             else:
                 msg = "could not delete symbol"
                 self.raise_exception(node, msg=msg)
 
+    def kernel(self, node):
+        """return the fusion.Kernel of the elementwise operations of
+        node, or None if it has too few of them"""
+        entry = self.kernels.get(id(node))
+        if entry is None or entry[0] is not node:
+            entry = (node, build_kernel(node, self.symtable, min_ops=1))
+            self.kernels.put(id(node), entry)
+        kernel = entry[1]
+        min_ops = 1 if self.array_threads > 1 else FUSE_MIN_OPS
+        if kernel is None or len(kernel) < min_ops:
+            return None
+        return kernel
+
+    def run_kernel(self, kernel, values):
+        """run a fusion.Kernel on the values of its leaves"""
+        funcs = [self.run(fnode) for fnode in kernel.funcs]
+        min_size = FUSE_MIN_SIZE if self.fuse_arrays else self.thread_min_size
+        out = kernel.run(values, funcs, min_size=min_size,
+                         threads=self.array_threads,
+                         thread_min_size=self.thread_min_size)
+        if self._max_steps is not None:
+            # the operations run() did not count, the root being counted
+            for name in kernel.nodes[:-1]:
+                self.steps += self.node_costs.get(name, 1)
+            self.steps += kernel.array_steps(values, out)
+        return out
+
     def on_unaryop(self, node):  # ('op', 'operand')
         """unary operator"""
+        if self.fuse_arrays or self.array_threads > 1:
+            kernel = self.kernel(node)
+            if kernel is not None:
+                values = []
+                for leaf in kernel.leaves:  # not adding to the call depth
+                    values.append(self.run(leaf))
+                return self.run_kernel(kernel, values)
         return op2func(node.op)(self.run(node.operand))
 
     def on_binop(self, node):  # ('left', 'op', 'right')
         """binary operator"""
+        if self.fuse_arrays or self.array_threads > 1:
+            kernel = self.kernel(node)
+            if kernel is not None:
+                values = []
+                for leaf in kernel.leaves:  # not adding to the call depth
+                    values.append(self.run(leaf))
+                return self.run_kernel(kernel, values)
         return op2func(node.op)(self.run(node.left),
                                 self.run(node.right))
 
@@ -511,13 +1036,20 @@ class Interpreter:
 
     def on_compare(self, node):  # ('left', 'ops', 'comparators')
         """comparison operators"""
+        if self.fuse_arrays or self.array_threads > 1:
+            kernel = self.kernel(node)
+            if kernel is not None:
+                values = []
+                for leaf in kernel.leaves:  # not adding to the call depth
+                    values.append(self.run(leaf))
+                return self.run_kernel(kernel, values)
         lval = self.run(node.left)
         out = True
         for op, rnode in zip(node.ops, node.comparators):
             rval = self.run(rnode)
             out = op2func(op)(lval, rval)
             lval = rval
-            if self.use_numpy and isinstance(out, numpy.ndarray) and out.any():
+            if self.use_numpy and is_ndarray(out) and out.any():
                 break
             elif not out:
                 break
@@ -563,6 +1095,8 @@ class Interpreter:
     def on_while(self, node):  # ('test', 'body', 'orelse')
         """while blocks"""
         while self.run(node.test):
+            if self.steps >= self._next_check:
+                self.check_limits()
             self._interrupt = None
             for tnode in node.body:
                 self.run(tnode)
@@ -578,6 +1112,8 @@ class Interpreter:
     def on_for(self, node):  # ('target', 'iter', 'body', 'orelse')
         """for blocks"""
         for val in self.run(node.iter):
+            if self.steps >= self._next_check:
+                self.check_limits()
             self.node_assign(node.target, val)
             self._interrupt = None
             for tnode in node.body:
@@ -597,6 +1133,8 @@ class Interpreter:
         for tnode in node.generators:
             if tnode.__class__ == ast.comprehension:
                 for val in self.run(tnode.iter):
+                    if self.steps >= self._next_check:
+                        self.check_limits()
                     self.node_assign(tnode.target, val)
                     add = True
                     for cond in tnode.ifs:
@@ -654,6 +1192,13 @@ class Interpreter:
     def on_call(self, node):
         """function execution"""
         #  ('func', 'args', 'keywords', and 'starargs', 'kwargs' in py < 3.5)
+        if self.fuse_arrays or self.array_threads > 1:
+            kernel = self.kernel(node)
+            if kernel is not None:
+                values = []
+                for leaf in kernel.leaves:  # not adding to the call depth
+                    values.append(self.run(leaf))
+                return self.run_kernel(kernel, values)
         func = self.run(node.func)
         if not hasattr(func, '__call__') and not isinstance(func, type):
             msg = "'%s' is not callable!!" % func
@@ -717,25 +1262,30 @@ class Interpreter:
             if isinstance(varkws, ast.arg):
                 varkws = varkws.arg
 
-        self.symtable[node.name] = Procedure(node.name, self, doc=doc,
-                                             lineno=self.lineno,
-                                             body=node.body,
-                                             args=args, kwargs=kwargs,
-                                             vararg=vararg, varkws=varkws)
-        if node.name in self.no_deepcopy:
-            self.no_deepcopy.pop(node.name)
+        proc = Procedure(node.name, self, doc=doc, lineno=self.lineno,
+                         body=node.body, args=args, kwargs=kwargs,
+                         vararg=vararg, varkws=varkws)
+        if self.frame is not None:
+            self.frame[node.name] = proc
+            return
+        self.symtable[node.name] = proc
+        self.remove_no_deepcopy(node.name)
 
 
 class Procedure(object):
     """Procedure: user-defined function for asteval
 
     This stores the parsed ast nodes as from the
-    'functiondef' ast node for later evaluation.
+    'functiondef' ast node for later evaluation, and
+    the compiled closure for the body, if any, with
+    the slot indexes of its local names (see compiler.Frame)
+    and the steps counted for each call of it.
     """
 
     def __init__(self, name, interp, doc=None, lineno=0,
                  body=None, args=None, kwargs=None,
-                 vararg=None, varkws=None):
+                 vararg=None, varkws=None, code=None, index=None,
+                 cost=0):
         self.name = name
         self.__asteval__ = interp
         self.raise_exc = self.__asteval__.raise_exception
@@ -746,6 +1296,9 @@ class Procedure(object):
         self.vararg = vararg
         self.varkws = varkws
         self.lineno = lineno
+        self.code = code
+        self.index = index
+        self.cost = cost
 
     def __repr__(self):
         sig = ""
@@ -820,21 +1373,51 @@ class Procedure(object):
             msg = 'incorrect arguments for Procedure %s' % self.name
             self.raise_exc(None, msg=msg, lineno=self.lineno)
 
-        save_symtable = self.__asteval__.symtable.copy()
-        self.__asteval__.symtable.update(symlocals)
-        self.__asteval__.retval = None
+        # run in a new local frame: the caller's local names (but not
+        # the symtable) are copied, so the call only allocates its locals
+        interp = self.__asteval__
+        interp.steps += self.cost
+        if interp.steps >= interp._next_check:
+            interp.check_limits()
+        if interp.depth >= interp.recursion_limit:
+            msg = 'maximum recursion depth exceeded in Procedure %s' % self.name
+            self.raise_exc(None, exc=RuntimeError, msg=msg, lineno=self.lineno)
+        frame = {} if self.index is None else Frame(self.index)
+        if interp.frame is not None:
+            frame.update(interp.frame)
+        frame.update(symlocals)
+        save_frame = interp.frame
+        interp.frame = frame
+        interp.depth += 1
+        interp.retval = None
         retval = None
 
-        # evaluate script of function
-        for node in self.body:
-            self.__asteval__.run(node, expr='<>', lineno=self.lineno)
-            if self.__asteval__.error:
-                break
-            if self.__asteval__.retval is not None:
-                retval = self.__asteval__.retval
-                if retval is ReturnedNone:
-                    retval = None
-                break
+        if self.code is not None:
+            save_expr = interp.expr
+            interp.expr = '<>'
+            interp.lineno = self.lineno
+            try:
+                if self.code() is RETURN:
+                    retval = interp.retval
+            finally:
+                interp.retval = None
+                interp.expr = save_expr
+                interp.frame = save_frame
+                interp.depth -= 1
+            return retval
 
-        self.__asteval__.symtable = save_symtable
+        # evaluate script of function
+        try:
+            for node in self.body:
+                interp.run(node, expr='<>', lineno=self.lineno)
+                if interp.error:
+                    break
+                if interp.retval is not None:
+                    retval = interp.retval
+                    if retval is ReturnedNone:
+                        retval = None
+                    break
+        finally:
+            interp.frame = save_frame
+            interp.depth -= 1
         return retval
@@ -7,13 +7,50 @@ utility functions for asteval
 from __future__ import division, print_function
 import re
 import ast
+import mmap
+import operator
+import os
+import sys
 from sys import exc_info
+from collections import OrderedDict
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Lock, RLock, Thread
+from time import time
 
 MAX_EXPONENT = 10000
 MAX_STR_LEN = 2 << 17  # 256KiB
 MAX_SHIFT = 1000
 MAX_OPEN_BUFFER = 2 << 17
+MAX_CHUNK_ROWS = 10**6
 RECURSION_LIMIT = 100
+MAX_EXEC_TIME = 2  # sec
+PARSE_CACHE_SIZE = 1024
+PROGRAM_CACHE_SIZE = 256
+KERNEL_CACHE_SIZE = 1024
+PARSE_CACHE_BYTES = 2 << 24  # 32MiB
+AST_NODE_BYTES = 128  # rough memory cost of one parsed ast node
+ARRAY_STEP_SIZE = 1000  # array elements counted as one step
+
+# steps counted for evaluating each type of node (default 1), see
+# Interpreter.max_steps.  Array results of ARRAY_NODES add one step for
+# every ARRAY_STEP_SIZE elements.
+NODE_COSTS = {'call': 10, 'functiondef': 5, 'listcomp': 5, 'attribute': 2,
+              'subscript': 2}
+ARRAY_NODES = ('binop', 'unaryop', 'compare', 'call')
+
+# numpy is only imported when it is first needed, see get_numpy()
+try:
+    from importlib.util import find_spec
+    HAS_NUMPY = find_spec('numpy') is not None
+except ImportError:
+    import imp
+    try:
+        imp.find_module('numpy')
+        HAS_NUMPY = True
+    except ImportError:
+        HAS_NUMPY = False
+_NUMPY = {}
 
 RESERVED_WORDS = ('and', 'as', 'assert', 'break', 'class', 'continue',
                   'def', 'del', 'elif', 'else', 'except', 'exec',
@@ -144,7 +181,7 @@ NUMPY_RENAMES = {'ln': 'log', 'asin': 'arcsin', 'acos': 'arccos',
                  'arctanh', 'acosh': 'arccosh', 'asinh': 'arcsinh'}
 
 
-def _open(filename, mode='r', buffering=0):
+def _open(filename, mode='r', buffering=-1):
     """read only version of open()"""
     if mode not in ('r', 'rb', 'rU'):
         raise RuntimeError("Invalid open file mode, must be 'r', 'rb', or 'rU'")
@@ -153,8 +190,116 @@ def _open(filename, mode='r', buffering=0):
     return open(filename, mode, buffering)
 
 
+def sandbox_path(root, filename):
+    """path of filename, relative to directory root, and not outside it
+    (after following links).  With root None, filename is unchanged."""
+    if root is None:
+        return filename
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, filename))
+    if path != root and not path.startswith(os.path.join(root, '')):
+        raise RuntimeError("Invalid file name '{}', outside of the data "
+                           "directory".format(filename))
+    return path
+
+
+def file_functions(root=None):
+    """read-only file functions for scripts, with file names limited to
+    the directory root (if not None):
+
+    open(filename, mode='r', buffering=-1)
+        read-only open(), buffered by default.
+    load_array(filename, dtype='float64', shape=None, offset=0)
+        read-only numpy memory map of a .npy file, or of raw binary data
+        of dtype.  Data is read from disk as it is used.
+    read_chunks(filename, chunksize=10000, delimiter=',', skiprows=0,
+                dtype='float64')
+        iterator over the rows of a delimited text file, in lists of up
+        to chunksize rows: 2-d arrays of dtype with numpy and a dtype,
+        lists of rows of values (floats, or strings with dtype None)
+        without.
+    read_bytes(filename, offset=0, size=-1)
+        read-only memoryview of bytes of a file, mapped into memory.
+    """
+    def open_(filename, mode='r', buffering=-1):
+        return _open(sandbox_path(root, filename), mode, buffering)
+
+    def load_array(filename, dtype='float64', shape=None, offset=0):
+        numpy = get_numpy()
+        if numpy is None:
+            raise RuntimeError("load_array() requires numpy")
+        path = sandbox_path(root, filename)
+        if path.endswith('.npy'):
+            return numpy.load(path, mmap_mode='r', allow_pickle=False)
+        return numpy.memmap(path, dtype=dtype, mode='r', offset=offset,
+                            shape=shape)
+
+    def read_chunks(filename, chunksize=10000, delimiter=',', skiprows=0,
+                    dtype='float64'):
+        if not 0 < chunksize <= MAX_CHUNK_ROWS:
+            raise RuntimeError("Invalid chunksize, max chunk size is "
+                               "{}".format(MAX_CHUNK_ROWS))
+        numpy = get_numpy() if dtype is not None else None
+        convert = None if dtype is None else float
+        path = sandbox_path(root, filename)
+
+        def chunks():
+            with _open(path, 'r') as fileh:
+                for _ in range(skiprows):
+                    fileh.readline()
+                rows = []
+                for line in fileh:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    row = line.split(delimiter)
+                    if numpy is None and convert is not None:
+                        row = [convert(val) for val in row]
+                    rows.append(row)
+                    if len(rows) == chunksize:
+                        yield _chunk(rows, numpy, dtype)
+                        rows = []
+                if rows:
+                    yield _chunk(rows, numpy, dtype)
+        return chunks()
+
+    def read_bytes(filename, offset=0, size=-1):
+        with _open(sandbox_path(root, filename), 'rb') as fileh:
+            length = os.fstat(fileh.fileno()).st_size
+            if offset < 0 or offset > length:
+                raise RuntimeError("Invalid offset {} for file of {} "
+                                   "bytes".format(offset, length))
+            if size < 0 or offset + size > length:
+                size = length - offset
+            if size == 0:
+                return memoryview(b'')
+            # mmap offsets must be multiples of the allocation granularity
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            mapped = mmap.mmap(fileh.fileno(), size + offset - start,
+                               access=mmap.ACCESS_READ, offset=start)
+        return memoryview(mapped)[offset-start:]
+
+    out = {'open': open_, 'load_array': load_array,
+           'read_chunks': read_chunks, 'read_bytes': read_bytes}
+    for name, func in out.items():
+        func.__name__ = func.__qualname__ = name
+    return out
+
+
+def _chunk(rows, numpy, dtype):
+    """rows of a chunk read by read_chunks(), as an array with numpy"""
+    if numpy is None:
+        return rows
+    return numpy.array(rows, dtype=dtype)
+
+
 LOCALFUNCS = {'open': _open}
 
+# numpy functions reading files outside of the restrictions of
+# file_functions(), removed from Interpreters with a file_root
+NUMPY_FILE_FUNCS = ('fromfile', 'fromregex', 'genfromtxt', 'load', 'loads',
+                    'loadtxt', 'mafromtxt', 'memmap', 'ndfromtxt')
+
 
 # Safe versions of functions to prevent denial of service issues
 
@@ -212,6 +357,69 @@ OPERATORS = {ast.Is: lambda a, b: a is b,
              ast.USub: lambda a: -a}
 
 
+def safe_ipow(base, exp):
+    if exp > MAX_EXPONENT:
+        raise RuntimeError("Invalid exponent, max exponent is {}".format(MAX_EXPONENT))
+    base **= exp
+    return base
+
+
+def safe_imult(a, b):
+    if isinstance(a, str) and isinstance(b, int) and len(a) * b > MAX_STR_LEN:
+        raise RuntimeError("String length exceeded, max string length is {}".format(MAX_STR_LEN))
+    a *= b
+    return a
+
+
+def safe_iadd(a, b):
+    if isinstance(a, str) and isinstance(b, str) and len(a) + len(b) > MAX_STR_LEN:
+        raise RuntimeError("String length exceeded, max string length is {}".format(MAX_STR_LEN))
+    a += b
+    return a
+
+
+def safe_ilshift(a, b):
+    if b > MAX_SHIFT:
+        raise RuntimeError("Invalid left shift, max left shift is {}".format(MAX_SHIFT))
+    a <<= b
+    return a
+
+
+# in-place operators of augmented assignments: mutable objects such as
+# numpy arrays and lists are updated without a temporary result
+INPLACE_OPERATORS = {ast.Add: safe_iadd,
+                     ast.BitAnd: operator.iand,
+                     ast.BitOr: operator.ior,
+                     ast.BitXor: operator.ixor,
+                     ast.Div: operator.itruediv,
+                     ast.FloorDiv: operator.ifloordiv,
+                     ast.LShift: safe_ilshift,
+                     ast.RShift: operator.irshift,
+                     ast.Mult: safe_imult,
+                     ast.Pow: safe_ipow,
+                     ast.Sub: operator.isub,
+                     ast.Mod: operator.imod}
+
+
+def op2inplace(op):
+    """return function for the operator node of an augmented assignment,
+    applying the in-place operator.  numpy arrays that can not hold the
+    result (such as an integer array += a float) get a new array, from
+    the plain operator, as for `a = a + b`.
+    :param op:
+    """
+    inplace, plain = INPLACE_OPERATORS[op.__class__], OPERATORS[op.__class__]
+
+    def func(a, b):
+        try:
+            return inplace(a, b)
+        except TypeError:
+            if not is_ndarray(a):
+                raise
+        return plain(a, b)
+    return func
+
+
 def valid_symbol_name(name):
     """determines whether the input symbol name is a valid name
 
@@ -283,18 +491,57 @@ class ExceptionHolder(object):
         return exc_name, '\n'.join(out)
 
 
+class EvalError(object):
+    """picklable description of the error raised by one expression,
+    as returned by parallel.eval_many() and Interpreter.eval_stream()
+
+    :param index: position of the expression (or chunk) in the input
+    :param exc_name: name of the exception, e.g. 'NameError'
+    :param msg: error message
+    :param expr: expression text
+    :param text: full error report, as printed by Interpreter.eval()
+    """
+
+    def __init__(self, index, exc_name, msg, expr=None, text=None):
+        self.index = index
+        self.exc_name = exc_name
+        self.msg = msg
+        self.expr = expr
+        self.text = text
+
+    @classmethod
+    def from_interpreter(cls, index, interp, expr):
+        """build from the error held by an Interpreter"""
+        if not interp.error:
+            return cls(index, 'UnknownError', '', expr=expr)
+        holder = interp.error[0]
+        exc_name, text = holder.get_error()
+        return cls(index, exc_name, str(holder.msg), expr=expr, text=text)
+
+    def __repr__(self):
+        return "<EvalError %i %s: %s>" % (self.index, self.exc_name,
+                                          self.msg)
+
+
 class NameFinder(ast.NodeVisitor):
     """find all symbol names used by a parsed node"""
 
     def __init__(self):
         self.names = []
+        self._seen = set()
         ast.NodeVisitor.__init__(self)
 
+    def visit_Name(self, node):
+        if node.id not in self._seen and isinstance(node.ctx, ast.Load):
+            self._seen.add(node.id)
+            self.names.append(node.id)
+
     def generic_visit(self, node):
-        if node.__class__.__name__ == 'Name':
-            if node.ctx.__class__ == ast.Load and node.id not in self.names:
-                self.names.append(node.id)
-        ast.NodeVisitor.generic_visit(self, node)
+        # a root Name is found too, as visit() would
+        if isinstance(node, ast.Name):
+            self.visit_Name(node)
+        else:
+            ast.NodeVisitor.generic_visit(self, node)
 
 
 def get_ast_names(astnode):
@@ -302,5 +549,330 @@ def get_ast_names(astnode):
     :param astnode:
     """
     finder = NameFinder()
-    finder.generic_visit(astnode)
+    finder.visit(astnode)
     return finder.names
+
+
+class SymbolUsage(object):
+    """symbols used by a parsed node, as sets of names:
+
+    reads:  names loaded, and targets of augmented assignments
+    writes: names assigned or deleted, and names of functions defined
+            and exceptions caught
+    calls:  names of the functions called by name
+    attrs:  attribute names used
+    """
+    __slots__ = ('reads', 'writes', 'calls', 'attrs')
+
+    def __init__(self, reads, writes, calls, attrs):
+        self.reads = reads
+        self.writes = writes
+        self.calls = calls
+        self.attrs = attrs
+
+    def __repr__(self):
+        return "<SymbolUsage reads=%r writes=%r>" % (sorted(self.reads),
+                                                     sorted(self.writes))
+
+
+def symbol_usage(astnode):
+    """return the SymbolUsage of an AST node, in a single pass over the
+    tree"""
+    reads, writes, calls, attrs = set(), set(), set(), set()
+    Name, Load, Call = ast.Name, ast.Load, ast.Call
+    Attribute, AugAssign, AST = ast.Attribute, ast.AugAssign, ast.AST
+    definitions = (ast.FunctionDef, ast.ExceptHandler)
+    todo = [astnode]
+    pop, push = todo.pop, todo.append
+    while todo:
+        node = pop()
+        ntype = type(node)
+        if ntype is Name:
+            if type(node.ctx) is Load:
+                reads.add(node.id)
+            else:
+                writes.add(node.id)
+            continue
+        elif ntype is Call:
+            if type(node.func) is Name:
+                calls.add(node.func.id)
+        elif ntype is Attribute:
+            attrs.add(node.attr)
+        elif ntype is AugAssign:
+            # 'x += 1' reads x, though its target has a Store context
+            if type(node.target) is Name:
+                reads.add(node.target.id)
+        elif ntype in definitions and isinstance(node.name, str):
+            writes.add(node.name)
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, AST):
+                        push(item)
+            elif isinstance(value, AST):
+                push(value)
+    return SymbolUsage(reads, writes, calls, attrs)
+
+
+def get_numpy():
+    """return the numpy module, importing it on first use, or None if
+    numpy is not available"""
+    if 'numpy' not in _NUMPY:
+        numpy = None
+        if HAS_NUMPY:
+            try:
+                import numpy
+            except ImportError:
+                pass
+        _NUMPY['numpy'] = numpy
+    return _NUMPY['numpy']
+
+
+def is_ndarray(obj):
+    """return whether obj is a numpy array, without importing numpy"""
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(obj, numpy.ndarray)
+
+
+class SymbolTable(dict):
+    """symbol table: a dictionary of symbols layered over a shared,
+    read-only base mapping of builtin symbols.
+
+    Lookups that miss the table fall back to the base mapping, so
+    creating a SymbolTable does not copy the builtins.  Assigning to a
+    builtin name stores the new value in the table, and deleting a
+    builtin name hides it, leaving the base mapping unchanged.
+    """
+
+    def __init__(self, base, *args, **kws):
+        dict.__init__(self, *args, **kws)
+        self.base = base
+        self.deleted = set()
+
+    def __missing__(self, key):
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        return key in self.base and key not in self.deleted
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __iter__(self):
+        for key in dict.__iter__(self):
+            yield key
+        for key in self.base:
+            if key not in self.deleted and not dict.__contains__(self, key):
+                yield key
+
+    def __len__(self):
+        return len(list(self.__iter__()))
+
+    def __repr__(self):
+        return "<SymbolTable: %i symbols>" % len(self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        if key in self.base and key not in self.deleted:
+            value = dict.pop(self, key, self.base[key])
+            self.deleted.add(key)
+            return value
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def keys(self):
+        return list(self.__iter__())
+
+    def values(self):
+        return [self[key] for key in self.__iter__()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.__iter__()]
+
+    def clear(self):
+        dict.clear(self)
+        self.deleted.update(self.base)
+
+    def reset(self, symbols, deleted=()):
+        """undo all changes to the base mapping, except for hiding the
+        names in deleted, and replace the symbols in the table with
+        symbols"""
+        dict.clear(self)
+        self.deleted.clear()
+        self.deleted.update(deleted)
+        dict.update(self, symbols)
+
+    def copy(self):
+        out = SymbolTable(self.base, dict.items(self))
+        out.deleted.update(self.deleted)
+        return out
+
+
+def estimate_ast_bytes(astnode, text=''):
+    """rough estimate of the memory held by a parsed AST node
+    :param astnode: ast node
+    :param text: source text the node was parsed from
+    """
+    return len(text) + AST_NODE_BYTES * sum(1 for _ in ast.walk(astnode))
+
+
+class Watchdog(object):
+    """a single daemon thread that cancels evaluations which run past
+    their deadline, so that the evaluator does not read the clock.
+
+    arm() registers a callback to run at a deadline and returns an entry
+    to pass to disarm() once the evaluation is done.  Disarmed entries
+    are dropped lazily.  A forked child process starts a watchdog of its
+    own, as the thread of the parent does not run in it.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        """forget the thread, lock and deadlines (of a parent process)"""
+        self._pid = os.getpid()
+        self._heap = []
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._seq = count()
+        self._thread = None
+        self._wakeup = None  # deadline the thread is waiting for
+
+    def arm(self, timeout, callback):
+        """call callback(entry) in timeout seconds, unless disarmed"""
+        if self._pid != os.getpid():
+            self._reset()
+        entry = [time() + timeout, next(self._seq), callback]
+        heap = self._heap
+        self._lock.acquire()
+        try:
+            while heap and heap[0][2] is None:
+                heappop(heap)
+            heappush(heap, entry)
+            if self._thread is None:
+                self._thread = Thread(target=self._watch,
+                                      name='asteval-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._wakeup is None or entry[0] < self._wakeup:
+                self._cond.notify()
+        finally:
+            self._lock.release()
+        return entry
+
+    @staticmethod
+    def disarm(entry):
+        """cancel the callback of an entry returned by arm()"""
+        entry[2] = None
+
+    def _watch(self):
+        """watchdog thread: run callbacks as their deadlines pass"""
+        heap = self._heap
+        with self._cond:
+            while True:
+                while heap and heap[0][2] is None:
+                    heappop(heap)
+                if not heap:
+                    self._wakeup = None
+                    self._cond.wait()
+                    continue
+                self._wakeup = heap[0][0]
+                delay = self._wakeup - time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                entry = heappop(heap)
+                callback = entry[2]
+                if callback is not None:
+                    callback(entry)
+
+
+WATCHDOG = Watchdog()
+
+
+class LRUCache(object):
+    """bounded, thread-safe least-recently-used cache
+
+    Entries are evicted in least-recently-used order once either
+    `maxsize` entries or roughly `maxbytes` bytes are held.  A single
+    cache can be shared between several Interpreters.
+
+    :param maxsize: maximum number of entries (None for no limit)
+    :param maxbytes: maximum approximate size in bytes (None for no limit)
+    """
+
+    def __init__(self, maxsize=PARSE_CACHE_SIZE, maxbytes=PARSE_CACHE_BYTES):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """return cached value for key, or default"""
+        with self._lock:
+            try:
+                value, nbytes = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = (value, nbytes)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes=0):
+        """add value for key, evicting old entries as needed"""
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            if self.maxbytes is not None and nbytes > self.maxbytes:
+                return
+            self._data[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while ((self.maxsize is not None and
+                    len(self._data) > self.maxsize) or
+                   (self.maxbytes is not None and
+                    self.nbytes > self.maxbytes)):
+                self.nbytes -= self._data.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """remove key from the cache, or all entries if key is None"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+                self.nbytes = 0
+            elif key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+
+    def stats(self):
+        """return dictionary of cache statistics"""
+        with self._lock:
+            return {'entries': len(self._data), 'nbytes': self.nbytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
@@ -0,0 +1,194 @@
+"""
+native code generation for asteval ("trusted compile")
+
+Expressions that pass a strict static check are compiled to a real
+CPython code object and run with eval(), with the Interpreter symtable
+as the only namespace.  The operators guarded by safe_pow, safe_mult,
+safe_add, and safe_lshift are rewritten into calls to those functions,
+so the resource limits still hold.  Augmented assignments call the
+in-place operators of astutils.op2inplace, with the same guards.  The
+names of these functions are declared global, so that they are loaded
+from SAFE_GLOBALS without a failed lookup in the symtable.
+
+The check only accepts simple statements (expressions, assignments and
+augmented assignments) made of supported nodes: no loops, function
+definitions, comprehensions, or try blocks, and no attributes from
+UNSAFE_ATTRS or names starting with '__'.  Anything else is left to
+the closure compiler.
+"""
+from __future__ import division, print_function
+import __future__
+import ast
+from copy import deepcopy
+
+from .astutils import (INPLACE_OPERATORS, UNSAFE_ATTRS, op2inplace,
+                       safe_add, safe_lshift, safe_mult, safe_pow,
+                       valid_symbol_name)
+from .compiler import Program
+
+SAFE_FUNCS = {ast.Add: '__asteval_add__',
+              ast.Mult: '__asteval_mult__',
+              ast.Pow: '__asteval_pow__',
+              ast.LShift: '__asteval_lshift__'}
+
+SAFE_GLOBALS = {'__builtins__': {},
+                '__asteval_add__': safe_add,
+                '__asteval_mult__': safe_mult,
+                '__asteval_pow__': safe_pow,
+                '__asteval_lshift__': safe_lshift}
+
+INPLACE_FUNCS = dict((op, '__asteval_i%s__' % op.__name__.lower())
+                     for op in INPLACE_OPERATORS)
+SAFE_GLOBALS.update((name, op2inplace(op()))
+                    for op, name in INPLACE_FUNCS.items())
+
+GUARD_NAMES = sorted(name for name in SAFE_GLOBALS if name != '__builtins__')
+
+# holds the value of the final expression, for the time of a run
+RESULT_NAME = '__asteval_result__'
+
+TRUSTED_STATEMENTS = (ast.Expr, ast.Assign, ast.AugAssign)
+
+TRUSTED_EXPRESSIONS = (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare,
+                       ast.Call, ast.Name, ast.Num, ast.Str, ast.Attribute,
+                       ast.Subscript, ast.Index, ast.Slice, ast.ExtSlice,
+                       ast.Ellipsis, ast.List, ast.Tuple, ast.Dict,
+                       ast.IfExp)
+if hasattr(ast, 'NameConstant'):
+    TRUSTED_EXPRESSIONS += (ast.NameConstant, )
+
+TRUSTED_LEAVES = (ast.operator, ast.unaryop, ast.boolop, ast.cmpop,
+                  ast.expr_context, ast.keyword)
+
+COMPILE_FLAGS = __future__.division.compiler_flag
+
+
+def _trusted_name(name):
+    """names and attributes starting with '__' are never trusted"""
+    return not name.startswith('__')
+
+
+def is_trusted(node, interp):
+    """return whether a parsed Module passes the static check for
+    native compilation by an Interpreter
+    """
+    if not isinstance(node, ast.Module) or not node.body:
+        return False
+    for stmt in node.body:
+        if not isinstance(stmt, TRUSTED_STATEMENTS):
+            return False
+    for tnode in ast.walk(node):
+        if isinstance(tnode, (ast.Module, ) + TRUSTED_STATEMENTS +
+                      TRUSTED_EXPRESSIONS):
+            if tnode.__class__.__name__.lower() not in interp.supported_nodes:
+                return False
+        elif not isinstance(tnode, TRUSTED_LEAVES):
+            return False
+
+        if isinstance(tnode, ast.Name):
+            if not _trusted_name(tnode.id):
+                return False
+            if isinstance(tnode.ctx, ast.Store):
+                if (not valid_symbol_name(tnode.id) or
+                        tnode.id in (interp._no_deepcopy or ())):
+                    return False
+            elif not isinstance(tnode.ctx, ast.Load):
+                return False
+        elif isinstance(tnode, ast.Attribute):
+            if (tnode.attr in UNSAFE_ATTRS or not _trusted_name(tnode.attr) or
+                    not isinstance(tnode.ctx, ast.Load)):
+                return False
+        elif isinstance(tnode, ast.Subscript):
+            if isinstance(tnode.ctx, ast.Store):
+                if (isinstance(tnode.slice, ast.Slice) and
+                        tnode.slice.step is not None):
+                    return False
+            elif not isinstance(tnode.ctx, ast.Load):
+                return False
+        elif isinstance(tnode, ast.Compare):
+            if len(tnode.ops) > 1:
+                return False
+        elif isinstance(tnode, ast.Call):
+            if (getattr(tnode, 'starargs', None) is not None or
+                    getattr(tnode, 'kwargs', None) is not None):
+                return False
+            for key in tnode.keywords:
+                if key.arg is None:
+                    return False
+        elif isinstance(tnode, ast.AugAssign):
+            if not isinstance(tnode.target, ast.Name):
+                return False
+        elif isinstance(tnode, (ast.Tuple, ast.List)):
+            if not isinstance(tnode.ctx, (ast.Load, ast.Store)):
+                return False
+    return True
+
+
+class SafeOperators(ast.NodeTransformer):
+    """rewrite guarded operators into calls of the safe_* functions"""
+
+    @staticmethod
+    def _call(op, left, right, node, funcs=SAFE_FUNCS):
+        func = ast.Name(id=funcs[op.__class__], ctx=ast.Load())
+        call = ast.Call(func=func, args=[left, right], keywords=[])
+        return ast.copy_location(call, node)
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        if node.op.__class__ in SAFE_FUNCS:
+            return self._call(node.op, node.left, node.right, node)
+        return node
+
+    def visit_AugAssign(self, node):
+        node = self.generic_visit(node)
+        load = ast.copy_location(ast.Name(id=node.target.id, ctx=ast.Load()),
+                                 node.target)
+        value = self._call(node.op, load, node.value, node,
+                           funcs=INPLACE_FUNCS)
+        return ast.copy_location(ast.Assign(targets=[node.target],
+                                            value=value), node)
+
+
+def compile_trusted(node, interp, source=None):
+    """compile a parsed Module to a native Program, or return None if
+    it does not pass the static check"""
+    if not is_trusted(node, interp):
+        return None
+    tree = SafeOperators().visit(deepcopy(node))
+    body = tree.body
+    last = isinstance(body[-1], ast.Expr)
+    if last:
+        # an expression statement can not return its value from exec code
+        target = ast.Name(id=RESULT_NAME, ctx=ast.Store())
+        body[-1] = ast.copy_location(ast.Assign(targets=[target],
+                                                value=body[-1].value),
+                                     body[-1])
+    tree.body = [ast.copy_location(ast.Global(names=GUARD_NAMES),
+                                   body[0])] + body
+    code = compile(ast.fix_missing_locations(tree), '<asteval>', 'exec',
+                   COMPILE_FLAGS, True)
+
+    if last:
+        def func():
+            symtable = interp.symtable
+            eval(code, SAFE_GLOBALS, symtable)
+            # never in the base of a SymbolTable, which dict.pop skips
+            out = dict.pop(symtable, RESULT_NAME)
+            if isinstance(out, enumerate):
+                out = list(out)
+            return out
+    else:
+        def func():
+            eval(code, SAFE_GLOBALS, interp.symtable)
+    temps = getattr(node, 'temporaries', ())
+    if temps:
+        run = func
+
+        def func():
+            try:
+                return run()
+            finally:
+                # temporaries left by optimizer.CommonSubexpressions
+                for name in temps:
+                    interp.symtable.pop(name, None)
+    return Program(source, node, func, native=True)
@@ -0,0 +1,1134 @@
+"""
+closure compiler for asteval
+
+Turns a parsed AST into a tree of Python closures, one per node,
+following the semantics of the Interpreter on_* handlers.  The
+compiled program is then run without the per-node dispatch done by
+Interpreter.run(): no handler lookup, no time check and no error
+check for every node visited.  The time limit is checked on each
+loop iteration instead.
+
+Errors are reported as for Interpreter.run(): every node that fails
+records an ExceptionHolder with Interpreter.raise_exception().
+
+Names local to a Procedure (its arguments and the names its body
+assigns) are resolved at compile time to slot indexes in the Frame the
+Procedure runs with, so that they are read and assigned without a
+dictionary lookup.  Other names, including all names at module level,
+are looked up in the frame and the symtable as by Interpreter.run().
+"""
+from __future__ import division, print_function
+import ast
+from sys import exc_info, version_info
+
+from .astutils import (UNSAFE_ATTRS, ARRAY_NODES, ARRAY_STEP_SIZE, is_ndarray,
+                       op2func, op2inplace, symbol_usage, valid_symbol_name)
+from .fusion import FUSE_MIN_OPS, FUSE_MIN_SIZE, FUSED_NODES, build_kernel
+
+# control flow signals, returned by compiled statements
+BREAK = ast.Break()
+CONTINUE = ast.Continue()
+RETURN = ast.Return()
+
+# nodes that Interpreter.run() does not run, for Compiler.cost()
+NOT_RUN = (ast.expr_context, ast.operator, ast.unaryop, ast.boolop,
+           ast.cmpop)
+
+
+# marks the slots of local names that are not assigned
+UNBOUND = object()
+
+
+def _noop():
+    """empty block"""
+    return None
+
+
+def local_names(node):
+    """names assigned in the body of a FunctionDef node, including the
+    names of the procedures it defines, but not the names assigned
+    inside them"""
+    names = []
+    todo = list(reversed(node.body))
+    while todo:
+        tnode = todo.pop()
+        ntype = type(tnode)
+        if ntype is ast.Name:
+            if type(tnode.ctx) is ast.Store and tnode.id not in names:
+                names.append(tnode.id)
+            continue
+        elif ntype is ast.FunctionDef:
+            if tnode.name not in names:
+                names.append(tnode.name)
+            todo.extend(reversed(tnode.args.defaults))
+            continue
+        elif ntype is ast.ExceptHandler and isinstance(tnode.name, str):
+            if tnode.name not in names:
+                names.append(tnode.name)
+        children = list(ast.iter_child_nodes(tnode))
+        todo.extend(reversed(children))
+    return names
+
+
+class Frame(object):
+    """local frame of a compiled Procedure
+
+    The values of the names in `index` (a dictionary of names to slot
+    indexes) are kept in the list `slots`, with UNBOUND for those not
+    assigned.  Other names, such as the local names of the caller, are
+    kept in the dictionary `extra`.  A Frame is used as a dictionary of
+    the names it holds.
+    """
+
+    __slots__ = ('index', 'slots', 'extra')
+
+    def __init__(self, index):
+        self.index = index
+        self.slots = [UNBOUND] * len(index)
+        self.extra = {}
+
+    def __contains__(self, name):
+        i = self.index.get(name)
+        if i is None:
+            return name in self.extra
+        return self.slots[i] is not UNBOUND
+
+    def __getitem__(self, name):
+        i = self.index.get(name)
+        if i is None:
+            return self.extra[name]
+        val = self.slots[i]
+        if val is UNBOUND:
+            raise KeyError(name)
+        return val
+
+    def __setitem__(self, name, val):
+        i = self.index.get(name)
+        if i is None:
+            self.extra[name] = val
+        else:
+            self.slots[i] = val
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, name, default=None):
+        """value of name, or default"""
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def pop(self, name):
+        """remove name, returning its value"""
+        i = self.index.get(name)
+        if i is None:
+            return self.extra.pop(name)
+        val = self[name]
+        self.slots[i] = UNBOUND
+        return val
+
+    def keys(self):
+        """names held in the frame"""
+        out = [name for name, i in self.index.items()
+               if self.slots[i] is not UNBOUND]
+        out.extend(self.extra)
+        return out
+
+    def items(self):
+        """(name, value) pairs held in the frame"""
+        return [(name, self[name]) for name in self.keys()]
+
+    def update(self, other):
+        """set the names of a dictionary or Frame"""
+        for name in other.keys():
+            self[name] = other[name]
+
+
+class Program(object):
+    """compiled program: the source text, its AST and the closure
+    that runs it.  Run it with Interpreter.run() or Interpreter.eval().
+    `native` is True for programs compiled to Python code objects.
+    `guards` holds the symbols folded in by the optimizer, if any: the
+    program is compiled again if one of them changes.  `usage` is the
+    SymbolUsage of the AST, found on first use.
+
+    Programs can be pickled: only the source and AST are kept, and the
+    Interpreter that runs an unpickled Program compiles it again.
+    """
+
+    def __init__(self, source, tree, func, native=False):
+        self.source = source
+        self.tree = tree
+        self.func = func
+        self.native = native
+        self.guards = None
+        self._usage = None
+
+    @property
+    def usage(self):
+        """SymbolUsage of the program: names read, written and called,
+        and attributes used"""
+        if self._usage is None:
+            self._usage = symbol_usage(self.tree)
+        return self._usage
+
+    def __getstate__(self):
+        return {'source': self.source, 'tree': self.tree}
+
+    def __setstate__(self, state):
+        self.__init__(state['source'], state['tree'], None)
+
+    def __repr__(self):
+        return "<Program %r>" % (self.source,)
+
+
+class Compiler(object):
+    """compile parsed AST nodes into closures for an Interpreter
+
+    There is one on_xxx method for each supported node type, returning
+    a closure.  Expression closures take no arguments and return their
+    value.  Statement closures take no arguments and return None, or
+    one of BREAK, CONTINUE, RETURN.  Assignment targets are compiled
+    with target() into closures that take the value to assign.
+    """
+
+    statements = ('assert', 'assign', 'augassign', 'break', 'continue',
+                  'delete', 'expr', 'for', 'functiondef', 'if', 'pass',
+                  'print', 'raise', 'return', 'try', 'tryexcept',
+                  'tryfinally', 'while')
+
+    def __init__(self, interp):
+        self.interp = interp
+        self.scope = None      # name -> slot index in a Procedure body
+        self.handlers = {}
+        for node in interp.supported_nodes:
+            handler = getattr(self, "on_%s" % node, None)
+            if handler is not None:
+                self.handlers[node] = handler
+        if 'try' in self.handlers:
+            self.handlers['tryexcept'] = self.handlers['try']
+            self.handlers['tryfinally'] = self.handlers['try']
+
+    def compile(self, node):
+        """compile node to closure"""
+        if node is None:
+            return _noop
+        name = node.__class__.__name__.lower()
+        try:
+            handler = self.handlers[name]
+        except KeyError:
+            return self.interp.unimplemented(node)
+        func = None
+        if ((self.interp.fuse_arrays or self.interp.array_threads > 1) and
+                name in FUSED_NODES):
+            func = self.fused(node)
+        if func is None:
+            func = handler(node)
+        if self.interp.max_steps is not None and name in ARRAY_NODES:
+            return self.array_steps(func)
+        return func
+
+    def fused(self, node):
+        """compile the elementwise operations of node with a
+        fusion.Kernel, or return None if it has too few of them"""
+        interp = self.interp
+        min_ops = 1 if interp.array_threads > 1 else FUSE_MIN_OPS
+        kernel = build_kernel(node, interp.symtable, min_ops=min_ops)
+        if kernel is None:
+            return None
+        leaves = [self.compile(leaf) for leaf in kernel.leaves]
+        funcs = [self.compile(fnode) for fnode in kernel.funcs]
+        count = interp.max_steps is not None
+
+        def fused():
+            try:
+                values = []
+                for leaf in leaves:  # no comprehension frame per call
+                    values.append(leaf())
+                out = kernel.run(values, [func() for func in funcs],
+                                 min_size=(FUSE_MIN_SIZE if interp.fuse_arrays
+                                           else interp.thread_min_size),
+                                 threads=interp.array_threads,
+                                 thread_min_size=interp.thread_min_size)
+                if count:
+                    interp.steps += kernel.array_steps(values, out)
+                return out
+            except:
+                interp.raise_exception(node)
+        return fused
+
+    def array_steps(self, func):
+        """wrap an expression closure to count the steps for array
+        results, as Interpreter.run() does with a step budget"""
+        interp = self.interp
+
+        def counted():
+            out = func()
+            if is_ndarray(out):
+                interp.steps += out.size // ARRAY_STEP_SIZE
+                if interp.steps >= interp._next_check:
+                    interp.check_limits()
+            return out
+        return counted
+
+    def statement(self, node):
+        """compile node as a statement"""
+        if node.__class__.__name__.lower() in self.statements:
+            return self.compile(node)
+        func = self.compile(node)
+
+        def stmt():
+            func()
+        return stmt
+
+    def block(self, nodes):
+        """compile list of statements"""
+        funcs = [self.statement(tnode) for tnode in nodes]
+        if not funcs:
+            return _noop
+        if len(funcs) == 1:
+            return funcs[0]
+
+        def block():
+            for func in funcs:
+                sig = func()
+                if sig is not None:
+                    return sig
+        return block
+
+    def cost(self, nodes):
+        """steps counted for running nodes once, as run() would count
+        them, except for calls and the nodes run by loops, comprehensions
+        and procedures, which count their own steps"""
+        costs = self.interp.node_costs
+        total, todo = 0, list(nodes)
+        while todo:
+            tnode = todo.pop()
+            if isinstance(tnode, NOT_RUN) or (
+                    isinstance(tnode, ast.Name) and
+                    not isinstance(tnode.ctx, ast.Load)):
+                continue
+            name = tnode.__class__.__name__.lower()
+            if name != 'call':
+                total += costs.get(name, 1)
+            if name not in ('for', 'while', 'listcomp', 'functiondef'):
+                todo.extend(ast.iter_child_nodes(tnode))
+        return total
+
+    def time_check(self, nodes=()):
+        """closure run on each loop iteration: counts the steps of
+        running nodes, checks the limits of the Interpreter (raising
+        RuntimeError once exceeded) and calls its step_hook"""
+        interp = self.interp
+        cost = max(1, self.cost(nodes))
+
+        def check():
+            interp.steps += cost
+            if interp.steps >= interp._next_check:
+                interp.check_limits()
+            if interp.step_hook is not None:
+                interp.step_hook()
+        return check
+
+    def module(self, node, source=None):
+        """compile a Module node to a Program"""
+        return Program(source, node, self.compile(node))
+
+    # closures for ast components
+    def on_module(self, node):  # ():('body',)
+        """module def: returns value of the final expression"""
+        body = node.body
+        last = None
+        if body and isinstance(body[-1], ast.Expr):
+            last = self.compile(body[-1].value)
+            body = body[:-1]
+        funcs = [self.statement(tnode) for tnode in body]
+        temps = getattr(node, 'temporaries', ())
+        interp = self.interp
+
+        def module():
+            try:
+                for func in funcs:
+                    func()
+                if last is not None:
+                    return last()
+            finally:
+                # temporaries left by optimizer.CommonSubexpressions
+                for name in temps:
+                    interp.symtable.pop(name, None)
+        return module
+
+    def on_expr(self, node):
+        """expression statement"""
+        return self.statement(node.value)
+
+    def on_index(self, node):
+        """index"""
+        return self.compile(node.value)
+
+    def on_return(self, node):  # ('value',)
+        """return statement"""
+        interp = self.interp
+        value = self.compile(node.value)
+
+        def return_():
+            interp.retval = value()
+            return RETURN
+        return return_
+
+    def on_repr(self, node):
+        """repr """
+        interp = self.interp
+        value = self.compile(node.value)
+
+        def repr_():
+            try:
+                return repr(value())
+            except:
+                interp.raise_exception(node)
+        return repr_
+
+    # noinspection PyUnusedLocal
+    def on_pass(self, node):
+        """pass statement"""
+        return _noop
+
+    # noinspection PyUnusedLocal
+    def on_ellipsis(self, node):
+        """ellipses"""
+        return lambda: Ellipsis
+
+    # noinspection PyUnusedLocal
+    def on_break(self, node):
+        """break"""
+        return lambda: BREAK
+
+    # noinspection PyUnusedLocal
+    def on_continue(self, node):
+        """continue"""
+        return lambda: CONTINUE
+
+    def on_assert(self, node):  # ('test', 'msg')
+        """assert statement"""
+        interp = self.interp
+        test = self.compile(node.test)
+
+        def assert_():
+            if not test():
+                interp.raise_exception(node, exc=AssertionError, msg=node.msg)
+        return assert_
+
+    def on_list(self, node):  # ('elt', 'ctx')
+        """list"""
+        elts = [self.compile(e) for e in node.elts]
+        return lambda: [e() for e in elts]
+
+    def on_tuple(self, node):  # ('elts', 'ctx')
+        """tuple"""
+        elts = [self.compile(e) for e in node.elts]
+        return lambda: tuple([e() for e in elts])
+
+    def on_dict(self, node):  # ('keys', 'values')
+        """dictionary"""
+        items = [(self.compile(k), self.compile(v))
+                 for k, v in zip(node.keys, node.values)]
+        return lambda: dict([(k(), v()) for k, v in items])
+
+    def on_num(self, node):  # ('n',)
+        """return number"""
+        val = node.n
+        return lambda: val
+
+    def on_str(self, node):  # ('s',)
+        """return string"""
+        val = node.s
+        return lambda: val
+
+    def on_nameconstant(self, node):
+        """ True, False, None in python >= 3.4 """
+        val = node.value
+        return lambda: val
+
+    def on_name(self, node):  # ('id', 'ctx')
+        """ Name node """
+        interp = self.interp
+        name = node.id
+        if node.ctx.__class__ in (ast.Param, ast.Del):
+            name = str(name)
+            return lambda: name
+        msg = "name '%s' is not defined" % name
+        if self.scope is not None and name in self.scope:
+            i = self.scope[name]
+
+            def name_():
+                val = interp.frame.slots[i]
+                if val is not UNBOUND:
+                    return val
+                try:
+                    return interp.symtable[name]
+                except KeyError:
+                    pass
+                interp.raise_exception(node, exc=NameError, msg=msg)
+            return name_
+
+        def name_():
+            frame = interp.frame
+            if frame is not None and name in frame:
+                return frame[name]
+            try:
+                return interp.symtable[name]
+            except KeyError:
+                pass
+            interp.raise_exception(node, exc=NameError, msg=msg)
+        return name_
+
+    def on_attribute(self, node):  # ('value', 'attr', 'ctx')
+        """extract attribute"""
+        interp = self.interp
+        value = self.compile(node.value)
+        attr = node.attr
+        if node.ctx.__class__ == ast.Store:
+            msg = "attribute for storage: shouldn't be here!"
+            return lambda: interp.raise_exception(node, exc=RuntimeError,
+                                                  msg=msg)
+        if attr in UNSAFE_ATTRS:
+            def attribute():
+                msg = "cannnot access attribute '%s' for %s" % (attr, value())
+                interp.raise_exception(node, exc=AttributeError, msg=msg)
+            return attribute
+
+        def attribute():
+            sym = value()
+            try:
+                return getattr(sym, attr)
+            except AttributeError:
+                pass
+            msg = "no attribute '%s' for %s" % (attr, sym)
+            interp.raise_exception(node, exc=AttributeError, msg=msg)
+        return attribute
+
+    def target(self, node):
+        """compile assignment target to a closure taking the value,
+        as for Interpreter.node_assign()"""
+        interp = self.interp
+        if node.__class__ == ast.Name:
+            name = node.id
+            if not valid_symbol_name(name):
+                errmsg = "invalid symbol name (reserved word?) %s" % name
+
+                # noinspection PyUnusedLocal
+                def assign(val):
+                    interp.raise_exception(node, exc=NameError, msg=errmsg)
+                return assign
+            if self.scope is not None and name in self.scope:
+                i = self.scope[name]
+
+                def assign(val):
+                    interp.frame.slots[i] = val
+                return assign
+
+            def assign(val):
+                if interp.frame is not None:
+                    interp.frame[name] = val
+                    return
+                interp.symtable[name] = val
+                if interp._no_deepcopy is not None:
+                    interp.remove_no_deepcopy(name)
+            return assign
+
+        elif node.__class__ == ast.Attribute:
+            attr = node.attr
+            if node.ctx.__class__ == ast.Load:
+                msg = "cannot assign to attribute %s" % attr
+
+                # noinspection PyUnusedLocal
+                def assign(val):
+                    interp.raise_exception(node, exc=AttributeError, msg=msg)
+                return assign
+            value = self.compile(node.value)
+
+            def assign(val):
+                setattr(value(), attr, val)
+            return assign
+
+        elif node.__class__ == ast.Subscript:
+            value = self.compile(node.value)
+            xslice = self.compile(node.slice)
+            if isinstance(node.slice, ast.Slice):
+                def assign(val):
+                    sym = value()
+                    sl = xslice()
+                    sym[slice(sl.start, sl.stop)] = val
+            elif isinstance(node.slice, (ast.Index, ast.ExtSlice)):
+                def assign(val):
+                    sym = value()
+                    sym[xslice()] = val
+            else:
+                def assign(val):
+                    value()
+                    xslice()
+            return assign
+
+        elif node.__class__ in (ast.Tuple, ast.List):
+            targets = [self.target(telem) for telem in node.elts]
+            ntargets = len(targets)
+
+            def assign(val):
+                if len(val) != ntargets:
+                    raise ValueError('too many values to unpack')
+                for telem, tval in zip(targets, val):
+                    telem(tval)
+            return assign
+
+        return self.interp.unimplemented(node)
+
+    def on_assign(self, node):  # ('targets', 'value')
+        """simple assignment"""
+        interp = self.interp
+        value = self.compile(node.value)
+        targets = [self.target(tnode) for tnode in node.targets]
+        if len(targets) == 1:
+            target = targets[0]
+
+            def assign():
+                try:
+                    target(value())
+                except:
+                    interp.raise_exception(node)
+            return assign
+
+        def assign():
+            try:
+                val = value()
+                for target in targets:
+                    target(val)
+            except:
+                interp.raise_exception(node)
+        return assign
+
+    def on_augassign(self, node):  # ('target', 'op', 'value')
+        """augmented assign, with the in-place operator, as for
+        Interpreter.on_augassign()"""
+        interp = self.interp
+        tnode = node.target
+        value = self.compile(node.value)
+        op = op2inplace(node.op)
+        count = interp.max_steps is not None
+
+        def result(current):
+            out = op(current, value())
+            if count and is_ndarray(out):
+                interp.steps += out.size // ARRAY_STEP_SIZE
+            return out
+
+        if tnode.__class__ == ast.Subscript:
+            obj = self.compile(tnode.value)
+            xslice = self.compile(tnode.slice)
+
+            def augassign():
+                try:
+                    sym = obj()
+                    key = xslice()
+                    sym[key] = result(sym[key])
+                except:
+                    interp.raise_exception(node)
+            return augassign
+
+        elif tnode.__class__ == ast.Attribute:
+            obj = self.compile(tnode.value)
+            attr = tnode.attr
+            if attr in UNSAFE_ATTRS:
+                def augassign():
+                    msg = "cannnot access attribute '%s' for %s" % (attr, obj())
+                    interp.raise_exception(tnode, exc=AttributeError, msg=msg)
+                return augassign
+
+            def augassign():
+                try:
+                    sym = obj()
+                    setattr(sym, attr, result(getattr(sym, attr)))
+                except:
+                    interp.raise_exception(node)
+            return augassign
+
+        elif tnode.__class__ != ast.Name:
+            return interp.unimplemented(tnode)
+        current = self.on_name(tnode)
+        target = self.target(tnode)
+
+        def augassign():
+            try:
+                target(result(current()))
+            except:
+                interp.raise_exception(node)
+        return augassign
+
+    def on_slice(self, node):  # ():('lower', 'upper', 'step')
+        """simple slice"""
+        lower = self.compile(node.lower)
+        upper = self.compile(node.upper)
+        step = self.compile(node.step)
+        return lambda: slice(lower(), upper(), step())
+
+    def on_extslice(self, node):  # ():('dims',)
+        """extended slice"""
+        dims = [self.compile(tnode) for tnode in node.dims]
+        return lambda: tuple([d() for d in dims])
+
+    def on_subscript(self, node):  # ('value', 'slice', 'ctx')
+        """subscript handling"""
+        interp = self.interp
+        value = self.compile(node.value)
+        nslice = self.compile(node.slice)
+        if node.ctx.__class__ not in (ast.Load, ast.Store):
+            msg = "subscript with unknown context"
+            return lambda: interp.raise_exception(node, msg=msg)
+
+        def subscript():
+            try:
+                return value()[nslice()]
+            except:
+                interp.raise_exception(node)
+        return subscript
+
+    def on_delete(self, node):  # ('targets',)
+        """delete statement"""
+        interp = self.interp
+        names = []
+        for tnode in node.targets:
+            if tnode.ctx.__class__ != ast.Del:
+                break
+            children = []
+            while tnode.__class__ == ast.Attribute:
+                children.append(tnode.attr)
+                tnode = tnode.value
+            if tnode.__class__ == ast.Name:
+                children.append(tnode.id)
+                children.reverse()
+                names.append('.'.join(children))
+            else:
+                names.append(None)
+
+        def delete():
+            try:
+                for name in names:
+                    if name is None:
+                        interp.raise_exception(node, msg="could not delete symbol")
+                    if interp.frame is not None and name in interp.frame:
+                        interp.frame.pop(name)
+                    else:
+                        interp.symtable.pop(name)
+            except:
+                interp.raise_exception(node)
+        return delete
+
+    def on_unaryop(self, node):  # ('op', 'operand')
+        """unary operator"""
+        interp = self.interp
+        op = op2func(node.op)
+        operand = self.compile(node.operand)
+
+        def unaryop():
+            try:
+                return op(operand())
+            except:
+                interp.raise_exception(node)
+        return unaryop
+
+    def on_binop(self, node):  # ('left', 'op', 'right')
+        """binary operator"""
+        interp = self.interp
+        op = op2func(node.op)
+        left = self.compile(node.left)
+        right = self.compile(node.right)
+
+        def binop():
+            try:
+                return op(left(), right())
+            except:
+                interp.raise_exception(node)
+        return binop
+
+    def on_boolop(self, node):  # ('op', 'values')
+        """boolean operator"""
+        interp = self.interp
+        first = self.compile(node.values[0])
+        others = [self.compile(n) for n in node.values[1:]]
+        op = op2func(node.op)
+        is_and = ast.And == node.op.__class__
+
+        def boolop():
+            try:
+                val = first()
+                if (is_and and val) or (not is_and and not val):
+                    for other in others:
+                        val = op(val, other())
+                        if (is_and and not val) or (not is_and and val):
+                            break
+                return val
+            except:
+                interp.raise_exception(node)
+        return boolop
+
+    def on_compare(self, node):  # ('left', 'ops', 'comparators')
+        """comparison operators"""
+        interp = self.interp
+        left = self.compile(node.left)
+        comps = [(op2func(op), self.compile(rnode))
+                 for op, rnode in zip(node.ops, node.comparators)]
+        if len(comps) == 1:
+            op, right = comps[0]
+
+            def compare():
+                try:
+                    return op(left(), right())
+                except:
+                    interp.raise_exception(node)
+            return compare
+
+        def compare():
+            try:
+                lval = left()
+                out = True
+                for op, right in comps:
+                    rval = right()
+                    out = op(lval, rval)
+                    lval = rval
+                    if interp.use_numpy and is_ndarray(out) and out.any():
+                        break
+                    elif not out:
+                        break
+                return out
+            except:
+                interp.raise_exception(node)
+        return compare
+
+    def on_print(self, node):  # ('dest', 'values', 'nl')
+        """Python2 style print statement"""
+        interp = self.interp
+        dest = self.compile(node.dest)
+        values = [self.compile(tnode) for tnode in node.values]
+        end = ''
+        if node.nl:
+            end = '\n'
+
+        def print_():
+            try:
+                out = [val() for val in values]
+                if out:
+                    interp._printer(*out, file=dest() or interp.writer, end=end)
+            except:
+                interp.raise_exception(node)
+        return print_
+
+    def on_if(self, node):  # ('test', 'body', 'orelse')
+        """regular if-then-else statement"""
+        interp = self.interp
+        test = self.compile(node.test)
+        body = self.block(node.body)
+        orelse = self.block(node.orelse)
+
+        def if_():
+            try:
+                if test():
+                    return body()
+                return orelse()
+            except:
+                interp.raise_exception(node)
+        return if_
+
+    def on_ifexp(self, node):  # ('test', 'body', 'orelse')
+        """if expressions"""
+        interp = self.interp
+        test = self.compile(node.test)
+        body = self.compile(node.body)
+        orelse = self.compile(node.orelse)
+
+        def ifexp():
+            try:
+                if test():
+                    return body()
+                return orelse()
+            except:
+                interp.raise_exception(node)
+        return ifexp
+
+    def on_while(self, node):  # ('test', 'body', 'orelse')
+        """while blocks"""
+        interp = self.interp
+        test = self.compile(node.test)
+        body = self.block(node.body)
+        orelse = self.block(node.orelse)
+        check = self.time_check([node.test] + node.body)
+
+        def while_():
+            try:
+                while test():
+                    check()
+                    sig = body()
+                    if sig is BREAK:
+                        break
+                    elif sig is RETURN:
+                        return sig
+                else:
+                    return orelse()
+            except:
+                interp.raise_exception(node)
+        return while_
+
+    def on_for(self, node):  # ('target', 'iter', 'body', 'orelse')
+        """for blocks"""
+        interp = self.interp
+        target = self.target(node.target)
+        iter_ = self.compile(node.iter)
+        body = self.block(node.body)
+        orelse = self.block(node.orelse)
+        check = self.time_check(node.body)
+
+        def for_():
+            try:
+                for val in iter_():
+                    target(val)
+                    check()
+                    sig = body()
+                    if sig is BREAK:
+                        break
+                    elif sig is RETURN:
+                        return sig
+                else:
+                    return orelse()
+            except:
+                interp.raise_exception(node)
+        return for_
+
+    def on_listcomp(self, node):  # ('elt', 'generators')
+        """list comprehension"""
+        interp = self.interp
+        elt = self.compile(node.elt)
+        loop = None
+        for tnode in reversed(node.generators):
+            nodes = list(tnode.ifs)
+            if loop is None:
+                nodes.append(node.elt)
+            check = self.time_check(nodes)
+            loop = self._comprehension(tnode, elt, loop, check)
+
+        def listcomp():
+            out = []
+            try:
+                loop(out)
+            except:
+                interp.raise_exception(node)
+            return out
+        return listcomp
+
+    def _comprehension(self, node, elt, inner, check):
+        """one 'for' clause of a comprehension, running the inner clause
+        (or appending elt to out for the innermost clause)"""
+        iter_ = self.compile(node.iter)
+        target = self.target(node.target)
+        ifs = [self.compile(cond) for cond in node.ifs]
+
+        def loop(out):
+            for val in iter_():
+                target(val)
+                check()
+                add = True
+                for cond in ifs:
+                    add = add and cond()
+                if add:
+                    if inner is None:
+                        out.append(elt())
+                    else:
+                        inner(out)
+        return loop
+
+    def on_try(self, node):  # ('body', 'handlers', 'orelse', 'finalbody')
+        """try/except/else/finally blocks"""
+        interp = self.interp
+        body = self.block(node.body)
+        handlers = []
+        for hnd in node.handlers:
+            htype = None
+            if hnd.type is not None:
+                htype = self.compile(hnd.type)
+            name = hnd.name
+            if name is not None:
+                if not isinstance(name, ast.AST):
+                    name = ast.copy_location(ast.Name(id=name, ctx=ast.Store()), hnd)
+                name = self.target(name)
+            handlers.append((htype, name, self.block(hnd.body)))
+        orelse = self.block(getattr(node, 'orelse', []))
+        finalbody = self.block(getattr(node, 'finalbody', []))
+
+        def try_():
+            sig = None
+            try:
+                try:
+                    sig = body()
+                except Exception:
+                    e_value = exc_info()[1]
+                    for htype, name, hbody in handlers:
+                        if htype is None or isinstance(e_value, htype()):
+                            interp.error = []
+                            if name is not None:
+                                name(e_value)
+                            sig = hbody()
+                            break
+                    else:
+                        raise
+                else:
+                    sig = orelse()
+            finally:
+                fsig = finalbody()
+                if fsig is not None:
+                    sig = fsig
+            return sig
+        return try_
+
+    def on_raise(self, node):  # ('type', 'inst', 'tback')
+        """raise statement: note difference for python 2 and 3"""
+        interp = self.interp
+        if version_info[0] == 3:
+            excnode = node.exc
+            msgnode = node.cause
+        else:
+            excnode = node.type
+            msgnode = node.inst
+        exc = self.compile(excnode)
+        msgf = self.compile(msgnode)
+
+        def raise_():
+            try:
+                out = exc()
+                msg = ' '.join(out.args)
+                msg2 = msgf()
+                if msg2 not in (None, 'None'):
+                    msg = "%s: %s" % (msg, msg2)
+                interp.raise_exception(None, exc=out.__class__, msg=msg, expr='')
+            except:
+                interp.raise_exception(node)
+        return raise_
+
+    def on_call(self, node):
+        """function execution"""
+        #  ('func', 'args', 'keywords', and 'starargs', 'kwargs' in py < 3.5)
+        interp = self.interp
+        func = self.compile(node.func)
+        args = [self.compile(targ) for targ in node.args]
+        starargs = getattr(node, 'starargs', None)
+        if starargs is not None:
+            starargs = self.compile(starargs)
+        keywords = []
+        for key in node.keywords:
+            if not isinstance(key, ast.keyword):
+                return lambda: interp.raise_exception(
+                    node, msg="keyword error in function call '%s'" % func())
+            keywords.append((key.arg, self.compile(key.value)))
+        kwargs = getattr(node, 'kwargs', None)
+        if kwargs is not None:
+            kwargs = self.compile(kwargs)
+
+        def call():
+            try:
+                fcn = func()
+                if not callable(fcn) and not isinstance(fcn, type):
+                    msg = "'%s' is not callable!!" % fcn
+                    interp.raise_exception(node, exc=TypeError, msg=msg)
+                fargs = [arg() for arg in args]
+                if starargs is not None:
+                    fargs = fargs + starargs()
+                fkeys = {}
+                for key, val in keywords:
+                    fkeys[key] = val()
+                if kwargs is not None:
+                    fkeys.update(kwargs())
+                # noinspection PyBroadException
+                try:
+                    ret = fcn(*fargs, **fkeys)
+                except:
+                    interp.raise_exception(node, msg="Error running %s" % fcn)
+                if isinstance(ret, enumerate):
+                    ret = list(ret)
+                return ret
+            except:
+                interp.raise_exception(node)
+        if interp.max_steps is None:
+            return call
+
+        cost = interp.node_costs.get('call', 1)
+
+        def counted_call():
+            interp.steps += cost
+            if interp.steps >= interp._next_check:
+                interp.check_limits()
+            return call()
+        return counted_call
+
+    def on_functiondef(self, node):
+        """define procedures"""
+        # ('name', 'args', 'body', 'decorator_list')
+        from .asteval import Procedure
+        interp = self.interp
+        if node.decorator_list:
+            def functiondef():
+                try:
+                    raise Warning("decorated procedures not supported!")
+                except:
+                    interp.raise_exception(node)
+            return functiondef
+
+        offset = len(node.args.args) - len(node.args.defaults)
+        if version_info[0] == 3:
+            argnames = [tnode.arg for tnode in node.args.args]
+        else:
+            argnames = [str(tnode.id) for tnode in node.args.args]
+        defaults = [(argnames[idef + offset], self.compile(defnode))
+                    for idef, defnode in enumerate(node.args.defaults)]
+        args = argnames[:offset]
+
+        doc = None
+        nb0 = node.body[0]
+        if isinstance(nb0, ast.Expr) and isinstance(nb0.value, ast.Str):
+            doc = nb0.value.s
+
+        varkws = node.args.kwarg
+        vararg = node.args.vararg
+        if version_info[0] == 3:
+            if isinstance(vararg, ast.arg):
+                vararg = vararg.arg
+            if isinstance(varkws, ast.arg):
+                varkws = varkws.arg
+        name = node.name
+        index = {}
+        for lname in args + [key for key, _ in defaults] + [
+                vararg, varkws] + local_names(node):
+            if lname is not None and lname not in index:
+                index[lname] = len(index)
+        save_scope = self.scope
+        self.scope = index
+        try:
+            code = self.block(node.body)
+        finally:
+            self.scope = save_scope
+        cost = self.cost(node.body)
+
+        def functiondef():
+            try:
+                kwargs = [(key, defval()) for key, defval in defaults]
+                proc = Procedure(name, interp, doc=doc, lineno=interp.lineno,
+                                 body=node.body, args=args, kwargs=kwargs,
+                                 vararg=vararg, varkws=varkws, code=code,
+                                 index=index, cost=cost)
+                if interp.frame is not None:
+                    interp.frame[name] = proc
+                    return
+                interp.symtable[name] = proc
+                interp.remove_no_deepcopy(name)
+            except:
+                interp.raise_exception(node)
+        return functiondef
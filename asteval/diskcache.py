@@ -0,0 +1,339 @@
+"""
+persistent on-disk cache of parsed programs
+
+A ProgramCache keeps the expressions that parsed, with their symbol
+usage (see astutils.symbol_usage), in a directory, so that a process
+can look up what a stored expression reads, writes and calls without
+parsing it.  It can be used wherever an LRUCache is used as a parse
+cache:
+
+    cache = ProgramCache('/var/cache/asteval')
+    interp = Interpreter(parse_cache=cache)
+    ...
+    cache.flush()
+
+ASTs themselves are not stored: in CPython, ast.parse() is faster than
+rebuilding an AST from pickle or marshal data.  Programs loaded from the
+cache parse their source on first use of their `tree`, so that a
+process can open a cache of many expressions without parsing any.
+
+The cache holds one subdirectory per asteval version, Python version
+and implementation.  In each, `data` holds marshalled entries (source
+text and symbol usage) one after another, and `index` a sorted table
+of (hash of the source text, offset, length) records.  The index is
+mapped into memory with mmap and searched by bisection, so opening a
+cache reads nothing up front, and each lookup reads only the entry it
+needs.  Entries are checked against the source text when loaded.
+Being marshal data, not pickles, entries can not run code when loaded.
+
+New entries are kept in memory until flush() (called by close(), and
+once `flush_every` are pending), which appends them to `data` and
+replaces `index`.  Several processes may share a cache directory: a
+lock file serializes flushes (on systems with fcntl), and a process
+sees the entries flushed by others when a lookup misses.
+"""
+from __future__ import division, print_function
+import ast
+import hashlib
+import marshal
+import mmap
+import os
+import platform
+import struct
+import sys
+from collections import OrderedDict
+from threading import RLock
+
+from .astutils import LRUCache, SymbolUsage
+from .compiler import Program
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FORMAT_VERSION = 1
+MAGIC = b'ASTEVALC'
+HEADER = struct.Struct('>8sII')      # magic, format version, entries
+RECORD = struct.Struct('>16sQI')     # hash, offset, length
+HASH_SIZE = 16
+PREFIX = struct.Struct('>Q')         # leading bytes of a hash
+PREFIX_MAX = 2**64 - 1
+FLUSH_EVERY = 1000
+
+
+def cache_namespace():
+    """name of the subdirectory for this asteval and Python version"""
+    from . import __version__
+    return 'asteval-%s-%s-%d.%d' % (__version__,
+                                    platform.python_implementation().lower(),
+                                    sys.version_info[0], sys.version_info[1])
+
+
+class CachedProgram(Program):
+    """Program loaded from a ProgramCache, parsing its source on first
+    use of its AST"""
+
+    def __init__(self, source, tree=None, func=None, native=False,
+                 usage=None):
+        Program.__init__(self, source, tree, func, native=native)
+        self._usage = usage
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = ast.parse(self.source)
+        return self._tree
+
+    @tree.setter
+    def tree(self, value):
+        self._tree = value
+
+    def __setstate__(self, state):
+        Program.__init__(self, state['source'], state['tree'], None)
+
+
+def source_hash(text):
+    """hash of a source text, as used for the index"""
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).digest()[:HASH_SIZE]
+
+
+class ProgramCache(object):
+    """a parse cache persisted in a directory
+
+    :param path: cache directory, created if needed
+    :param maxsize: number of entries also kept in memory, in an LRUCache
+    :param flush_every: number of new entries held before flush()
+
+    get() and put() follow LRUCache, so a ProgramCache can be passed to
+    Interpreter as `parse_cache`.  get_program() returns a Program
+    (without compiled code) whose `usage` is loaded from the cache, and
+    whose source is parsed on first use of its `tree`.
+    """
+
+    def __init__(self, path, maxsize=1024, flush_every=FLUSH_EVERY):
+        self.path = os.path.join(path, cache_namespace())
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.index_file = os.path.join(self.path, 'index')
+        self.data_file = os.path.join(self.path, 'data')
+        self.lock_file = os.path.join(self.path, 'lock')
+        self.flush_every = flush_every
+        self.memory = LRUCache(maxsize=maxsize, maxbytes=None)
+        self.pending = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = RLock()
+        self._index = None
+        self._count = 0
+        self._stat = None
+        self._data = None
+        self._open()
+
+    def _open(self):
+        """map the index file into memory"""
+        self._close_files()
+        try:
+            fh = open(self.index_file, 'rb')
+        except (IOError, OSError):
+            return
+        with fh:
+            stat = os.fstat(fh.fileno())
+            if stat.st_size < HEADER.size:
+                return
+            index = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(index, 0)
+        if (magic != MAGIC or version != FORMAT_VERSION or
+                stat.st_size < HEADER.size + count*RECORD.size):
+            index.close()
+            return
+        self._index, self._count = index, count
+        self._stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def _close_files(self):
+        if self._index is not None:
+            self._index.close()
+        if self._data is not None:
+            self._data.close()
+        self._index, self._count, self._stat, self._data = None, 0, None, None
+
+    def _changed(self):
+        """whether the index was replaced since it was mapped"""
+        try:
+            stat = os.stat(self.index_file)
+        except OSError:
+            return False
+        return self._stat != (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def _find(self, digest):
+        """(offset, length) of an entry in the data file, or None.
+        Hashes are uniform, so interpolation search needs only a few
+        probes of the index."""
+        index, size = self._index, RECORD.size
+        target = PREFIX.unpack_from(digest)[0]
+        low, high = 0, self._count - 1
+        klow, khigh = 0, PREFIX_MAX
+        while low <= high:
+            pos = low + (target - klow)*(high - low) // max(1, khigh - klow)
+            pos = min(max(pos, low), high)
+            start = HEADER.size + pos*size
+            key = index[start:start+HASH_SIZE]
+            if key < digest:
+                low, klow = pos + 1, PREFIX.unpack_from(key)[0]
+            elif key > digest:
+                high, khigh = pos - 1, PREFIX.unpack_from(key)[0]
+            else:
+                return RECORD.unpack_from(index, start)[1:]
+        return None
+
+    def _load(self, text, digest):
+        """Program for text from the files, or None"""
+        location = None
+        if self._index is not None:
+            location = self._find(digest)
+        if location is None and self._changed():
+            self._open()
+            if self._index is not None:
+                location = self._find(digest)
+        if location is None:
+            return None
+        if self._data is None:
+            self._data = open(self.data_file, 'rb')
+        offset, length = location
+        self._data.seek(offset)
+        try:
+            entry = marshal.loads(self._data.read(length))
+        except (EOFError, ValueError, TypeError):
+            return None
+        if entry[0] != text:
+            return None
+        usage = SymbolUsage(*[set(names) for names in entry[1:]])
+        return CachedProgram(text, usage=usage)
+
+    def __len__(self):
+        """number of entries in the index and pending"""
+        return self._count + len(self.pending)
+
+    def __contains__(self, text):
+        return self.get_program(text) is not None
+
+    def get_program(self, text):
+        """return the Program for a source text, or None"""
+        program = self.memory.get(text)
+        if program is not None:
+            self.hits += 1
+            return program
+        with self._lock:
+            digest = source_hash(text)
+            program = self.pending.get(digest)
+            if program is None:
+                program = self._load(text, digest)
+            if program is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.memory.put(text, program)
+            return program
+
+    def get(self, text, default=None):
+        """return the parsed AST for a source text, or default"""
+        program = self.get_program(text)
+        if program is None:
+            return default
+        return program.tree
+
+    def put(self, text, tree, nbytes=0):
+        """add the parsed AST for a source text.  It is written to disk
+        by the next flush()."""
+        program = Program(text, tree, None)
+        self.memory.put(text, program)
+        with self._lock:
+            digest = source_hash(text)
+            if self._index is not None and self._find(digest) is not None:
+                return
+            self.pending[digest] = program
+            if len(self.pending) >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        """write pending entries to the cache directory"""
+        with self._lock:
+            if not self.pending:
+                return
+            with open(self.lock_file, 'a') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                try:
+                    self._write()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            self._open()
+
+    def _write(self):
+        """append pending entries to the data file and write a new
+        index, holding the lock file"""
+        # entries flushed by other processes since the index was mapped
+        if self._changed():
+            self._open()
+        records = {}
+        if self._index is not None:
+            for i in range(self._count):
+                record = RECORD.unpack_from(self._index,
+                                            HEADER.size + i*RECORD.size)
+                records[record[0]] = record[1:]
+        self._close_files()
+
+        with open(self.data_file, 'ab') as data:
+            data.seek(0, os.SEEK_END)
+            offset = data.tell()
+            for digest, program in self.pending.items():
+                if digest in records:
+                    continue
+                usage = program.usage
+                blob = marshal.dumps((program.source,
+                                      tuple(sorted(usage.reads)),
+                                      tuple(sorted(usage.writes)),
+                                      tuple(sorted(usage.calls)),
+                                      tuple(sorted(usage.attrs))))
+                data.write(blob)
+                records[digest] = (offset, len(blob))
+                offset += len(blob)
+        self.pending.clear()
+
+        tmpfile = '%s.%d.tmp' % (self.index_file, os.getpid())
+        with open(tmpfile, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(records)))
+            for digest in sorted(records):
+                out.write(RECORD.pack(digest, *records[digest]))
+        _replace(tmpfile, self.index_file)
+
+    def close(self):
+        """flush pending entries and close the files"""
+        self.flush()
+        with self._lock:
+            self._close_files()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        """return dictionary of cache statistics"""
+        return {'entries': len(self), 'pending': len(self.pending),
+                'hits': self.hits, 'misses': self.misses}
+
+
+def _replace(src, dest):
+    """rename src to dest, replacing dest"""
+    replace = getattr(os, 'replace', None)
+    if replace is not None:
+        replace(src, dest)
+    else:
+        if os.path.exists(dest):
+            os.remove(dest)
+        os.rename(src, dest)
@@ -0,0 +1,375 @@
+"""
+fused evaluation of elementwise array expressions for asteval
+
+An expression such as `a*b + c*d - sqrt(e)` run node by node makes a
+full-size temporary array for every operator and function call.  A
+Kernel runs the elementwise part of such an expression in one go: the
+operands that are not elementwise operations (the leaves) are
+evaluated first, then the operations are applied block by block over
+FUSE_BLOCK_SIZE elements, reusing the same scratch buffers (with the
+`out` argument of numpy ufuncs) for every block and writing the
+result straight into the output array.
+
+The elementwise operations are the arithmetic, bitwise and comparison
+operators of FUSED_OPERATORS, and calls of numpy ufuncs with only
+positional arguments.  The block-wise evaluation is used only when the
+numeric arrays among the leaves all have the same shape, are
+contiguous, and have at least FUSE_MIN_SIZE elements, the other leaves
+being numbers.  Otherwise the operations are applied to the leaves one
+after the other, as the Interpreter would, with the same safe_* guards.
+The exponents of `**` and the shifts of `<<` must be numbers within
+the limits of safe_pow and safe_lshift to be fused.
+
+A call of one of the numpy reductions of FUSED_REDUCTIONS, such as
+`sum(a*b)`, is fused with its argument: each block is reduced as soon
+as it is computed, and the partial results are combined at the end.
+
+With threads > 1, arrays of at least THREAD_MIN_SIZE elements are split
+into one chunk per thread, whose blocks are run on a shared pool of
+worker threads (numpy ufuncs release the GIL while they run).  Sums and
+means of floats may then differ from numpy.sum and numpy.mean in the
+last digits, as the partial sums are added in another order.
+"""
+from __future__ import division, print_function
+import ast
+import os
+import sys
+from numbers import Number
+from threading import Lock
+
+from .astutils import (ARRAY_STEP_SIZE, MAX_EXPONENT, MAX_SHIFT, OPERATORS,
+                       is_ndarray)
+
+# elements per block: the scratch buffers of a block stay in cache
+FUSE_BLOCK_SIZE = 8192
+# smallest arrays evaluated block by block
+FUSE_MIN_SIZE = 2 << 15
+# fewest operations worth a kernel
+FUSE_MIN_OPS = 2
+# smallest arrays split across threads
+THREAD_MIN_SIZE = 1 << 20
+
+# numpy ufuncs of the fused operators
+FUSED_OPERATORS = {ast.Add: 'add', ast.Sub: 'subtract',
+                   ast.Mult: 'multiply', ast.Div: 'true_divide',
+                   ast.FloorDiv: 'floor_divide', ast.Mod: 'remainder',
+                   ast.Pow: 'power', ast.LShift: 'left_shift',
+                   ast.RShift: 'right_shift', ast.BitAnd: 'bitwise_and',
+                   ast.BitOr: 'bitwise_or', ast.BitXor: 'bitwise_xor',
+                   ast.USub: 'negative', ast.UAdd: 'positive',
+                   ast.Invert: 'invert', ast.Eq: 'equal',
+                   ast.NotEq: 'not_equal', ast.Lt: 'less',
+                   ast.LtE: 'less_equal', ast.Gt: 'greater',
+                   ast.GtE: 'greater_equal'}
+
+# numpy reductions fused with their argument, and the function applied
+# to each block (the partial sums of a mean are divided at the end)
+FUSED_REDUCTIONS = {'sum': 'sum', 'prod': 'prod', 'amin': 'amin',
+                    'amax': 'amax', 'min': 'min', 'max': 'max',
+                    'any': 'any', 'all': 'all', 'mean': 'sum'}
+
+# limits on the second operand of guarded operators
+FUSED_LIMITS = {ast.Pow: MAX_EXPONENT, ast.LShift: MAX_SHIFT}
+
+# node types that can start a kernel
+FUSED_NODES = ('binop', 'unaryop', 'compare', 'call')
+
+# dtype kinds of the arrays that are fused
+FUSED_KINDS = 'biufc'
+
+# returned when a kernel can not be run block by block
+NOT_FUSED = object()
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def _is_ufunc(value):
+    """whether value is a numpy ufunc with one output"""
+    numpy = sys.modules.get('numpy')
+    return (numpy is not None and isinstance(value, numpy.ufunc) and
+            value.nout == 1)
+
+
+def _reduction(value):
+    """name of the numpy reduction value, or None"""
+    numpy = sys.modules.get('numpy')
+    if numpy is not None:
+        for name in FUSED_REDUCTIONS:
+            if getattr(numpy, name, None) is value:
+                return name
+    return None
+
+
+def _is_plain_call(node):
+    """whether node calls a name with positional arguments only"""
+    return (type(node) is ast.Call and isinstance(node.func, ast.Name) and
+            not node.keywords and
+            getattr(node, 'starargs', None) is None and
+            getattr(node, 'kwargs', None) is None and
+            not any(arg.__class__.__name__ == 'Starred'
+                    for arg in node.args))
+
+
+def thread_pool(threads):
+    """return the pool of worker threads shared by the kernels run on
+    that many threads (in this process)"""
+    key = (os.getpid(), threads)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            from multiprocessing.pool import ThreadPool
+            pool = _pools[key] = ThreadPool(threads)
+    return pool
+
+
+class Kernel(object):
+    """elementwise operations of an expression, in the order they run
+
+    :param node: root node of the expression
+    :param symtable: symbols used to recognize the called ufuncs
+
+    `leaves` are the nodes whose values are passed to run(), `funcs`
+    the Name nodes of the called functions, and `nodes` the names of
+    the node types of the operations.  Each elementwise operation of
+    `code` is a tuple (plain function or None for calls, ufunc name or
+    index in `funcs`, limit of its second operand or None, references),
+    where a reference is the index of an earlier operation, or ~index
+    of a leaf.  `reduction` is None, or (index in `funcs`, name) of the
+    reduction applied to the result of `code`, or to the only leaf.
+    """
+
+    def __init__(self, node, symtable):
+        self.symtable = symtable
+        self.leaves = []
+        self.funcs = []
+        self.nodes = []
+        self.code = []
+        self.reduction = None
+        if _is_plain_call(node) and len(node.args) == 1:
+            name = _reduction(symtable.get(node.func.id, None))
+            if name is not None:
+                self.funcs.append(node.func)
+                self.reduction = (len(self.funcs) - 1, name)
+                node = node.args[0]
+        self.add(node)
+        if self.reduction is not None:
+            self.nodes.append('call')
+        self.symtable = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def operation(self, node):
+        """(plain function, ufunc name, limit, operands) of an
+        elementwise operation, or None"""
+        ntype = type(node)
+        if ntype is ast.BinOp or ntype is ast.UnaryOp:
+            optype = type(node.op)
+            if optype in FUSED_OPERATORS:
+                operands = ([node.left, node.right] if ntype is ast.BinOp
+                            else [node.operand])
+                return (OPERATORS[optype], FUSED_OPERATORS[optype],
+                        FUSED_LIMITS.get(optype), operands)
+        elif ntype is ast.Compare:
+            if len(node.ops) == 1 and type(node.ops[0]) in FUSED_OPERATORS:
+                optype = type(node.ops[0])
+                return (OPERATORS[optype], FUSED_OPERATORS[optype], None,
+                        [node.left, node.comparators[0]])
+        elif _is_plain_call(node):
+            func = self.symtable.get(node.func.id, None)
+            if _is_ufunc(func) and func.nin == len(node.args):
+                self.funcs.append(node.func)
+                return None, len(self.funcs) - 1, None, node.args
+        return None
+
+    def add(self, node):
+        """add the operations of node, returning its reference"""
+        operation = self.operation(node)
+        if operation is None:
+            self.leaves.append(node)
+            return ~(len(self.leaves) - 1)
+        plain, ufunc, limit, operands = operation
+        refs = [self.add(operand) for operand in operands]
+        self.code.append((plain, ufunc, limit, refs))
+        self.nodes.append(node.__class__.__name__.lower())
+        return len(self.code) - 1
+
+    def array_steps(self, values, out):
+        """steps for the array results of the operations, but the last
+        one, as counted by Interpreter.run() with a step budget"""
+        if is_ndarray(out):
+            size = out.size
+        else:
+            size = max([value.size for value in values
+                        if is_ndarray(value)] or [0])
+        nops = len(self.code) - (self.reduction is None)
+        return nops * (size // ARRAY_STEP_SIZE)
+
+    def run(self, values, funcs, block_size=FUSE_BLOCK_SIZE,
+            min_size=FUSE_MIN_SIZE, threads=1,
+            thread_min_size=THREAD_MIN_SIZE):
+        """return the value of the expression, from the values of the
+        leaves and of the called functions"""
+        out = NOT_FUSED
+        if len(values) > 0 and sys.modules.get('numpy') is not None:
+            out = self.run_blocks(values, funcs, block_size, min_size,
+                                  threads, thread_min_size)
+        if out is NOT_FUSED:
+            out = self.run_plain(values, funcs)
+        return out
+
+    def run_plain(self, values, funcs):
+        """apply the operations one after the other"""
+        results = []
+        for plain, ufunc, limit, refs in self.code:
+            args = [results[ref] if ref >= 0 else values[~ref]
+                    for ref in refs]
+            if plain is None:
+                results.append(funcs[ufunc](*args))
+            else:
+                results.append(plain(*args))
+        out = results[-1] if results else values[0]
+        if self.reduction is not None:
+            out = funcs[self.reduction[0]](out)
+        return out
+
+    def run_blocks(self, values, funcs, block_size, min_size, threads,
+                   thread_min_size):
+        """apply the operations block by block, on threads chunks of
+        the arrays if they are large enough, or return NOT_FUSED"""
+        numpy = sys.modules['numpy']
+        shape = None
+        size = 0
+        flat = []
+        for value in values:
+            if isinstance(value, numpy.ndarray):
+                if (value.dtype.kind not in FUSED_KINDS or
+                        not value.flags.c_contiguous or
+                        (shape is not None and value.shape != shape)):
+                    return NOT_FUSED
+                shape, size = value.shape, value.size
+                value = value.reshape(-1)
+            elif not isinstance(value, Number):
+                return NOT_FUSED
+            flat.append(value)
+        if threads < 2 or size < thread_min_size:
+            threads = 1
+        if shape is None or size == 0 or (threads == 1 and size < min_size):
+            return NOT_FUSED
+        if self.reduction is not None:
+            index, name = self.reduction
+            if funcs[index] is not getattr(numpy, name):
+                return NOT_FUSED
+
+        # operations on numbers only are run once, here
+        ufuncs, consts, is_array = [], {}, []
+        for index, (plain, ufunc, limit, refs) in enumerate(self.code):
+            if plain is None:
+                ufunc = funcs[ufunc]
+                if not _is_ufunc(ufunc) or ufunc.nin != len(refs):
+                    return NOT_FUSED
+            else:
+                ufunc = getattr(numpy, ufunc)
+            arrays = [is_array[ref] if ref >= 0 else
+                      isinstance(flat[~ref], numpy.ndarray) for ref in refs]
+            if not any(arrays):
+                args = [consts[ref] if ref >= 0 else flat[~ref]
+                        for ref in refs]
+                consts[index] = ufunc(*args) if plain is None else plain(*args)
+            elif limit is not None:
+                ref = refs[1]
+                arg = consts.get(ref) if ref >= 0 else flat[~ref]
+                if (arrays[1] or not isinstance(arg, Number) or
+                        numpy.iscomplexobj(arg) or arg > limit):
+                    return NOT_FUSED
+            ufuncs.append(ufunc)
+            is_array.append(any(arrays))
+
+        code = self.code
+        last = len(code) - 1
+
+        def block(start, stop, scratch, out):
+            """value of the elements start to stop, computed into the
+            scratch buffers (or new arrays), and out if given"""
+            if not code:
+                return flat[0][start:stop]
+            nblock = stop - start
+            results = []
+            for index, (plain, ufunc, limit, refs) in enumerate(code):
+                if not is_array[index]:
+                    results.append(consts[index])
+                    continue
+                args = []
+                for ref in refs:
+                    if ref >= 0:
+                        args.append(results[ref])
+                    else:
+                        arg = flat[~ref]
+                        if isinstance(arg, numpy.ndarray):
+                            arg = arg[start:stop]
+                        args.append(arg)
+                if index == last and out is not None:
+                    results.append(ufuncs[index](*args, out=out))
+                elif scratch is None:
+                    results.append(ufuncs[index](*args))
+                else:
+                    results.append(ufuncs[index](
+                        *args, out=scratch[index][:nblock]))
+            return results
+
+        # the first element gives the dtype of the result
+        dtype = block(0, 1, None, None)
+        dtype = (dtype[last] if code else dtype).dtype
+        out = reduce = None
+        if self.reduction is None:
+            out = numpy.empty(size, dtype=dtype)
+        elif self.reduction[1] == 'mean':
+            accum = (numpy.float64 if dtype.kind in 'biu' else
+                     numpy.float32 if dtype == numpy.float16 else None)
+            reduce = lambda value: numpy.sum(value, dtype=accum)
+        else:
+            reduce = getattr(numpy, FUSED_REDUCTIONS[self.reduction[1]])
+
+        def chunk(bounds):
+            """run the blocks of the elements start to stop, returning
+            the partial reductions"""
+            start, stop = bounds
+            step = block_size if code else stop - start
+            scratch, partials = None, []
+            for first in range(start, stop, step):
+                end = min(first + step, stop)
+                results = block(first, end, scratch,
+                                None if out is None else out[first:end])
+                if code:
+                    if scratch is None:
+                        scratch = results
+                    results = results[last]
+                if reduce is not None:
+                    partials.append(reduce(results))
+            return partials
+
+        if threads > 1:
+            nblocks = -(-size // block_size)
+            step = -(-nblocks // threads) * block_size
+            bounds = [(start, min(start + step, size))
+                      for start in range(0, size, step)]
+            parts = thread_pool(threads).map(chunk, bounds)
+        else:
+            parts = [chunk((0, size))]
+        if reduce is None:
+            return out.reshape(shape)
+        partials = [partial for part in parts for partial in part]
+        if self.reduction[1] != 'mean':
+            return reduce(partials)
+        out = numpy.true_divide(numpy.sum(partials, dtype=accum), size)
+        return out if dtype.kind in 'biu' else dtype.type(out)
+
+
+def build_kernel(node, symtable, min_ops=FUSE_MIN_OPS):
+    """return the Kernel of the expression node, or None if it has
+    fewer than min_ops elementwise operations"""
+    kernel = Kernel(node, symtable)
+    if len(kernel) < min_ops:
+        return None
+    return kernel
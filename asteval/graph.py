@@ -0,0 +1,244 @@
+"""
+incremental evaluation of interdependent named expressions
+
+An ExpressionGraph holds named expressions, each assigning its value to
+a symbol of an Interpreter:
+
+    graph = ExpressionGraph(interp)
+    graph.add('a', 'b*2')
+    graph.add('c', 'sqrt(a) + d')
+    interp.symtable.update({'b': 8, 'd': 1})
+    graph.evaluate()              # evaluates a, then c
+    interp.symtable['d'] = 2
+    graph.evaluate()              # evaluates c only
+
+The names read by each expression (Program.usage.reads) give the
+edges of the graph.  Names that no expression defines are inputs: an
+input counts as changed when its symbol no longer holds the same object
+as at the last evaluation, or when passed to changed().  evaluate()
+runs, in dependency order, only the expressions that are new or depend
+on a changed input or a re-evaluated expression.
+
+Names used inside procedures called by an expression are not seen:
+call changed() for them.
+
+With `cse=True`, the expressions to evaluate are run as one program of
+assignments, in which pure subexpressions shared by several expressions
+are computed once (see optimizer.CommonSubexpressions).
+"""
+from __future__ import division, print_function
+import ast
+from copy import deepcopy
+
+from .astutils import LRUCache
+from .compiler import Program
+from .optimizer import eliminate_common, guards_hold
+
+# marks missing symbols
+MISSING = object()
+
+
+class ExpressionGraph(object):
+    """a set of named expressions, evaluated in dependency order and
+    only when their inputs change
+
+    :param interp: Interpreter holding the symbols (default: a new one)
+    :param cse: whether to eliminate common subexpressions between the
+                expressions evaluated together
+    """
+
+    def __init__(self, interp=None, cse=False):
+        if interp is None:
+            from .asteval import Interpreter
+            interp = Interpreter()
+        self.interp = interp
+        self.exprs = {}        # name -> Program
+        self.reads = {}        # name -> set of names read
+        self.dependents = {}   # name -> set of expression names reading it
+        self._order = None     # name -> position in dependency order
+        self._dirty = set()
+        self._inputs = {}      # input name -> value at last evaluation
+        self.cse = cse
+        self._batches = LRUCache(maxsize=64, maxbytes=None)
+
+    def __len__(self):
+        return len(self.exprs)
+
+    def __contains__(self, name):
+        return name in self.exprs
+
+    def add(self, name, expr):
+        """add (or replace) the expression defining symbol `name`.
+        Raises ValueError if this makes a cycle."""
+        try:
+            program = self.interp.compile(expr)
+        finally:
+            self.interp.error = []
+        reads = set(program.usage.reads)
+        reads.discard(name)
+        old = self.exprs.get(name), self.reads.get(name)
+        old_input = self._inputs.get(name, MISSING)
+        self._unlink(name)
+        self.exprs[name], self.reads[name] = program, reads
+        self._link(name)
+        try:
+            self.order()
+        except ValueError:
+            self._unlink(name)
+            if old[0] is not None:
+                self.exprs[name], self.reads[name] = old
+                self._link(name)
+            elif name in self.dependents:
+                self._inputs[name] = old_input
+            raise
+        self._mark(name)
+
+    def remove(self, name):
+        """remove the expression defining `name`.  Its symbol is kept,
+        and becomes an input of the expressions reading it."""
+        self._unlink(name)
+        self._dirty.discard(name)
+        self._order = None
+        if name in self.dependents:
+            self._inputs[name] = self.interp.symtable.get(name, MISSING)
+
+    def _link(self, name):
+        """add the edges of the expression `name`"""
+        self._inputs.pop(name, None)
+        for read in self.reads[name]:
+            self.dependents.setdefault(read, set()).add(name)
+            if read not in self.exprs:
+                self._inputs.setdefault(read, MISSING)
+        self._order = None
+        self._batches.invalidate()
+
+    def _unlink(self, name):
+        """remove the expression `name` and its edges"""
+        if name not in self.exprs:
+            return
+        for read in self.reads.pop(name):
+            users = self.dependents.get(read)
+            users.discard(name)
+            if not users:
+                del self.dependents[read]
+                self._inputs.pop(read, None)
+        del self.exprs[name]
+        self._order = None
+        self._batches.invalidate()
+
+    def order(self):
+        """names of the expressions in dependency order.
+        Raises ValueError if the expressions make a cycle."""
+        if self._order is None:
+            exprs = self.exprs
+            nreads = dict((name, sum(1 for read in self.reads[name]
+                                     if read in exprs))
+                          for name in exprs)
+            ready = sorted(name for name, count in nreads.items()
+                           if count == 0)
+            out = []
+            while ready:
+                name = ready.pop()
+                out.append(name)
+                for dep in self.dependents.get(name, ()):
+                    nreads[dep] -= 1
+                    if nreads[dep] == 0:
+                        ready.append(dep)
+            if len(out) < len(exprs):
+                cycle = sorted(name for name, count in nreads.items()
+                               if count > 0)
+                raise ValueError("cycle in expressions: %s"
+                                 % ', '.join(cycle))
+            self._order = dict((name, i) for i, name in enumerate(out))
+        return sorted(self._order, key=self._order.get)
+
+    def changed(self, *names):
+        """mark symbols as changed, so that the expressions depending on
+        them, and the expressions of these names, are evaluated again"""
+        for name in names:
+            self._mark(name)
+
+    def _mark(self, name):
+        """mark the expressions depending on `name` (and `name` itself,
+        if it is an expression) for evaluation"""
+        todo = [name]
+        dirty = self._dirty
+        while todo:
+            name = todo.pop()
+            if name in self.exprs:
+                if name in dirty:
+                    continue
+                dirty.add(name)
+            todo.extend(self.dependents.get(name, ()))
+
+    def evaluate(self):
+        """evaluate the expressions that are new or depend on changed
+        symbols, returning their names in the order evaluated.  If an
+        expression fails, its error is raised, and it and the remaining
+        expressions are evaluated again by the next call."""
+        symtable = self.interp.symtable
+        for name, value in self._inputs.items():
+            current = symtable.get(name, MISSING)
+            if current is not value:
+                self._inputs[name] = current
+                self._mark(name)
+        if not self._dirty:
+            return []
+        if self._order is None:
+            self.order()
+        todo = sorted(self._dirty, key=self._order.get)
+        if self.cse and len(todo) > 1:
+            program = self._batch(todo)
+            if program is not None:
+                # noinspection PyBroadException
+                try:
+                    self.interp.eval(program, show_errors=False)
+                except Exception:
+                    # evaluate one by one, to stop at the failing one
+                    pass
+                else:
+                    self._dirty.difference_update(todo)
+                    return todo
+        for name in todo:
+            symtable[name] = self.interp.eval(self.exprs[name],
+                                              show_errors=False)
+            self._dirty.discard(name)
+        return todo
+
+    def _batch(self, names):
+        """Program assigning the expressions `names` in turn, with common
+        subexpressions eliminated, or None if one is not an expression"""
+        key = tuple(names)
+        program = self._batches.get(key)
+        if program is not None and guards_hold(program.guards,
+                                               self.interp.symtable):
+            return program
+        body = []
+        for name in names:
+            tree = self.exprs[name].tree
+            if (not isinstance(tree, ast.Module) or len(tree.body) != 1 or
+                    not isinstance(tree.body[0], ast.Expr)):
+                return None
+            stmt = tree.body[0]
+            target = ast.Name(id=name, ctx=ast.Store())
+            body.append(ast.copy_location(
+                ast.Assign(targets=[target], value=deepcopy(stmt.value)),
+                stmt))
+        tree, guards = eliminate_common(ast.Module(body=body),
+                                        self.interp.symtable)
+        program = Program(None, tree, None)
+        if self.interp.use_compiler or self.interp.trusted_compile:
+            program = self.interp.compile(program)
+            if program.guards:
+                guards.update(program.guards)
+        program.guards = guards
+        self._batches.put(key, program)
+        return program
+
+    def __getitem__(self, name):
+        """current value of the expression `name`, evaluating first if
+        needed"""
+        if name not in self.exprs:
+            raise KeyError(name)
+        self.evaluate()
+        return self.interp.symtable[name]
@@ -0,0 +1,547 @@
+"""
+constant folding and dead-branch elimination for asteval
+
+optimize() rewrites a copy of a parsed Module before it is run:
+
+  * operators, comparisons and boolean operators on constants are
+    evaluated once, with the same functions (and safe_* guards) as
+    Interpreter.run().  Operations that fail, such as 2**100000, are
+    left for run() to report.
+  * calls of the pure functions in FOLD_FUNCS (from FROM_MATH) with
+    constant arguments, and the constants in FOLD_NAMES (pi, e), are
+    evaluated at module level, but not inside function definitions or
+    for names that the code assigns.
+  * if statements, if expressions and while loops with a constant test
+    keep only the branch that can run.
+
+Folding names relies on the symtable values at the time of folding.
+These are returned as `guards`: the optimized tree is only valid while
+each guarded name still holds the same object (see guards_hold()).
+
+eliminate_common() then computes pure subexpressions that are repeated
+in the module-level statements only once, see CommonSubexpressions.
+"""
+from __future__ import division, print_function
+import ast
+import math
+import sys
+from copy import deepcopy
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+from .astutils import FROM_MATH, op2func, symbol_usage
+
+# math functions that are cheap and pure for any constant arguments
+FOLD_FUNCS = tuple(name for name in FROM_MATH
+                   if name not in ('e', 'pi', 'factorial', 'fsum'))
+FOLD_NAMES = ('e', 'pi')
+
+# largest constants made by folding
+FOLD_MAX_BITS = 1024
+FOLD_MAX_STRLEN = 256
+
+# types of the values folded into Num nodes: not numpy scalars
+NUMBER_TYPES = (int, float, complex)
+
+# functions known to be pure, besides numpy ufuncs (recognized by type)
+CSE_FUNCS = FOLD_FUNCS + ('abs', 'max', 'min', 'round', 'real', 'imag',
+                          'conj', 'sum', 'prod', 'mean', 'dot', 'where',
+                          'clip')
+# pure functions that may return one of their arguments, or a view of it
+CSE_PASSING = ('max', 'min', 'real', 'imag')
+# cost of a subexpression worth a temporary: an operator counts 1, a call
+CSE_CALL_COST = 3
+CSE_MIN_COST = 2
+CSE_MAX_ROUNDS = 50
+CSE_PREFIX = '_cse_'
+
+# expressions that are evaluated in a scope of their own, or can assign
+# names (comprehension variables)
+CSE_SCOPED = tuple(getattr(ast, name) for name in
+                   ('ListComp', 'SetComp', 'DictComp', 'GeneratorExp',
+                    'Lambda') if hasattr(ast, name))
+
+HAS_NAMECONSTANT = hasattr(ast, 'NameConstant')
+
+# marks values that can not be folded
+NOT_CONSTANT = object()
+
+
+def guards_hold(guards, symtable):
+    """return whether the symbols assumed by folding are unchanged"""
+    if guards:
+        for name, value in guards.items():
+            if symtable.get(name, NOT_CONSTANT) is not value:
+                return False
+    return True
+
+
+def _is_builtin(name, value):
+    """whether value is the function `name` of math or numpy"""
+    if value is getattr(math, name, None):
+        return True
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and value is getattr(numpy, name, None)
+
+
+def _is_pure(name, value):
+    """whether value is the pure function `name` of math, numpy or the
+    builtins"""
+    if name in CSE_FUNCS:
+        if _is_builtin(name, value) or value is getattr(builtins, name, None):
+            return True
+    numpy = sys.modules.get('numpy')
+    return (numpy is not None and isinstance(value, numpy.ufunc) and
+            value is getattr(numpy, name, None))
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """fold constant expressions and drop dead branches
+
+    :param symtable: symbols used to fold FOLD_NAMES and FOLD_FUNCS
+    :param assigned: names that must not be folded
+    """
+
+    def __init__(self, symtable, assigned=()):
+        self.symtable = symtable
+        self.assigned = set(assigned)
+        self.guards = {}
+        self.in_function = 0
+
+    def value(self, node):
+        """value of a constant node, or NOT_CONSTANT"""
+        if isinstance(node, ast.Num):
+            return node.n
+        elif isinstance(node, ast.Str):
+            return node.s
+        elif HAS_NAMECONSTANT and isinstance(node, ast.NameConstant):
+            return node.value
+        return NOT_CONSTANT
+
+    def constant(self, value, node):
+        """constant node for value, or node if value can not be folded"""
+        vtype = type(value)
+        if value is None or vtype is bool:
+            if not HAS_NAMECONSTANT:
+                return node
+            new = ast.NameConstant(value=value)
+        elif vtype in NUMBER_TYPES:
+            if vtype is int and value.bit_length() > FOLD_MAX_BITS:
+                return node
+            new = ast.Num(n=value)
+        elif vtype is str and len(value) <= FOLD_MAX_STRLEN:
+            new = ast.Str(s=value)
+        else:
+            return node
+        return ast.copy_location(new, node)
+
+    def symbol(self, name):
+        """value of a foldable symbol, recorded in guards"""
+        if self.in_function or name in self.assigned:
+            return NOT_CONSTANT
+        value = self.symtable.get(name, NOT_CONSTANT)
+        if value is not NOT_CONSTANT:
+            self.guards[name] = value
+        return value
+
+    def visit_FunctionDef(self, node):
+        self.in_function += 1
+        try:
+            return self.generic_visit(node)
+        finally:
+            self.in_function -= 1
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in FOLD_NAMES:
+            value = self.symbol(node.id)
+            if isinstance(value, float):
+                return self.constant(value, node)
+        return node
+
+    def fold(self, func, args, node):
+        """call func(*args), returning a constant node, or node if that
+        fails"""
+        # noinspection PyBroadException
+        try:
+            return self.constant(func(*args), node)
+        except Exception:
+            return node
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        left, right = self.value(node.left), self.value(node.right)
+        if left is NOT_CONSTANT or right is NOT_CONSTANT:
+            return node
+        return self.fold(op2func(node.op), (left, right), node)
+
+    def visit_UnaryOp(self, node):
+        node = self.generic_visit(node)
+        operand = self.value(node.operand)
+        if operand is NOT_CONSTANT:
+            return node
+        return self.fold(op2func(node.op), (operand, ), node)
+
+    def visit_Compare(self, node):
+        node = self.generic_visit(node)
+        values = [self.value(node.left)]
+        values.extend(self.value(comp) for comp in node.comparators)
+        if NOT_CONSTANT in values:
+            return node
+
+        def compare(*values):
+            out = True
+            for op, lval, rval in zip(node.ops, values[:-1], values[1:]):
+                out = op2func(op)(lval, rval)
+                if not out:
+                    break
+            return out
+        return self.fold(compare, values, node)
+
+    def visit_BoolOp(self, node):
+        node = self.generic_visit(node)
+        is_and = isinstance(node.op, ast.And)
+        # constants that decide the result, or can be dropped
+        values = []
+        for val in node.values:
+            const = self.value(val)
+            if const is NOT_CONSTANT:
+                values.append(val)
+            elif bool(const) != is_and or val is node.values[-1]:
+                values.append(val)
+                break
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+    def visit_Call(self, node):
+        node = self.generic_visit(node)
+        func = node.func
+        if (not isinstance(func, ast.Name) or func.id not in FOLD_FUNCS or
+                node.keywords or getattr(node, 'starargs', None) or
+                getattr(node, 'kwargs', None)):
+            return node
+        args = [self.value(arg) for arg in node.args]
+        if NOT_CONSTANT in args:
+            return node
+        value = self.symbol(func.id)
+        if not _is_builtin(func.id, value):
+            return node
+        return self.fold(value, args, node)
+
+    def block(self, body, node):
+        """statements replacing a compound statement: end with a pass
+        statement, so that the value of a module is not changed"""
+        if not body or isinstance(body[-1], ast.Expr):
+            body = body + [ast.copy_location(ast.Pass(), node)]
+        return body
+
+    def visit_IfExp(self, node):
+        node = self.generic_visit(node)
+        test = self.value(node.test)
+        if test is NOT_CONSTANT:
+            return node
+        return node.body if test else node.orelse
+
+    def visit_If(self, node):
+        node = self.generic_visit(node)
+        test = self.value(node.test)
+        if test is NOT_CONSTANT:
+            return node
+        return self.block(node.body if test else node.orelse, node)
+
+    def visit_While(self, node):
+        node = self.generic_visit(node)
+        test = self.value(node.test)
+        if test is NOT_CONSTANT or test:
+            return node
+        return self.block(node.orelse, node)
+
+
+def optimize(tree, symtable, cse=False):
+    """return an optimized copy of a parsed Module, and the guards:
+    a dictionary of the symbols whose values were folded into it, or
+    that it relies on being pure functions.  With cse=True, common
+    subexpressions are also eliminated."""
+    folder = ConstantFolder(symtable, assigned=symbol_usage(tree).writes)
+    out = folder.visit(deepcopy(tree))
+    if cse and isinstance(out, ast.Module):
+        CommonSubexpressions(symtable, guards=folder.guards).visit(out)
+    return ast.fix_missing_locations(out), folder.guards
+
+
+class CommonSubexpressions(object):
+    """common-subexpression elimination in the module-level statements
+    of a parsed Module
+
+    :param symtable: symbols used to recognize pure functions
+    :param guards: dictionary of the symbols relied on, updated
+    :param min_cost: smallest cost of a subexpression to eliminate
+
+    Pure subexpressions are made of names, constants, operators,
+    comparisons and calls of the functions in CSE_FUNCS or numpy ufuncs
+    (without keyword arguments).  Within runs of assignments and
+    expression statements free of other calls, a subexpression found
+    again with none of its names assigned in between is computed once,
+    into a temporary assigned before the first statement that always
+    evaluates it.  Only the operands of operators, comparisons and pure
+    calls are shared, as these make new values: an array or list is
+    never bound to two names.  Other statements (compound statements,
+    assignments to items or attributes, augmented assignments, other
+    calls) may change any value, and end the reuse of all temporaries.
+    Code inside function definitions, loops and comprehensions is left
+    as it is.
+
+    Temporaries are deleted after their last use, unless that is the
+    final expression statement, whose value is the value of the module.
+    Their names are listed in the `temporaries` attribute of the Module:
+    the Interpreter deletes those left once the module has run.
+    """
+
+    def __init__(self, symtable, guards=None, min_cost=CSE_MIN_COST):
+        self.symtable = symtable
+        self.guards = {} if guards is None else guards
+        self.min_cost = min_cost
+        self.assigned = set()
+        self.used = set()
+        self.temps = []
+        self.keys = {}
+        self.found = []
+
+    def pure_function(self, name):
+        """whether the symbol `name` is a pure function, recorded in
+        guards"""
+        if name in self.assigned:
+            return False
+        value = self.symtable.get(name, NOT_CONSTANT)
+        if not _is_pure(name, value):
+            return False
+        self.guards[name] = value
+        return True
+
+    def key(self, node):
+        """(key, names read, cost) of a pure expression, or None"""
+        nid = id(node)
+        if nid in self.keys:
+            return self.keys[nid]
+        out, ntype = None, type(node)
+        if ntype is ast.Name:
+            if isinstance(node.ctx, ast.Load):
+                out = (('name', node.id), frozenset((node.id, )), 0)
+        elif ntype is ast.Num:
+            out = (('const', repr(node.n)), frozenset(), 0)
+        elif ntype is ast.Str:
+            out = (('const', repr(node.s)), frozenset(), 0)
+        elif HAS_NAMECONSTANT and ntype is ast.NameConstant:
+            out = (('const', repr(node.value)), frozenset(), 0)
+        elif ntype is ast.BinOp:
+            out = self.combine(('binop', type(node.op).__name__),
+                               (node.left, node.right), 1)
+        elif ntype is ast.UnaryOp:
+            out = self.combine(('unaryop', type(node.op).__name__),
+                               (node.operand, ), 1)
+        elif ntype is ast.Compare:
+            out = self.combine(('compare', ) + tuple(type(op).__name__
+                                                     for op in node.ops),
+                               [node.left] + node.comparators, 1)
+        elif (ntype is ast.Call and isinstance(node.func, ast.Name) and
+              not node.keywords and not getattr(node, 'starargs', None) and
+              not getattr(node, 'kwargs', None) and
+              self.pure_function(node.func.id)):
+            out = self.combine(('call', node.func.id),
+                               [node.func] + node.args, CSE_CALL_COST)
+        self.keys[nid] = out
+        return out
+
+    def combine(self, head, children, cost):
+        """key of an expression from the keys of its children"""
+        keys, names = [head], set()
+        for child in children:
+            info = self.key(child)
+            if info is None:
+                return None
+            keys.append(info[0])
+            names.update(info[1])
+            cost += info[2]
+        return tuple(keys), frozenset(names), cost
+
+    def has_effects(self, node):
+        """whether evaluating node may change values: calls of functions
+        that are not pure, comprehensions that assign their variables"""
+        for child in ast.walk(node):
+            if isinstance(child, CSE_SCOPED):
+                return True
+            if isinstance(child, ast.Call) and self.key(child) is None:
+                return True
+        return False
+
+    def collect(self, node, parent, field, pos, conditional):
+        """record the subexpressions of node worth eliminating, with
+        where they are found and whether they are always evaluated"""
+        if isinstance(node, CSE_SCOPED):
+            return
+        info = self.key(node)
+        if (info is not None and info[2] >= self.min_cost and
+                self.consumes(parent, field)):
+            self.found.append((node, parent, field, pos, conditional))
+        ntype = type(node)
+        if ntype is ast.IfExp:
+            self.collect(node.test, node, 'test', None, conditional)
+            self.collect(node.body, node, 'body', None, True)
+            self.collect(node.orelse, node, 'orelse', None, True)
+        elif ntype is ast.BoolOp or ntype is ast.Compare:
+            # only the first operands are always evaluated
+            first = 1 if ntype is ast.BoolOp else 2
+            children = [('values', i, child)
+                        for i, child in enumerate(node.values)] \
+                if ntype is ast.BoolOp else \
+                [('left', None, node.left)] + [
+                    ('comparators', i, child)
+                    for i, child in enumerate(node.comparators)]
+            for i, (fname, fpos, child) in enumerate(children):
+                self.collect(child, node, fname, fpos,
+                             conditional or i >= first)
+        else:
+            for fname, value in ast.iter_fields(node):
+                if isinstance(value, list):
+                    for i, child in enumerate(value):
+                        if isinstance(child, ast.expr):
+                            self.collect(child, node, fname, i, conditional)
+                elif isinstance(value, ast.expr):
+                    self.collect(value, node, fname, None, conditional)
+
+    def consumes(self, parent, field):
+        """whether the value of a child of parent is only used to make a
+        new value, and can be shared without aliasing"""
+        ptype = type(parent)
+        if ptype is ast.BinOp or ptype is ast.UnaryOp or ptype is ast.Compare:
+            return True
+        if ptype is ast.IfExp:
+            return field == 'test'
+        return (ptype is ast.Call and field == 'args' and
+                self.key(parent) is not None and
+                parent.func.id not in CSE_PASSING)
+
+    def written(self, stmt):
+        """names assigned by a statement, or None if it may change any
+        value"""
+        if type(stmt) is ast.Expr:
+            return ()
+        if type(stmt) is not ast.Assign:
+            return None
+        names, todo = [], list(stmt.targets)
+        while todo:
+            target = todo.pop()
+            if isinstance(target, ast.Name):
+                names.append(target.id)
+            elif isinstance(target, (ast.Tuple, ast.List)):
+                todo.extend(target.elts)
+            elif getattr(ast, 'Starred', None) and isinstance(target,
+                                                              ast.Starred):
+                todo.append(target.value)
+            else:
+                return None
+        return names
+
+    def eliminate(self, body):
+        """eliminate common subexpressions in a list of statements once,
+        returning whether any were found"""
+        self.keys = {}
+        groups = {}
+        versions, epoch = {}, 0
+        for index, stmt in enumerate(body):
+            written = self.written(stmt)
+            if written is None or self.has_effects(stmt.value):
+                epoch += 1
+                continue
+            self.found = []
+            self.collect(stmt.value, stmt, 'value', None, False)
+            for node, parent, field, pos, conditional in self.found:
+                key, names, cost = self.keys[id(node)]
+                version = tuple(sorted((name, versions.get(name, 0))
+                                       for name in names))
+                groups.setdefault((key, epoch, version), []).append(
+                    (cost, index, conditional, node, parent, field, pos))
+            for name in written:
+                versions[name] = versions.get(name, 0) + 1
+
+        # largest subexpressions first: those found inside them go away
+        chosen = sorted((places for places in groups.values()
+                         if len(places) > 1),
+                        key=lambda places: (-places[0][0], places[0][1]))
+        removed, inserts = set(), []
+        for places in chosen:
+            places = [place for place in places if id(place[3]) not in removed]
+            first = [place for place in places if not place[2]]
+            if not first:
+                continue
+            start = first[0][1]
+            places = [place for place in places if place[1] >= start]
+            if len(places) < 2:
+                continue
+            name = self.temporary()
+            node = first[0][3]
+            inserts.append((start, ast.copy_location(
+                ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())],
+                           value=node), body[start])))
+            for cost, index, conditional, old, parent, field, pos in places:
+                removed.update(id(child) for child in ast.walk(old))
+                new = ast.copy_location(ast.Name(id=name, ctx=ast.Load()),
+                                        old)
+                if pos is None:
+                    setattr(parent, field, new)
+                else:
+                    getattr(parent, field)[pos] = new
+        for start, assign in sorted(inserts, key=lambda item: -item[0]):
+            body.insert(start, assign)
+        return len(inserts) > 0
+
+    def temporary(self):
+        """name of a new temporary"""
+        name = '%s%d' % (CSE_PREFIX, len(self.temps))
+        while name in self.used:
+            name = '_' + name
+        self.temps.append(name)
+        return name
+
+    def visit(self, tree):
+        """eliminate common subexpressions in a Module, in place"""
+        usage = symbol_usage(tree)
+        self.assigned = usage.writes
+        self.used = usage.writes | usage.reads
+        for _ in range(CSE_MAX_ROUNDS):
+            if not self.eliminate(tree.body):
+                break
+        if self.temps:
+            self.delete_temporaries(tree.body)
+            tree.temporaries = list(self.temps)
+        return tree
+
+    def delete_temporaries(self, body):
+        """delete each temporary after the statement last using it"""
+        temps, last = set(self.temps), {}
+        for index, stmt in enumerate(body):
+            for node in ast.walk(stmt):
+                if isinstance(node, ast.Name) and node.id in temps:
+                    last[node.id] = index
+        ends = {}
+        for name, index in last.items():
+            if index < len(body) - 1 or not isinstance(body[index], ast.Expr):
+                ends.setdefault(index, []).append(name)
+        for index in sorted(ends, reverse=True):
+            targets = [ast.Name(id=name, ctx=ast.Del())
+                       for name in sorted(ends[index])]
+            body.insert(index + 1, ast.copy_location(
+                ast.Delete(targets=targets), body[index]))
+
+
+def eliminate_common(tree, symtable, guards=None):
+    """return a copy of a parsed Module with common subexpressions
+    eliminated, and the guards: a dictionary of the pure functions it
+    relies on.  See CommonSubexpressions."""
+    cse = CommonSubexpressions(symtable, guards=guards)
+    out = cse.visit(deepcopy(tree))
+    return ast.fix_missing_locations(out), cse.guards
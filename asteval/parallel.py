@@ -0,0 +1,178 @@
+"""
+parallel evaluation of many expressions in worker processes
+
+Interpreter.run() is pure Python, and so runs on one core at a time.
+eval_many() spreads a list of expressions over a pool of worker
+processes, each holding one Interpreter for its lifetime:
+
+    results, errors = eval_many(['a*x + b', 'sqrt(x)', ...],
+                                symbols={'a': 1, 'b': 2, 'x': 3},
+                                workers=4)
+
+The expressions are parsed in the calling process, so that syntax
+errors are found without a round trip, and sent as pickled Programs
+(source and AST) in chunks.  Results come back in input order, with
+an EvalError in place of the result of each expression that failed.
+To keep the worker processes between calls, use a ParallelEvaluator.
+"""
+from __future__ import division, print_function
+import pickle
+from multiprocessing import Pool, cpu_count
+
+from .asteval import Interpreter
+from .astutils import EvalError, ExceptionHolder
+from .compiler import Program
+
+# Interpreter of a worker process, created by _init_worker()
+_WORKER = {}
+
+
+def _init_worker(kws, symbols):
+    """create the Interpreter of a worker process"""
+    interp = Interpreter(**kws)
+    interp.symtable.update(symbols)
+    _WORKER['interp'] = interp
+    _WORKER['symbols'] = symbols
+
+
+def _eval_chunk(chunk):
+    """evaluate a chunk of (index, program, symbols) in a worker,
+    returning (index, pickled result, EvalError or None) for each"""
+    interp, shared = _WORKER['interp'], _WORKER['symbols']
+    out = []
+    for index, program, symbols in chunk:
+        if symbols:
+            interp.symtable.update(symbols)
+        result, error = None, None
+        value = _run(interp, program)
+        if interp.error:
+            error = EvalError.from_interpreter(index, interp, program.source)
+        else:
+            try:
+                result = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                error = EvalError(index, 'TypeError',
+                                  'result can not be pickled: %r' % (value, ),
+                                  expr=program.source)
+        out.append((index, result, error))
+        # so that no expression sees the symbols set by another
+        interp.reset()
+        interp.symtable.update(shared)
+    return out
+
+
+def _run(interp, program):
+    """evaluate a program, leaving any error in interp.error"""
+    # noinspection PyBroadException
+    try:
+        return interp.eval(program, show_errors=False)
+    except Exception:
+        if not interp.error:
+            interp.error.append(ExceptionHolder(None, expr=program.source))
+
+
+class ParallelEvaluator(object):
+    """a pool of worker processes, each holding an Interpreter
+
+    :param workers: number of worker processes (default: number of CPUs)
+    :param symbols: dictionary of symbols given to every expression
+    :param chunksize: default number of expressions sent to a worker at
+                      a time (default: split the input into about four
+                      chunks per worker)
+
+    Other keyword arguments are passed to Interpreter in each worker.
+    Symbols and results must be picklable.
+    """
+
+    def __init__(self, workers=None, symbols=None, chunksize=None, **kws):
+        if workers is None:
+            workers = cpu_count()
+        self.workers = max(1, workers)
+        self.chunksize = chunksize
+        self.symbols = symbols or {}
+        self.kws = kws
+        self.parser = Interpreter(use_numpy=False)
+        self.pool = Pool(self.workers, _init_worker, (kws, self.symbols))
+
+    def close(self):
+        """stop the worker processes"""
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def eval_many(self, exprs, symbols=None, chunksize=None):
+        """evaluate a sequence of expressions (text or Programs)
+
+        symbols is either a dictionary of symbols for all of the
+        expressions, or a sequence of dictionaries, one per expression.
+        These are added to the symbols of the evaluator for each
+        expression.
+
+        Returns (results, errors): two lists in input order, where
+        errors[i] is None for expressions that succeeded, and an
+        EvalError (with results[i] None) for those that failed.
+        """
+        exprs = list(exprs)
+        nexprs = len(exprs)
+        results, errors = [None]*nexprs, [None]*nexprs
+        if symbols is None or isinstance(symbols, dict):
+            symbols = [symbols]*nexprs
+        elif len(symbols) != nexprs:
+            raise ValueError("need one symbols dictionary per expression")
+
+        tasks = []
+        for index, expr in enumerate(exprs):
+            if not isinstance(expr, Program):
+                self.parser.error = []
+                # noinspection PyBroadException
+                try:
+                    expr = Program(expr, self.parser.parse(expr), None)
+                except Exception:
+                    errors[index] = EvalError.from_interpreter(
+                        index, self.parser, expr)
+                    continue
+            tasks.append((index, expr, symbols[index]))
+        if not tasks:
+            return results, errors
+
+        if chunksize is None:
+            chunksize = self.chunksize
+        if chunksize is None:
+            chunksize = max(1, -(-len(tasks) // (4*self.workers)))
+        chunks = [tasks[i:i+chunksize]
+                  for i in range(0, len(tasks), chunksize)]
+        for chunk in self.pool.imap(_eval_chunk, chunks):
+            for index, result, error in chunk:
+                if error is not None:
+                    errors[index] = error
+                else:
+                    results[index] = pickle.loads(result)
+        return results, errors
+
+
+def eval_many(exprs, symbols=None, workers=None, chunksize=None, **kws):
+    """evaluate many expressions with a temporary ParallelEvaluator
+
+    :param exprs: sequence of expressions (text or Programs)
+    :param symbols: dictionary of symbols for all expressions, or a
+                    sequence of dictionaries, one per expression
+    :param workers: number of worker processes (default: number of CPUs)
+    :param chunksize: number of expressions sent to a worker at a time
+
+    Other keyword arguments are passed to Interpreter.  Returns
+    (results, errors) as ParallelEvaluator.eval_many().
+    """
+    shared = None
+    if isinstance(symbols, dict):
+        shared, symbols = symbols, None
+    evaluator = ParallelEvaluator(workers=workers, symbols=shared,
+                                  chunksize=chunksize, **kws)
+    try:
+        return evaluator.eval_many(exprs, symbols=symbols)
+    finally:
+        evaluator.close()
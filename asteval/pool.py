@@ -0,0 +1,140 @@
+"""
+a thread-safe pool of asteval Interpreters
+
+An Interpreter keeps the state of an evaluation (error, expr, retval,
+frame, ...) on the instance, so it must not be used by two threads at
+once.  An InterpreterPool holds Interpreters created ahead of time:
+each thread checks one out, uses it, and checks it back in, which
+resets it for the next user.
+
+    pool = InterpreterPool(size=8)
+    with pool.interpreter() as interp:
+        interp('x = 4')
+        interp('sqrt(x)')
+
+or, for single expressions:
+
+    pool.eval('sqrt(4)')
+
+Within one thread, pool.interpreter() blocks are nested on the same
+Interpreter, so that a thread sees the symbols it set until its
+outermost block ends.
+"""
+from __future__ import division, print_function
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition, local
+from time import time
+
+from .astutils import LRUCache
+from .asteval import Interpreter
+
+
+class InterpreterPool(object):
+    """a thread-safe pool of Interpreters
+
+    :param size: number of Interpreters created up front
+    :param maxsize: largest number of Interpreters (default ``size``);
+                    more are created on demand, up to this number
+    :param symbols: dictionary of symbols added to each Interpreter,
+                    and restored when it is checked in
+    :param timeout: default time (sec) to wait in checkout() for a
+                    free Interpreter, or None to wait without limit
+
+    Other keyword arguments are passed to Interpreter.  Unless given,
+    the Interpreters share one LRUCache for parsed expressions.
+    """
+
+    def __init__(self, size=4, maxsize=None, symbols=None, timeout=None,
+                 **kws):
+        if 'symtable' in kws:
+            raise TypeError("InterpreterPool does not accept a symtable:"
+                            " use 'symbols'")
+        if maxsize is None:
+            maxsize = size
+        self.maxsize = max(maxsize, size)
+        self.symbols = symbols or {}
+        self.timeout = timeout
+        kws.setdefault('parse_cache', LRUCache())
+        self.kws = kws
+        self.nbusy = 0
+        self._idle = deque()
+        self._count = 0
+        self._cond = Condition()
+        self._local = local()
+        for _ in range(size):
+            self._idle.append(self._create())
+
+    def _create(self):
+        """create and initialize an Interpreter for the pool"""
+        interp = Interpreter(**self.kws)
+        interp.symtable.update(self.symbols)
+        self._count += 1
+        return interp
+
+    def __len__(self):
+        """number of Interpreters created by the pool"""
+        return self._count
+
+    def checkout(self, timeout=None):
+        """take an Interpreter from the pool, creating one if none is
+        free and fewer than maxsize exist, or else waiting up to timeout
+        seconds for one to be checked in.
+
+        Raises RuntimeError if no Interpreter is free in time."""
+        if timeout is None:
+            timeout = self.timeout
+        with self._cond:
+            end = None
+            while not self._idle:
+                if self._count < self.maxsize:
+                    self._idle.append(self._create())
+                    break
+                if timeout is not None:
+                    if end is None:
+                        end = time() + timeout
+                    remaining = end - time()
+                    if remaining <= 0:
+                        raise RuntimeError("no free Interpreter in pool after %gs"
+                                           % timeout)
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+            self.nbusy += 1
+            return self._idle.pop()
+
+    def checkin(self, interp):
+        """reset an Interpreter taken with checkout() and return it to
+        the pool"""
+        interp.reset()
+        interp.symtable.update(self.symbols)
+        with self._cond:
+            self.nbusy -= 1
+            self._idle.append(interp)
+            self._cond.notify()
+
+    @contextmanager
+    def interpreter(self, timeout=None):
+        """context manager giving the current thread an Interpreter,
+        which is checked in at the end of the outermost block."""
+        interp = getattr(self._local, 'interp', None)
+        if interp is not None:
+            self._local.depth += 1
+            try:
+                yield interp
+            finally:
+                self._local.depth -= 1
+            return
+
+        interp = self.checkout(timeout=timeout)
+        self._local.interp, self._local.depth = interp, 0
+        try:
+            yield interp
+        finally:
+            self._local.interp = None
+            self.checkin(interp)
+
+    def eval(self, expr, **kws):
+        """evaluate an expression with an Interpreter from the pool"""
+        with self.interpreter() as interp:
+            return interp.eval(expr, **kws)
@@ -0,0 +1,198 @@
+"""
+profiling of Interpreter.run()
+
+A Profiler wraps the node handlers of an Interpreter while it is
+active, and leaves them untouched otherwise, so that an Interpreter
+that is not being profiled runs at full speed:
+
+    with interp.profile() as prof:
+        interp(script)
+    print(prof.report())
+
+For each node type, source line and called function it records the
+number of calls, the inclusive time (including nested nodes) and the
+exclusive time (excluding them).  For lines, inclusive time is that of
+the statements starting on the line; for functions, exclusive time
+excludes the time of nested function calls.
+
+Compiled programs do not go through run(): while a Profiler is active,
+the Interpreter compiles nothing, and Programs compiled before are run
+without being profiled.  Array expressions are not fused or split
+across threads either, so that each of their nodes is recorded.
+"""
+from __future__ import division, print_function
+import ast
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+COUNT, INCLUSIVE, EXCLUSIVE = 0, 1, 2
+SORT_KEYS = {'count': COUNT, 'inclusive': INCLUSIVE, 'exclusive': EXCLUSIVE}
+
+
+def call_name(node):
+    """dotted name of the function called by a Call node"""
+    parts = []
+    func = node.func
+    while isinstance(func, ast.Attribute):
+        parts.append(func.attr)
+        func = func.value
+    parts.append(func.id if isinstance(func, ast.Name) else '<expr>')
+    return '.'.join(reversed(parts))
+
+
+class Profiler(object):
+    """profile of the nodes run by an Interpreter
+
+    :param interp: Interpreter to profile
+    :param timer: function returning the time in seconds
+                  (default: time.perf_counter)
+
+    Use as a context manager, or call start() and stop().  Statistics
+    accumulate over all evaluations while active, in the dictionaries
+    `nodes`, `lines` and `functions`, mapping keys to lists of
+    [count, inclusive time, exclusive time].
+    """
+
+    def __init__(self, interp, timer=perf_counter):
+        self.interp = interp
+        self.timer = timer
+        self.nodes = {}
+        self.lines = {}
+        self.functions = {}
+        # time spent in nested nodes and nested calls, one entry per level
+        self._children = []
+        self._calls = []
+        self._saved = None
+
+    def clear(self):
+        """discard the statistics"""
+        self.nodes.clear()
+        self.lines.clear()
+        self.functions.clear()
+
+    @property
+    def active(self):
+        """whether the Interpreter is being profiled"""
+        return self._saved is not None
+
+    def start(self):
+        """profile the Interpreter until stop() is called"""
+        if self._saved is not None:
+            return
+        interp = self.interp
+        self._saved = (interp.node_handlers, interp.use_compiler,
+                       interp.trusted_compile, interp.fuse_arrays,
+                       interp.array_threads)
+        interp.node_handlers = dict((name, self._wrap(name, handler))
+                                    for name, handler in
+                                    interp.node_handlers.items())
+        interp.use_compiler = interp.trusted_compile = False
+        interp.fuse_arrays = False
+        interp.array_threads = 1
+
+    def stop(self):
+        """stop profiling, restoring the Interpreter"""
+        if self._saved is None:
+            return
+        interp = self.interp
+        (interp.node_handlers, interp.use_compiler,
+         interp.trusted_compile, interp.fuse_arrays,
+         interp.array_threads) = self._saved
+        self._saved = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _wrap(self, nodename, handler):
+        """handler recording the time of running a node"""
+        timer = self.timer
+        nodes, lines, functions = self.nodes, self.lines, self.functions
+        children, calls = self._children, self._calls
+        is_call = nodename == 'call'
+
+        def profiled(node):
+            children.append(0.0)
+            if is_call:
+                calls.append(0.0)
+            start = timer()
+            try:
+                return handler(node)
+            finally:
+                elapsed = timer() - start
+                exclusive = elapsed - children.pop()
+                if children:
+                    children[-1] += elapsed
+                stats = nodes.get(nodename)
+                if stats is None:
+                    stats = nodes[nodename] = [0, 0.0, 0.0]
+                stats[COUNT] += 1
+                stats[INCLUSIVE] += elapsed
+                stats[EXCLUSIVE] += exclusive
+
+                lineno = getattr(node, 'lineno', None)
+                if lineno is not None:
+                    stats = lines.get(lineno)
+                    if stats is None:
+                        stats = lines[lineno] = [0, 0.0, 0.0]
+                    if isinstance(node, ast.stmt):
+                        stats[COUNT] += 1
+                        stats[INCLUSIVE] += elapsed
+                    stats[EXCLUSIVE] += exclusive
+
+                if is_call:
+                    nested = calls.pop()
+                    if calls:
+                        calls[-1] += elapsed
+                    name = call_name(node)
+                    stats = functions.get(name)
+                    if stats is None:
+                        stats = functions[name] = [0, 0.0, 0.0]
+                    stats[COUNT] += 1
+                    stats[INCLUSIVE] += elapsed
+                    stats[EXCLUSIVE] += elapsed - nested
+        return profiled
+
+    def as_dict(self):
+        """statistics as a dictionary of 'nodes', 'lines' and 'functions',
+        each mapping keys to dictionaries of 'count', 'inclusive' and
+        'exclusive' (times in seconds)"""
+        out = {}
+        for kind in ('nodes', 'lines', 'functions'):
+            out[kind] = dict((key, {'count': stats[COUNT],
+                                    'inclusive': stats[INCLUSIVE],
+                                    'exclusive': stats[EXCLUSIVE]})
+                             for key, stats in getattr(self, kind).items())
+        return out
+
+    def report(self, by='nodes', sort='exclusive', limit=None):
+        """text table of the statistics
+
+        :param by: 'nodes', 'lines' or 'functions'
+        :param sort: 'exclusive', 'inclusive' or 'count' (largest first)
+        :param limit: largest number of rows
+        """
+        if by not in ('nodes', 'lines', 'functions'):
+            raise ValueError("unknown report '%s'" % by)
+        if sort not in SORT_KEYS:
+            raise ValueError("unknown sort key '%s'" % sort)
+        index = SORT_KEYS[sort]
+        rows = sorted(getattr(self, by).items(),
+                      key=lambda item: item[1][index], reverse=True)
+        if limit is not None:
+            rows = rows[:limit]
+        title = {'nodes': 'node', 'lines': 'line',
+                 'functions': 'function'}[by]
+        out = ['%-24s %10s %12s %12s' % (title, 'count', 'incl (ms)',
+                                         'excl (ms)')]
+        for key, stats in rows:
+            out.append('%-24s %10d %12.3f %12.3f' % (
+                key, stats[COUNT], 1000*stats[INCLUSIVE],
+                1000*stats[EXCLUSIVE]))
+        return '\n'.join(out)
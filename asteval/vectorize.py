@@ -0,0 +1,202 @@
+"""
+column-wise (batch) evaluation for asteval
+
+A single expression is evaluated over equal-length columns of data.
+With numpy, the columns are bound to their symbol names as arrays and
+the expression is evaluated once, after rewriting the parts of Python
+that do not work elementwise on arrays:
+
+    a if test else b    ->  where(test, a, b)
+    a and b, a or b     ->  logical_and(a, b), logical_or(a, b)
+    not a               ->  logical_not(a)
+    a < b < c           ->  logical_and(a < b, b < c)
+
+If that fails, or does not give one value per row, the expression is
+evaluated row by row instead.
+"""
+from __future__ import division, print_function
+import ast
+from copy import deepcopy
+
+from .astutils import get_numpy, symbol_usage
+
+# names of the numpy functions used by rewritten expressions
+VECTOR_FUNCS = {'__asteval_where__': 'where',
+                '__asteval_and__': 'logical_and',
+                '__asteval_or__': 'logical_or',
+                '__asteval_not__': 'logical_not'}
+
+
+class Vectorizer(ast.NodeTransformer):
+    """rewrite an expression so that it works elementwise on arrays"""
+
+    @staticmethod
+    def _call(name, args, node):
+        func = ast.Name(id=name, ctx=ast.Load())
+        return ast.copy_location(ast.Call(func=func, args=args, keywords=[]),
+                                 node)
+
+    def visit_IfExp(self, node):
+        node = self.generic_visit(node)
+        return self._call('__asteval_where__',
+                          [node.test, node.body, node.orelse], node)
+
+    def visit_BoolOp(self, node):
+        node = self.generic_visit(node)
+        name = '__asteval_and__'
+        if isinstance(node.op, ast.Or):
+            name = '__asteval_or__'
+        out = node.values[0]
+        for val in node.values[1:]:
+            out = self._call(name, [out, val], node)
+        return out
+
+    def visit_UnaryOp(self, node):
+        node = self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return self._call('__asteval_not__', [node.operand], node)
+        return node
+
+    def visit_Compare(self, node):
+        node = self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        out, left = None, node.left
+        for op, right in zip(node.ops, node.comparators):
+            comp = ast.copy_location(ast.Compare(left=left, ops=[op],
+                                                 comparators=[right]), node)
+            out = comp if out is None else self._call('__asteval_and__',
+                                                      [out, comp], node)
+            left = right
+        return out
+
+
+class Batch(object):
+    """an expression to be evaluated for every row of a set of columns
+
+    :param interp: Interpreter
+    :param node: parsed expression
+    :param columns: dictionary of symbol name: equal-length sequences
+
+    A Batch can be run again over other columns given to load(), reusing
+    the rewritten and compiled expression.
+    """
+
+    def __init__(self, interp, node, columns=None):
+        self.interp = interp
+        self.node = node
+        self.numpy = None
+        if interp.use_numpy:
+            self.numpy = get_numpy()
+        self.use_numpy = self.numpy is not None
+        self.vectorized = None
+        self.names = symbol_usage(node).reads
+        self.columns = {}
+        self.nrows = 0
+        self._tree = None
+        self._program = None
+        if columns is not None:
+            self.load(columns)
+
+    def load(self, columns):
+        """set the columns to evaluate the expression over"""
+        names = self.names
+        self.columns = {}
+        self.nrows = None
+        for name, col in columns.items():
+            if name not in names:
+                continue
+            if self.use_numpy:
+                col = self.numpy.asarray(col)
+            if self.nrows is None:
+                self.nrows = len(col)
+            elif len(col) != self.nrows:
+                msg = "columns must all have the same length"
+                self.interp.raise_exception(None, exc=ValueError, msg=msg)
+            self.columns[name] = col
+        if self.nrows is None:
+            self.nrows = 0
+            for col in columns.values():
+                self.nrows = len(col)
+                break
+
+    def run(self):
+        """evaluate the expression, returning one result per row"""
+        out = None
+        body = getattr(self.node, 'body', None)
+        if (self.use_numpy and self.nrows > 0 and len(body) == 1 and
+                isinstance(body[0], ast.Expr)):
+            out = self.run_vectorized()
+        self.vectorized = out is not None
+        if out is None:
+            out = self.run_rows()
+        return out
+
+    def _bind(self, symbols):
+        """add symbols to symtable, returning the values they replace"""
+        symtable = self.interp.symtable
+        saved = {}
+        for name, val in symbols.items():
+            saved[name] = symtable.get(name, self)
+            symtable[name] = val
+        return saved
+
+    def _restore(self, saved):
+        """restore symtable values replaced by _bind()"""
+        symtable = self.interp.symtable
+        for name, val in saved.items():
+            if val is self:
+                symtable.pop(name, None)
+            else:
+                symtable[name] = val
+
+    def run_vectorized(self):
+        """evaluate once over the whole columns, or return None if the
+        expression can not be evaluated elementwise"""
+        interp, numpy = self.interp, self.numpy
+        if self._tree is None:
+            self._tree = ast.fix_missing_locations(
+                Vectorizer().visit(deepcopy(self.node)))
+        tree = self._tree
+        symbols = {}
+        for name, func in VECTOR_FUNCS.items():
+            symbols[name] = getattr(numpy, func)
+        symbols.update(self.columns)
+        error_msg = interp.error_msg
+        saved = self._bind(symbols)
+        try:
+            out = interp.run(tree, with_raise=False)
+        finally:
+            self._restore(saved)
+        if interp.error:
+            interp.error = []
+            interp.error_msg = error_msg
+            return None
+        if numpy.ndim(out) == 0:
+            if self.columns:
+                return None
+            return numpy.repeat(numpy.asarray(out), self.nrows)
+        if numpy.ndim(out) != 1 or len(out) != self.nrows:
+            return None
+        return out
+
+    def run_rows(self):
+        """evaluate the expression once for each row"""
+        interp = self.interp
+        if self._program is None:
+            self._program = interp.compile(self.node)
+        program = self._program
+        symtable = interp.symtable
+        columns = list(self.columns.items())
+        out = []
+        saved = self._bind(dict([(name, None) for name, _ in columns]))
+        try:
+            for irow in range(self.nrows):
+                for name, col in columns:
+                    symtable[name] = col[irow]
+                out.append(interp.run(program))
+        finally:
+            self._restore(saved)
+        if self.use_numpy:
+            out = self.numpy.array(out)
+        return out
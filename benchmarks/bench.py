@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+benchmarks for asteval
+
+    python benchmarks/bench.py                   # run all, print a table
+    python benchmarks/bench.py -o before.json    # also save the results
+    python benchmarks/bench.py -c before.json    # compare to saved results
+    python benchmarks/bench.py -k loop -k parse  # only matching names
+
+Each benchmark times one operation with asteval and, where there is
+one, the same operation with Python's own eval()/exec(), and reports
+the best time per operation of several repeats.  The JSON output holds
+these times (in seconds) with the versions of Python, numpy and asteval,
+so that results of two commits can be compared with -c.
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asteval
+from asteval import Interpreter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LOOP = """
+s = 0
+for i in range(2000):
+    s = s + i*i
+"""
+
+WHILE = """
+n, s = 0, 0
+while n < 2000:
+    n = n + 1
+    if n % 3 == 0:
+        s = s + n
+"""
+
+FIB = """
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n-1) + fib(n-2)
+"""
+
+LISTCOMP = "x = [i*i for i in range(2000) if i % 3]"
+
+SHORT = "a*x**2 + b*x + c"
+
+# (name, reference): benchmarks expected to take no longer than another
+EXPECTED_FASTER = [('eval_short_trusted', 'eval_short_compiled'),
+                   ('run_short_trusted', 'run_short_compiled')]
+
+
+def native_namespace(use_numpy=False):
+    """globals for eval()/exec() with math (or numpy) functions"""
+    namespace = dict((name, getattr(math, name)) for name in dir(math)
+                     if not name.startswith('_'))
+    if use_numpy and numpy is not None:
+        namespace.update((name, getattr(numpy, name))
+                         for name in ('sqrt', 'sin', 'exp', 'arange'))
+    return namespace
+
+
+def short_symbols():
+    return {'a': 1.5, 'b': -2.0, 'c': 0.25, 'x': 3.0}
+
+
+def benchmarks():
+    """return a list of (name, asteval setup, native setup), where a
+    setup returns the function to time"""
+    out = []
+
+    def parse():
+        interp = Interpreter(use_numpy=False)
+        return lambda: interp.parse(SHORT)
+
+    def native_parse():
+        return lambda: compile(SHORT, '<expr>', 'eval')
+    out.append(('parse_short', parse, native_parse))
+
+    def eval_short(**kws):
+        def setup():
+            interp = Interpreter(**kws)
+            interp.symtable.update(short_symbols())
+            return lambda: interp(SHORT)
+        return setup
+
+    def native_short():
+        code = compile(SHORT, '<expr>', 'eval')
+        namespace = short_symbols()
+        return lambda: eval(code, namespace)
+    out.append(('eval_short', eval_short(), native_short))
+    out.append(('eval_short_compiled', eval_short(use_compiler=True),
+                native_short))
+    out.append(('eval_short_trusted', eval_short(trusted_compile=True),
+                native_short))
+
+    def run_short(**kws):
+        def setup():
+            interp = Interpreter(**kws)
+            interp.symtable.update(short_symbols())
+            program = interp.compile(SHORT)
+            return lambda: interp.run(program)
+        return setup
+    out.append(('run_short_compiled', run_short(), native_short))
+    out.append(('run_short_trusted', run_short(trusted_compile=True),
+                native_short))
+
+    for name, script in (('for_loop', LOOP), ('while_loop', WHILE),
+                         ('listcomp', LISTCOMP)):
+        for suffix, kws in (('', {}), ('_compiled', {'use_compiler': True})):
+            out.append((name + suffix, _script(script, kws),
+                        _native_script(script)))
+
+    for suffix, kws in (('', {}), ('_compiled', {'use_compiler': True})):
+        out.append(('recursion' + suffix,
+                    _script('fib(15)', kws, setup=FIB),
+                    _native_script('fib(15)', setup=FIB)))
+
+    if numpy is not None:
+        def arrays(**kws):
+            def setup():
+                interp = Interpreter(**kws)
+                interp.symtable['a'] = numpy.linspace(0, 1, 10**6)
+                interp.symtable['b'] = numpy.linspace(1, 2, 10**6)
+                return lambda: interp('c = a*b + sqrt(a) - exp(-b)')
+            return setup
+
+        def native_arrays():
+            namespace = native_namespace(use_numpy=True)
+            namespace['a'] = numpy.linspace(0, 1, 10**6)
+            namespace['b'] = numpy.linspace(1, 2, 10**6)
+            code = compile('c = a*b + sqrt(a) - exp(-b)', '<expr>', 'exec')
+            return lambda: exec(code, namespace)
+        out.append(('array_arith', arrays(), native_arrays))
+        out.append(('array_arith_compiled', arrays(use_compiler=True),
+                    native_arrays))
+        out.append(('array_arith_fused', arrays(fuse_arrays=True),
+                    native_arrays))
+        out.append(('array_arith_threads',
+                    arrays(fuse_arrays=True, array_threads=4),
+                    native_arrays))
+
+    out.append(('construct', lambda: Interpreter, None))
+    out.append(('construct_no_numpy',
+                lambda: lambda: Interpreter(use_numpy=False), None))
+    out.append(('construct_lazy_numpy',
+                lambda: lambda: Interpreter(lazy_numpy=True), None))
+    return out
+
+
+def _script(script, kws, setup=None):
+    def func():
+        interp = Interpreter(**kws)
+        if setup is not None:
+            interp(setup)
+        return lambda: interp(script)
+    return func
+
+
+def _native_script(script, setup=None):
+    def func():
+        namespace = native_namespace()
+        if setup is not None:
+            exec(setup, namespace)
+        code = compile(script, '<script>', 'exec')
+        return lambda: exec(code, namespace)
+    return func
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """best time (sec) of one call of func, from `repeat` runs of enough
+    calls to take at least min_time"""
+    func()
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time or number >= 10**6:
+            break
+        number *= max(2, min(10, int(min_time / max(elapsed, 1e-9))))
+    times = [elapsed] + timeit.repeat(func, number=number, repeat=repeat-1)
+    return min(times) / number
+
+
+def run(names=None, repeat=5, min_time=0.2, out=sys.stdout):
+    """run the benchmarks, returning the results as a dictionary"""
+    results = {}
+    for name, setup, native in benchmarks():
+        if names and not any(key in name for key in names):
+            continue
+        result = {'asteval': measure(setup(), repeat, min_time)}
+        if native is not None:
+            result['native'] = measure(native(), repeat, min_time)
+            result['ratio'] = result['asteval'] / result['native']
+        results[name] = result
+        if out is not None:
+            print(format_row(name, result), file=out)
+            out.flush()
+    return {'meta': metadata(), 'results': results}
+
+
+def check_order(results, out=sys.stdout):
+    """print the EXPECTED_FASTER benchmarks that were slower"""
+    for name, reference in EXPECTED_FASTER:
+        if name in results and reference in results:
+            time, ref_time = (results[name]['asteval'],
+                              results[reference]['asteval'])
+            if time > ref_time:
+                print('warning: %s (%s) is slower than %s (%s)' % (
+                    name, format_time(time).strip(), reference,
+                    format_time(ref_time).strip()), file=out)
+
+
+def metadata():
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'asteval': asteval.__version__,
+            'numpy': getattr(numpy, '__version__', None)}
+
+
+def format_time(sec):
+    if sec is None:
+        return '%10s' % '-'
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if sec >= scale:
+            return '%8.2f%-2s' % (sec / scale, unit)
+    return '%8.2f%-2s' % (sec / 1e-9, 'ns')
+
+
+def format_row(name, result):
+    ratio = result.get('ratio')
+    return '%-24s %s %s %8s' % (name, format_time(result['asteval']),
+                                format_time(result.get('native')),
+                                '-' if ratio is None else '%.1fx' % ratio)
+
+
+def compare(old, new, out=sys.stdout):
+    """print the change in asteval times between two sets of results"""
+    print('%-24s %10s %10s %8s' % ('benchmark', 'old', 'new', 'change'),
+          file=out)
+    for name, result in sorted(new['results'].items()):
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        change = result['asteval'] / before['asteval'] - 1
+        print('%-24s %s %s %+7.1f%%' % (name, format_time(before['asteval']),
+                                         format_time(result['asteval']),
+                                         100*change), file=out)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-k', dest='names', action='append',
+                        help='run benchmarks whose name contains this')
+    parser.add_argument('-o', '--output', help='write results to JSON file')
+    parser.add_argument('-c', '--compare',
+                        help='compare to results in JSON file')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of repeats (default 5)')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='time fewer and shorter runs')
+    opts = parser.parse_args(args)
+    repeat, min_time = opts.repeat, 0.2
+    if opts.quick:
+        repeat, min_time = min(repeat, 3), 0.02
+
+    print('%-24s %10s %10s %8s' % ('benchmark', 'asteval', 'native',
+                                   'ratio'))
+    results = run(names=opts.names, repeat=repeat, min_time=min_time)
+    check_order(results['results'])
+    if opts.output:
+        with open(opts.output, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as fh:
+            old = json.load(fh)
+        print()
+        compare(old, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,16 @@
 Base TestCase for asteval
 """
 import ast
+import math
 import os
+import pickle
+import shutil
+import sys
+import threading
 import time
 import unittest
 from sys import version_info
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 
 PY3 = version_info[0] == 3
 PY33Plus = PY3 and version_info[1] >= 3
@@ -19,7 +24,12 @@ else:
     # noinspection PyUnresolvedReferences
     from cStringIO import StringIO
 
-from asteval import NameFinder, Interpreter
+from asteval import (NameFinder, Interpreter, InterpreterPool, LRUCache,
+                     SymbolTable, ExpressionGraph, ProgramCache)
+from asteval.astutils import WATCHDOG, get_ast_names, symbol_usage
+from asteval.compiler import Frame
+from asteval.fusion import build_kernel
+from asteval.parallel import ParallelEvaluator, eval_many
 
 HAS_NUMPY = False
 try:
@@ -504,6 +514,12 @@ a = arange(7)""")
         self.interp("del b")
         self.assertFalse('a' in self.symtable)
         self.assertFalse('b' in self.symtable)
+        # in a procedure, names not local are deleted from the symtable
+        self.interp("g = 1\ndef f(x):\n    y = x\n    del y\n    del g\n"
+                    "    return x\nf(2)")
+        self.assertEqual(len(self.interp.error), 0)
+        self.assertFalse('g' in self.symtable)
+        self.assertFalse('y' in self.symtable)
 
     # noinspection PyUnresolvedReferences
     def test_math1(self):
@@ -525,6 +541,36 @@ a = arange(7)""")
         self.assertTrue('y' in nf.names)
         self.assertTrue('z' in nf.names)
         self.assertTrue('cos' in nf.names)
+        # a bare name is found as the root node
+        for node in (ast.Name(id='x', ctx=ast.Load()),
+                     self.interp.parse('x').body[0].value):
+            self.assertEqual(get_ast_names(node), ['x'])
+            nf = NameFinder()
+            nf.generic_visit(node)
+            self.assertEqual(nf.names, ['x'])
+
+    def test_symbol_usage(self):
+        """names read, written and called, and attributes used"""
+        usage = symbol_usage(self.interp.parse("""
+def f(a):
+    return a.real + g(b)
+try:
+    x = f(y)
+except ValueError as exc:
+    del z
+"""))
+        self.assertEqual(usage.reads,
+                         set(['a', 'g', 'b', 'f', 'y', 'ValueError']))
+        self.assertEqual(usage.writes, set(['f', 'x', 'exc', 'z']))
+        self.assertEqual(usage.calls, set(['f', 'g']))
+        self.assertEqual(usage.attrs, set(['real']))
+        usage = symbol_usage(self.interp.parse("n += 1\nm.x -= n"))
+        self.assertEqual(usage.reads, set(['n', 'm']))
+        self.assertEqual(usage.writes, set(['n']))
+        program = self.interp.compile("y = x.imag + sqrt(x)")
+        self.assertTrue(program.usage is program.usage)
+        self.assertEqual(program.usage.reads, set(['x', 'sqrt']))
+        self.assertEqual(program.usage.writes, set(['y']))
 
     def test_list_comprehension(self):
         """test list comprehension"""
@@ -732,6 +778,261 @@ def fcn(x, y):
         self.interp("o = fcn(1, x=2)")
         self.check_error('TypeError')
 
+    def test_shared_builtins(self):
+        """builtins are shared, not copied, by each interpreter"""
+        interp2 = Interpreter()
+        self.assertTrue(self.interp.symtable['sqrt'] is
+                        interp2.symtable['sqrt'])
+        self.interp("sqrt = 4")
+        self.isvalue('sqrt', 4)
+        self.assertEqual(interp2("sqrt(9)"), 3)
+        self.interp("del sqrt")
+        self.interp("sqrt(9)")
+        self.check_error('NameError')
+        self.assertFalse('sqrt' in self.interp.symtable)
+        self.assertTrue('sqrt' in interp2.symtable)
+        self.assertFalse('sqrt' in self.interp.symtable.keys())
+        self.assertTrue('abs' in self.interp.no_deepcopy)
+        self.assertTrue('cos' in self.interp.no_deepcopy)
+        self.interp("cos = 2")
+        self.assertFalse('cos' in self.interp.no_deepcopy)
+
+    def test_lazy_numpy(self):
+        """with lazy_numpy, numpy is used on the first lookup of its
+        names"""
+        interp = Interpreter(lazy_numpy=True)
+        self.assertEqual(interp("sqrt(16) + 1"), 5)
+        self.assertTrue(interp.symtable['len'] is len)
+        if HAS_NUMPY:
+            self.assertTrue(interp.symtable['sqrt'] is np.sqrt)
+            self.assertEqual(list(interp("sqrt(arange(3)**2)")), [0, 1, 2])
+            self.assertTrue(interp.symtable['arange'] is np.arange)
+            self.assertTrue('linspace' in interp.symtable)
+            out = interp("arange(4)*2")
+            self.assertTrue(isinstance(out, np.ndarray))
+        self.assertFalse('not_a_numpy_name' in interp.symtable)
+
+    def test_cancel(self):
+        """cancel() from another thread, and the watchdog, stop evaluation"""
+        self.interp.max_time = 30
+        timer = threading.Timer(0.1, self.interp.cancel)
+        timer.start()
+        self.interp("while True: pass")
+        timer.join()
+        self.check_error('RuntimeError', 'cancelled')
+        self.interp.max_time = 0.2
+        self.interp("def f():\n    while True: pass\nf()")
+        self.check_error('RuntimeError', 'max runtime is 0.2s')
+        self.assertEqual(self.interp("1 + 2"), 3)
+        # the watchdog is only armed by a loop iteration or call
+        armed = []
+        arm = WATCHDOG.arm
+        WATCHDOG.arm = lambda *args: armed.append(args) or arm(*args)
+        try:
+            self.interp("x = 1 + 2")
+            self.assertEqual(armed, [])
+            self.interp("for i in range(3): x = x + i")
+            self.assertEqual(len(armed), 1)
+            self.assertTrue(armed[0][0] <= 0.2)
+        finally:
+            del WATCHDOG.arm
+        # catching the error does not keep the evaluation running
+        start = time.time()
+        self.interp("""
+n = 0
+while True:
+    try:
+        n = n + 1
+    except:
+        pass
+""")
+        self.assertTrue(time.time() - start < 5)
+        self.check_error('RuntimeError', 'max runtime is 0.2s')
+        self.interp("def g():\n    try:\n        g()\n    except:\n        g()\n"
+                    "while True:\n    try:\n        g()\n    except:\n"
+                    "        pass")
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(self.interp("1 + 2"), 3)
+
+    def test_step_budget(self):
+        """max_steps aborts evaluation after a reproducible number of steps"""
+        self.interp.max_steps = 5000
+        counts = []
+        for _ in range(2):
+            self.interp("s = 0\nwhile True: s = s + 1")
+            self.check_error('RuntimeError', 'step budget')
+            counts.append(self.symtable['s'])
+        self.assertEqual(counts[0], counts[1])
+        self.assertTrue(800 < counts[0] < 1300)
+        self.interp("x = [i for i in range(100)]")
+        self.assertEqual(len(self.symtable['x']), 100)
+        # recursion without loops
+        self.interp("def fib(n):\n    if n < 2:\n        return n\n"
+                    "    return fib(n-1) + fib(n-2)\n\nfib(22)")
+        self.check_error('RuntimeError', 'step budget')
+        self.assertTrue(5000 < self.interp.steps < 5100)
+        if HAS_NUMPY:
+            # no time limit: a slow host must not trip it before the budget
+            self.interp.max_time = None
+            self.symtable['a'] = np.ones(10**7)
+            self.interp("b = a*2")
+            self.check_error('RuntimeError', 'step budget')
+
+    def test_eval_stream(self):
+        """streaming evaluation in chunks, with per-chunk errors"""
+        records = ({'x': i, 'y': 2} for i in range(25))
+        stream = self.interp.eval_stream("x*y + 1 if x > 3 else 0",
+                                         records, chunk_size=10)
+        chunks = list(stream)
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEqual(list(chunks[0][:6]), [0, 0, 0, 0, 9, 11])
+        records = [{'x': 1}]*5 + [{'x': 'a'}] + [{'x': 2}]*5
+        chunks = list(self.interp.eval_stream("x*2 + 1", records,
+                                              chunk_size=4))
+        self.assertEqual(list(chunks[0]), [3]*4)
+        self.assertEqual(chunks[1].index, 1)
+        self.assertEqual(chunks[1].exc_name, 'TypeError')
+        self.assertEqual(list(chunks[2]), [5]*3)
+        self.assertEqual(self.interp.error, [])
+        chunks = self.interp.eval_stream("a - b", iter([(1, 2), (5, 3)]),
+                                         names=['a', 'b'])
+        self.assertEqual(list(next(chunks)), [-1, 2])
+        # syntax errors are reported as by eval_batch()
+        self.assertEqual(list(self.interp.eval_stream("x +", records)), [])
+        self.check_error('SyntaxError')
+        chunks = self.interp.eval_stream("x +", records, show_errors=False)
+        self.assertRaises(SyntaxError, list, chunks)
+
+    def test_file_loaders(self):
+        """read-only loaders, restricted to file_root"""
+        root = mkdtemp(prefix='astevaltest')
+        try:
+            with open(os.path.join(root, 'table.csv'), 'w') as fh:
+                fh.write("x,y\n")
+                for i in range(25):
+                    fh.write("%d,%d\n" % (i, i*i))
+            with open(os.path.join(root, 'raw.bin'), 'wb') as fh:
+                fh.write(b'0123456789')
+            interp = Interpreter(file_root=root)
+            interp("chunks = [c for c in read_chunks('table.csv', "
+                   "chunksize=10, skiprows=1)]")
+            self.assertEqual([len(c) for c in interp.symtable['chunks']],
+                             [10, 10, 5])
+            self.assertEqual(interp("sum([sum([row[1] for row in c]) "
+                                    "for c in chunks])"), 4900)
+            self.assertEqual(interp("bytes(read_bytes('raw.bin', 3, 4))"),
+                             b'3456')
+            self.assertEqual(interp("open('table.csv').readline()"), "x,y\n")
+            # files are opened when chunks are read
+            interp("chunks = read_chunks('missing.csv')")
+            self.assertEqual(len(interp.error), 0)
+            interp("chunks = read_chunks('../table.csv')")
+            self.assertTrue(len(interp.error) > 0)
+            for expr in ("open('%s')" % os.path.abspath(__file__),
+                         "read_bytes('../raw.bin')"):
+                interp(expr)
+                self.assertTrue(len(interp.error) > 0)
+                self.assertTrue('outside' in str(interp.error[0].msg) or
+                                'outside' in repr(interp.error[0].exc_info))
+            if HAS_NUMPY:
+                np.save(os.path.join(root, 'a.npy'), np.arange(10.0))
+                self.assertEqual(interp("load_array('a.npy').sum()"), 45)
+                self.assertEqual(list(interp("load_array('raw.bin', "
+                                             "dtype='uint8')[:2]")),
+                                 [48, 49])
+                interp.reset()
+                self.assertFalse('loadtxt' in interp.symtable)
+                self.assertTrue('read_chunks' in interp.symtable)
+        finally:
+            shutil.rmtree(root)
+        # only open() without a file_root
+        for name in ('load_array', 'read_chunks', 'read_bytes'):
+            self.assertFalse(name in Interpreter().symtable)
+
+    def test_profile(self):
+        """profiling counts nodes, lines and calls, and is removed after"""
+        handlers = self.interp.node_handlers
+        with self.interp.profile() as prof:
+            self.interp("def f(n):\n    return abs(n) + 1\n"
+                        "s = 0\nfor k in range(50):\n    s = s + f(k)")
+        self.assertTrue(self.interp.node_handlers is handlers)
+        self.isvalue('s', 1275)
+        stats = prof.as_dict()
+        self.assertEqual(stats['functions']['f']['count'], 50)
+        self.assertEqual(stats['functions']['abs']['count'], 50)
+        self.assertEqual(stats['nodes']['call']['count'], 101)
+        self.assertEqual(stats['lines'][5]['count'], 50)
+        func = stats['functions']['f']
+        self.assertTrue(func['exclusive'] <= func['inclusive'])
+        self.assertTrue(stats['nodes']['for']['inclusive'] >=
+                        stats['nodes']['assign']['inclusive'])
+        report = prof.report(by='functions', sort='count', limit=2)
+        self.assertEqual(len(report.split('\n')), 3)
+        self.assertRaises(ValueError, prof.report, by='files')
+        self.interp("s = f(1)")
+        self.assertEqual(prof.as_dict()['functions']['f']['count'], 50)
+
+    def test_reset(self):
+        """reset() restores the symtable and clears errors"""
+        self.interp("x = 1\nsqrt = 2\ndel cos")
+        self.interp("undefined_name")
+        self.assertTrue(len(self.interp.error) > 0)
+        self.interp.reset()
+        self.assertEqual(self.interp.error, [])
+        self.assertFalse('x' in self.interp.symtable)
+        self.assertEqual(self.interp("sqrt(cos(0)*4)"), 2)
+
+    def test_recursion_depth(self):
+        """recursion is limited without changing sys.getrecursionlimit()"""
+        limit = sys.getrecursionlimit()
+        self.interp("def fact(n):\n    if n < 2: return 1\n    return n*fact(n-1)")
+        self.assertEqual(self.interp("fact(20)"), 2432902008176640000)
+        self.assertEqual(self.interp.depth, 0)
+        self.interp("fact(500)")
+        self.check_error('RuntimeError', 'recursion depth')
+        self.assertEqual(sys.getrecursionlimit(), limit)
+        self.interp.set_recursion_limit(10)
+        self.interp("fact(20)")
+        self.check_error('RuntimeError', 'recursion depth')
+        self.interp.reset_recursion_limit()
+        self.assertEqual(self.interp("fact(20)"), 2432902008176640000)
+        self.assertEqual(sys.getrecursionlimit(), limit)
+
+    def test_user_symtable(self):
+        """a user-supplied dictionary is filled with builtins"""
+        symtable = {'x': 3}
+        interp = Interpreter(symtable=symtable)
+        self.assertFalse(isinstance(interp.symtable, SymbolTable))
+        self.assertTrue('sqrt' in symtable)
+        self.assertEqual(interp("sqrt(x*12)"), 6)
+
+    def test_function_frames(self):
+        """procedure locals live in their own frame"""
+        self.interp("""
+total = 10
+def addup(n):
+    total = 0
+    def step(i):
+        return total + i
+    for i in range(n):
+        total = step(i)
+    return total
+""")
+        self.interp("out = addup(4)")
+        self.isvalue('out', 6)
+        self.isvalue('total', 10)
+        self.assertFalse('i' in self.symtable)
+        self.assertFalse('step' in self.symtable)
+        self.assertTrue(self.interp.frame is None)
+        self.interp("""
+def fact(n):
+    if n <= 1:
+        return 1
+    return n * fact(n-1)
+""")
+        self.interp("f = fact(6)")
+        self.isvalue('f', 720)
+
     def test_astdump(self):
         """test ast parsing and dumping"""
         astnode = self.interp.parse('x = 1')
@@ -770,6 +1071,9 @@ def fcn(x, y):
         self.check_error('RuntimeError')
 
     def test_dos(self):
+        # compiled code runs this loop in little more than the default
+        # max_time: a shorter limit makes sure it is reached
+        self.interp.max_time = 0.5
         self.interp("""for x in range(2<<21): pass""")
         self.check_error('RuntimeError', 'time limit')
         self.interp("""while True: pass""")
@@ -777,6 +1081,44 @@ def fcn(x, y):
         self.interp("""def foo(): return foo()\nfoo()""")
         self.check_error('RuntimeError')  # Stack overflow... is caught, but with MemoryError. A bit concerning...
 
+    def test_augassign_inplace(self):
+        """augmented assignments update their target in place"""
+        self.interp("a = [1]\nb = a\na += [2]")
+        self.isvalue('b', [1, 2])
+        self.assertTrue(self.symtable['a'] is self.symtable['b'])
+        self.interp("""
+keys = []
+def key(k):
+    keys.append(k)
+    return k
+d = {'x': 1}
+d[key('x')] += 2
+n = 3
+n *= 4
+""")
+        self.isvalue('d', {'x': 3})
+        self.isvalue('keys', ['x'])
+        self.isvalue('n', 12)
+
+        class Holder(object):
+            pass
+        self.symtable['obj'] = Holder()
+        self.symtable['obj'].total = 1
+        self.interp("obj.total -= 5")
+        self.assertEqual(self.symtable['obj'].total, -4)
+        self.interp("s = '*'*(2<<17)")
+        self.interp("s += 'x'")
+        self.check_error('RuntimeError')
+        self.interp("n **= 10001")
+        self.check_error('RuntimeError')
+        if HAS_NUMPY:
+            self.interp("x = arange(5)\ny = x\nx += 2\nx[1:3] *= 10")
+            self.assertTrue(self.symtable['x'] is self.symtable['y'])
+            self.isvalue('y', np.array([2, 30, 40, 5, 6]))
+            # an integer array can not hold float results
+            self.interp("x += 0.5")
+            self.isvalue('x', np.array([2.5, 30.5, 40.5, 5.5, 6.5]))
+
     def test_kaboom(self):
         """ test Ned Batchelder's 'Eval really is dangerous' - Kaboom test (and related tests)"""
         self.interp("""(lambda fc=(lambda n: [c for c in ().__class__.__bases__[0].__subclasses__() if c.__name__ == n][0]):
@@ -810,6 +1152,358 @@ def fcn(x, y):
         z = self.interp("""def foo(): return 42\nfoo()""")
         self.assertEqual(z, 42)
 
+    def test_eval_batch(self):
+        """evaluate one expression over columns of data"""
+        cols = {'x': [1.0, -2.0, 3.0, 4.0], 'y': [2.0, 2.0, 0.5, 8.0]}
+        expr = "x*y + 1 if x > 0 and not y > 5 else -1"
+        expected = [3.0, -1, 2.5, -1]
+        out = self.interp.eval_batch(expr, cols)
+        self.assertEqual(list(out), expected)
+        self.interp("z = 2")
+        out = self.interp.eval_batch("0 < x < z", cols)
+        self.assertEqual(list(out), [True, False, False, False])
+        self.assertFalse('x' in self.symtable)
+
+    def test_eval_batch_rows(self):
+        """expressions that can not be vectorized are evaluated per row"""
+        self.interp("""
+def sign(val):
+    if val < 0:
+        return -1
+    return 1
+""")
+        self.interp("x = 'unchanged'")
+        out = self.interp.eval_batch("sign(x) * len(name)",
+                                     {'x': [1, -2, 3], 'name': ['a', 'bb', 'c']})
+        self.assertEqual(list(out), [1, -2, 1])
+        self.isvalue('x', 'unchanged')
+        self.assertFalse('name' in self.symtable)
+        self.interp.eval_batch("x/y", {'x': [1, 2], 'y': [1]})
+        self.check_error('ValueError', 'same length')
+
+
+class TestEvalCompiled(TestEval):
+    """run the TestEval tests with the closure compiler"""
+
+    def setUp(self):
+        self.interp = Interpreter(use_compiler=True)
+        self.symtable = self.interp.symtable
+        self.set_stdout()
+        if not HAS_NUMPY:
+            self.interp("arange = range")
+
+    def test_compile(self):
+        """compile once, run many times"""
+        self.interp("x = 2")
+        program = self.interp.compile("y = x*3 + 1\ny")
+        self.assertEqual(self.interp.run(program), 7)
+        self.interp("x = 5")
+        self.assertEqual(self.interp.run(program), 16)
+        self.isvalue('y', 16)
+        self.assertTrue(self.interp.compile("x*2") is self.interp.compile("x*2"))
+
+    def test_slot_frames(self):
+        """procedure locals are slots of a Frame, other names are found
+        in the caller frame and the symtable"""
+        self.interp("""
+scale = 10
+def inner(k):
+    return acc + k*scale
+def outer(n, start=0):
+    if n < 0:
+        return scale
+    acc = start
+    for i in range(n):
+        acc = inner(i)
+    try:
+        del acc
+        acc
+    except NameError:
+        acc = -1
+    return acc, i
+""")
+        self.assertEqual(self.interp("outer(3, start=1)"), (-1, 2))
+        self.assertEqual(self.interp("outer(-1)"), 10)
+        self.interp("acc = 100")
+        self.assertEqual(self.interp("inner(1)"), 110)
+        proc = self.symtable['outer']
+        self.assertEqual(sorted(proc.index),
+                         ['acc', 'i', 'n', 'start'])
+        frame = Frame(proc.index)
+        frame.update({'n': 2, 'x': 1})
+        self.assertEqual(sorted(frame.items()), [('n', 2), ('x', 1)])
+        self.assertFalse('acc' in frame)
+        self.assertEqual(frame.pop('n'), 2)
+        self.assertEqual(frame.keys(), ['x'])
+
+    def test_return_in_loop(self):
+        """return from inside nested loops"""
+        self.interp("""
+def first_over(values, limit):
+    for row in values:
+        for val in row:
+            if val > limit:
+                return val
+    return None
+""")
+        self.assertEqual(self.interp("first_over([[1, 2], [5, 9]], 3)"), 5)
+        self.assertEqual(self.interp("first_over([[1, 2]], 3)"), None)
+
+    def test_nested_listcomp(self):
+        """list comprehension with several generators"""
+        self.interp('x = [i*j for i in range(3) for j in range(i) if j > 0]')
+        self.isvalue('x', [2])
+
+
+class TestEvalTrusted(TestEval):
+    """run the TestEval tests with trusted (native) compilation"""
+
+    def setUp(self):
+        self.interp = Interpreter(trusted_compile=True)
+        self.symtable = self.interp.symtable
+        self.set_stdout()
+        if not HAS_NUMPY:
+            self.interp("arange = range")
+
+    def test_trusted_native(self):
+        """simple expressions compile to native code"""
+        self.interp("a, b = 3, 4.5")
+        program = self.interp.compile("c = a*b + sqrt(16)\nc - 1")
+        self.assertTrue(program.native)
+        self.assertEqual(self.interp.run(program), 16.5)
+        self.isvalue('c', 17.5)
+        self.assertFalse(any(key.startswith('__asteval')
+                             for key in self.symtable))
+        for expr in ("x = 0\nfor i in range(3): x += i",
+                     "().__class__", "__import__", "a.__dict__",
+                     "[i for i in range(3)]"):
+            self.assertFalse(self.interp.compile(expr).native)
+
+    def test_trusted_guards(self):
+        """safe_* operator guards and errors in native code"""
+        self.assertTrue(self.interp.compile("10**10001").native)
+        self.interp("10**10001")
+        self.check_error('RuntimeError')
+        self.interp("s = '*'*(2<<17)")
+        self.interp("s += 'x'")
+        self.check_error('RuntimeError')
+        self.interp("y = 1/0")
+        self.check_error('ZeroDivisionError')
+        self.interp("z = undefined + 1")
+        self.check_error('NameError', 'undefined')
+
+
+class TestEvalOptimized(TestEval):
+    """run the TestEval tests with the constant-folding optimizer"""
+
+    def setUp(self):
+        self.interp = Interpreter(use_optimizer=True)
+        self.symtable = self.interp.symtable
+        self.set_stdout()
+        if not HAS_NUMPY:
+            self.interp("arange = range")
+
+    def test_constant_folding(self):
+        """constants and dead branches are folded, guards are kept"""
+        interp = Interpreter(use_numpy=False, use_optimizer=True)
+        tree = interp.optimize(interp.parse("x = 2*pi*3 + sqrt(16)"))
+        self.assertTrue(isinstance(tree.body[0].value, ast.Num))
+        self.assertEqual(tree.body[0].value.n, 2*math.pi*3 + 4)
+        tree = interp.optimize(interp.parse("if 1 > 2:\n    x = 1\nelse:\n"
+                                            "    x = 2\nx"))
+        self.assertEqual([type(node) for node in tree.body],
+                         [ast.Assign, ast.Expr])
+        self.assertEqual(interp("if 1 < 2: 3"), None)
+        # errors and large results are left for run time
+        self.assertFalse(isinstance(
+            interp.optimize(interp.parse("2**100000")).body[0].value,
+            ast.Num))
+        interp("2**100000")
+        self.assertTrue(len(interp.error) > 0)
+        interp.error = []
+        # not inside functions, or for assigned names
+        interp("def f(): return pi")
+        self.assertEqual(interp("pi*2"), math.pi*2)
+        interp("pi = 3")
+        self.assertEqual(interp("pi*2"), 6)
+        self.assertEqual(interp("f()"), 3)
+        self.assertEqual(interp("sqrt = abs\nsqrt(-4)"), 4)
+        # compiled programs are compiled again when a guard fails
+        interp = Interpreter(use_numpy=False, use_compiler=True,
+                             use_optimizer=True)
+        program = interp.compile("cos(0) + e")
+        self.assertEqual(interp.run(program), 1 + math.e)
+        interp("e = 1")
+        self.assertEqual(interp.run(program), 2)
+        self.assertEqual(interp("cos(0) + e"), 2)
+
+    def test_common_subexpressions(self):
+        """repeated pure subexpressions are computed once, and again after
+        their names are assigned"""
+        interp = Interpreter(use_numpy=False, use_optimizer=True,
+                             use_cse=True)
+        script = """x = 2.0
+sigma = 1.5
+a = exp(-x**2/(2*sigma**2)) + 1
+b = 3*exp(-x**2/(2*sigma**2))
+x = 3.0
+c = exp(-x**2/(2*sigma**2))
+a + b + c"""
+        tree = interp.optimize(interp.parse(script))
+        temps = [stmt.targets[0].id for stmt in tree.body
+                 if isinstance(stmt, ast.Assign) and
+                 stmt.targets[0].id.startswith('_cse_')]
+        self.assertEqual(len(temps), 2)
+        self.assertEqual(tree.body[4].value.left.id, temps[1])
+        # exp() is computed again for c, as x was assigned
+        self.assertTrue(isinstance(tree.body[8].value, ast.Call))
+        expected = 4*math.exp(-4/4.5) + 1 + math.exp(-9/4.5)
+        self.assertAlmostEqual(interp(script), expected)
+        self.assertEqual([name for name in interp.symtable
+                          if name.startswith('_cse_')], [])
+        # not shared across other calls, or when the function is replaced
+        tree = interp.optimize(interp.parse("a = sqrt(x+1)\nf()\n"
+                                            "b = sqrt(x+1)"))
+        self.assertEqual(len(tree.body), 3)
+        interp("x = 3\ndef sqrt(v): return v")
+        self.assertEqual(interp("sqrt(x+1) + sqrt(x+1)"), 8)
+        # temporaries used by the final expression are deleted too
+        interp = Interpreter(use_numpy=False, use_optimizer=True,
+                             use_cse=True)
+        for use_compiler in (False, True):
+            interp.use_compiler = use_compiler
+            self.assertEqual(interp("x = 2\n(x*x + 1)*3 + (x*x + 1)"), 20)
+            self.assertEqual(interp("y = (x*x + 1)*2\n(x*x + 1)*3"), 15)
+            self.assertEqual([name for name in interp.symtable
+                              if name.startswith('_cse_')], [])
+        # values bound to names are not shared
+        interp("u, v, w = [1], [2], [3]\np = u + v + w\nq = u + v + w\n"
+               "p.append(9)")
+        self.assertEqual(interp.symtable['q'], [1, 2, 3])
+        tree = interp.optimize(interp.parse("c = x*y*z + 1\n"
+                                            "d = x*y*z + 1"))
+        self.assertEqual(tree.body[1].value.left.id, '_cse_0')
+        self.assertEqual(tree.body[2].value.left.id, '_cse_0')
+        if HAS_NUMPY:
+            interp = Interpreter(use_optimizer=True, use_cse=True)
+            interp.symtable['x'] = np.arange(3.0)
+            interp("c = x*x*x + 1\nd = x*x*x + 1\nc += 100")
+            self.assertEqual(list(interp.symtable['d']), [1, 2, 9])
+        # not without use_cse
+        interp = Interpreter(use_numpy=False, use_optimizer=True)
+        tree = interp.optimize(interp.parse("a = sqrt(x+1)*2\n"
+                                            "b = sqrt(x+1)*3"))
+        self.assertEqual(len(tree.body), 2)
+
+
+class TestEvalFused(TestEval):
+    """run the TestEval tests with fused array expressions"""
+
+    def setUp(self):
+        self.interp = Interpreter(fuse_arrays=True)
+        self.symtable = self.interp.symtable
+        self.set_stdout()
+        if not HAS_NUMPY:
+            self.interp("arange = range")
+
+    def test_fused_arrays(self):
+        """elementwise expressions are evaluated block by block"""
+        self.interp("x = 3\ns = 'ab'")
+        self.assertEqual(self.interp("x*2 + 1 - x"), 4)
+        self.assertEqual(self.interp("s*2 + 'c'"), 'ababc')
+        self.interp("s = '*'*(2<<17)")
+        self.interp("t = s + s + 'x'")
+        self.check_error('RuntimeError')
+        if not HAS_NUMPY:
+            return
+        size = 10**5 + 17
+        rand = np.random.RandomState(7)
+        arrays = {'a': rand.rand(size), 'b': rand.rand(size),
+                  'c': rand.rand(size), 'k': np.arange(size),
+                  'm': rand.rand(size//17, 17)}
+        exprs = {'a*b + c*2.5 - sqrt(a)': lambda a, b, c, k, m:
+                 a*b + c*2.5 - np.sqrt(a),
+                 '-(k % 7) // 2 + k**2': lambda a, b, c, k, m:
+                 -(k % 7) // 2 + k**2,
+                 'k*0.5 + 1 > a*k': lambda a, b, c, k, m: k*0.5 + 1 > a*k,
+                 'exp(-m**2/(2*1.5**2)) + m': lambda a, b, c, k, m:
+                 np.exp(-m**2/(2*1.5**2)) + m,
+                 'm.T*2 + 1': lambda a, b, c, k, m: m.T*2 + 1,
+                 'a[:10]*b[:10] + 1': lambda a, b, c, k, m:
+                 a[:10]*b[:10] + 1}
+        for use_compiler in (False, True):
+            interp = Interpreter(fuse_arrays=True, use_compiler=use_compiler)
+            interp.symtable.update(arrays)
+            for expr, func in exprs.items():
+                out = interp(expr)
+                expected = func(**arrays)
+                self.assertEqual(out.dtype, expected.dtype)
+                self.assertTrue(np.allclose(out, expected), expr)
+            interp("k**20000 + 1")
+            self.assertTrue(len(interp.error) > 0)
+            self.assertEqual(interp.error[0].get_error()[0], 'RuntimeError')
+        kernel = build_kernel(ast.parse('a*b + sqrt(c)').body[0].value,
+                              interp.symtable)
+        self.assertEqual(len(kernel), 3)
+        self.assertEqual([leaf.id for leaf in kernel.leaves], ['a', 'b', 'c'])
+        self.assertEqual(kernel.nodes, ['binop', 'call', 'binop'])
+        self.assertTrue(build_kernel(ast.parse('a*b').body[0].value,
+                                     interp.symtable) is None)
+
+
+class TestEvalThreaded(TestEval):
+    """run the TestEval tests with array expressions split across
+    threads"""
+
+    def setUp(self):
+        self.interp = Interpreter(array_threads=3, thread_min_size=8)
+        self.symtable = self.interp.symtable
+        self.set_stdout()
+        if not HAS_NUMPY:
+            self.interp("arange = range")
+
+    def test_array_threads(self):
+        """elementwise expressions and reductions run on threads"""
+        self.assertEqual(self.interp("x = 3\nx*2 + 1 - x"), 4)
+        if not HAS_NUMPY:
+            return
+        size = 10**5 + 17
+        rand = np.random.RandomState(7)
+        arrays = {'a': rand.rand(size), 'b': rand.rand(size),
+                  'k': np.arange(size, dtype='int32'),
+                  'f': rand.rand(size).astype('float32'),
+                  'm': rand.rand(size//17, 17)}
+        exprs = ['a*b + sqrt(a)', 'k*k', 'exp(-m**2) + m', 'sum(a*b)',
+                 'sum(k)', 'mean(k % 7)', 'mean(f*2)', 'max(a - b)',
+                 'min(m)', 'prod(a*0 + 1.000001)', 'any(a > 0.5)',
+                 'all(k >= 0)', 'sum(m.T*2)', 'sum(a[:10]*2)', 'sum(2*3)']
+        for use_compiler in (False, True):
+            for fuse_arrays in (False, True):
+                interp = Interpreter(array_threads=4, thread_min_size=1000,
+                                     fuse_arrays=fuse_arrays,
+                                     use_compiler=use_compiler)
+                interp.symtable.update(arrays)
+                plain = Interpreter()
+                plain.symtable.update(arrays)
+                for expr in exprs:
+                    out = interp(expr)
+                    expected = plain(expr)
+                    self.assertEqual(type(out), type(expected), expr)
+                    self.assertEqual(np.asarray(out).dtype,
+                                     np.asarray(expected).dtype, expr)
+                    self.assertTrue(np.allclose(out, expected), expr)
+                interp("k**20000 + 1")
+                self.assertEqual(interp.error[0].get_error()[0],
+                                 'RuntimeError')
+        kernel = build_kernel(ast.parse('sum(a*b)').body[0].value,
+                              interp.symtable)
+        self.assertEqual(kernel.reduction, (0, 'sum'))
+        self.assertEqual(kernel.nodes, ['binop', 'call'])
+        self.assertTrue(build_kernel(ast.parse('sum(a)').body[0].value,
+                                     interp.symtable) is None)
+        self.assertEqual(len(build_kernel(ast.parse('sum(a)').body[0].value,
+                                          interp.symtable, min_ops=1)), 1)
+
 
 class TestCase2(unittest.TestCase):
     def test_stringio(self):
@@ -821,6 +1515,350 @@ class TestCase2(unittest.TestCase):
         self.assertEqual(out.getvalue(), 'out\n')
 
 
+class TestInterpreterPool(unittest.TestCase):
+    """testing of the InterpreterPool"""
+
+    def test_checkout_checkin(self):
+        """interpreters are reset when checked in"""
+        pool = InterpreterPool(size=2, symbols={'scale': 10})
+        self.assertEqual(len(pool), 2)
+        interp = pool.checkout()
+        interp("x = scale*2\nscale = 1")
+        self.assertEqual(interp.symtable['x'], 20)
+        pool.checkin(interp)
+        interp = pool.checkout()
+        self.assertFalse('x' in interp.symtable)
+        self.assertEqual(interp.symtable['scale'], 10)
+        pool.checkin(interp)
+        self.assertEqual(pool.nbusy, 0)
+
+    def test_timeout(self):
+        """checkout() raises RuntimeError when the pool is exhausted"""
+        pool = InterpreterPool(size=1, maxsize=2)
+        first, second = pool.checkout(), pool.checkout()
+        self.assertEqual(len(pool), 2)
+        self.assertRaises(RuntimeError, pool.checkout, timeout=0.01)
+        pool.checkin(first)
+        pool.checkin(second)
+
+    def test_threads(self):
+        """each thread evaluates with its own interpreter"""
+        pool = InterpreterPool(size=3)
+        results = {}
+
+        def work(ithread):
+            with pool.interpreter() as interp:
+                interp("x = %d" % ithread)
+                out = []
+                for i in range(50):
+                    interp("x = x + 1")
+                    out.append(pool.eval("x"))
+                results[ithread] = out
+
+        threads = [threading.Thread(target=work, args=(i*1000, ))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for ithread, out in results.items():
+            self.assertEqual(out, list(range(ithread+1, ithread+51)))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(pool.nbusy, 0)
+
+
+class TestParallel(unittest.TestCase):
+    """testing of parallel evaluation in worker processes"""
+
+    def test_pickle_program(self):
+        """pickled Programs are compiled again when run"""
+        interp = Interpreter(use_compiler=True)
+        program = pickle.loads(pickle.dumps(interp.compile("x*2 + 1")))
+        self.assertTrue(program.func is None)
+        interp.symtable['x'] = 4
+        self.assertEqual(interp.eval(program), 9)
+        self.assertEqual(Interpreter(symtable={'x': 1}).eval(program), 3)
+
+    def test_eval_many(self):
+        """results and errors are returned in input order"""
+        exprs = ["a*x + 1", "undefined + 1", "1 +", "y = a*2\ny"] * 3
+        results, errors = eval_many(exprs, symbols={'a': 2, 'x': 3},
+                                    workers=2, chunksize=2)
+        self.assertEqual(len(results), 12)
+        for i in range(0, 12, 4):
+            self.assertEqual(results[i], 7)
+            self.assertTrue(errors[i] is None)
+            self.assertEqual(errors[i+1].exc_name, 'NameError')
+            self.assertEqual(errors[i+1].index, i+1)
+            self.assertEqual(errors[i+2].exc_name, 'SyntaxError')
+            self.assertEqual(results[i+3], 4)
+
+        with ParallelEvaluator(workers=2) as evaluator:
+            results, errors = evaluator.eval_many(
+                ["x*2", "x*2", "y"], symbols=[{'x': 1}, {'x': 3}, {}])
+        self.assertEqual(results[:2], [2, 6])
+        self.assertEqual(errors[2].exc_name, 'NameError')
+
+    def test_eval_many_time_limit(self):
+        """workers forked after an evaluation still have a time limit"""
+        Interpreter().eval('1')
+        start = time.time()
+        results, errors = eval_many(['x = 0\nwhile True: x = x + 1'],
+                                    workers=1, max_time=1)
+        self.assertTrue(time.time() - start < 15)
+        self.assertEqual(errors[0].exc_name, 'RuntimeError')
+        self.assertTrue('time limit' in errors[0].msg)
+
+
+@unittest.skipIf(version_info < (3, 5), "asyncio support needs Python 3.5")
+class TestAsync(unittest.TestCase):
+    """testing of evaluation from asyncio"""
+
+    def setUp(self):
+        import asyncio
+        self.asyncio = asyncio
+        self.loop = asyncio.new_event_loop()
+        self.interp = Interpreter()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_aeval(self):
+        """the event loop keeps running during aeval()"""
+        ticks = []
+
+        def tick():
+            ticks.append(time.time())
+            self.loop.call_later(0.001, tick)
+
+        self.loop.call_soon(tick)
+        coro = self.interp.aeval("s = 0\nfor i in range(5000): s = s + i\ns")
+        out = self.loop.run_until_complete(coro)
+        self.assertEqual(out, 12497500)
+        self.assertTrue(len(ticks) > 1)
+        self.assertTrue(self.interp.step_hook is None)
+
+    def test_cancel(self):
+        """cancelling the task aborts the evaluation"""
+        self.interp.max_time = 30
+        self.interp.err_writer = self.interp.writer = NamedTemporaryFile('w')
+        task = self.loop.create_task(self.interp.aeval("while True: pass"))
+        self.loop.call_later(0.05, task.cancel)
+        self.assertRaises(self.asyncio.CancelledError,
+                          self.loop.run_until_complete, task)
+        self.assertEqual(self.interp.error[0].get_error()[0], 'RuntimeError')
+        self.assertEqual(self.interp("1 + 1"), 2)
+
+    def test_cancel_caught(self):
+        """cancelling aborts a script that catches the error"""
+        self.interp.max_time = 30
+        self.interp.err_writer = self.interp.writer = NamedTemporaryFile('w')
+        script = "while True:\n    try:\n        pass\n    except:\n        pass"
+        for use_compiler in (False, True):
+            self.interp.use_compiler = use_compiler
+            task = self.loop.create_task(self.interp.aeval(script))
+            self.loop.call_later(0.05, task.cancel)
+            start = time.time()
+            self.assertRaises(self.asyncio.CancelledError,
+                              self.loop.run_until_complete,
+                              self.asyncio.wait_for(task, 10))
+            self.assertTrue(time.time() - start < 10)
+            self.assertEqual(self.interp("1 + 1"), 2)
+
+    def test_cancel_before_start(self):
+        """cancelling before the worker thread runs aborts the evaluation"""
+        from concurrent.futures import ThreadPoolExecutor
+        self.interp.max_time = 30
+        self.interp.err_writer = self.interp.writer = NamedTemporaryFile('w')
+        executor = ThreadPoolExecutor(max_workers=1)
+        busy = threading.Event()
+        executor.submit(busy.wait, 10)
+        task = self.loop.create_task(
+            self.interp.aeval("while True: pass", executor=executor))
+        self.loop.call_later(0.05, task.cancel)
+        self.loop.call_later(0.1, busy.set)
+        start = time.time()
+        self.assertRaises(self.asyncio.CancelledError,
+                          self.loop.run_until_complete,
+                          self.asyncio.wait_for(task, 10))
+        self.assertTrue(time.time() - start < 10)
+        executor.shutdown()
+        self.assertEqual(self.interp("1 + 1"), 2)
+
+
+class TestExpressionGraph(unittest.TestCase):
+    """testing of incremental evaluation of named expressions"""
+
+    def setUp(self):
+        self.interp = Interpreter(use_numpy=False)
+        self.symtable = self.interp.symtable
+        self.graph = ExpressionGraph(self.interp)
+
+    def test_evaluate(self):
+        """only the expressions downstream of a change are evaluated"""
+        graph = self.graph
+        graph.add('c', 'sqrt(a) + d')
+        graph.add('a', 'b*2')
+        graph.add('f', 'b - 1')
+        self.symtable.update({'b': 8, 'd': 1})
+        self.assertEqual(sorted(graph.evaluate()), ['a', 'c', 'f'])
+        self.assertEqual(self.symtable['c'], 5)
+        self.assertEqual(graph.evaluate(), [])
+        self.symtable['d'] = 2
+        self.assertEqual(graph.evaluate(), ['c'])
+        self.assertEqual(graph['c'], 6)
+        self.symtable['b'] = 32
+        order = graph.evaluate()
+        self.assertEqual(sorted(order), ['a', 'c', 'f'])
+        self.assertTrue(order.index('a') < order.index('c'))
+        self.assertEqual(graph['c'], 10)
+        graph.changed('d')
+        self.assertEqual(graph.evaluate(), ['c'])
+        graph.changed('a')
+        self.assertEqual(graph.evaluate(), ['a', 'c'])
+        graph.add('a', 'b*8')
+        self.assertEqual(graph['c'], 18)
+
+    def test_cycles_and_errors(self):
+        """cycles are refused, errors are raised and retried"""
+        graph = self.graph
+        graph.add('a', 'b + 1')
+        graph.add('c', 'a*2')
+        self.assertRaises(ValueError, graph.add, 'b', 'c - 1')
+        self.assertFalse('b' in graph)
+        self.symtable['b'] = 1
+        self.assertEqual(graph['c'], 4)
+        self.assertRaises(SyntaxError, graph.add, 'd', '1 +')
+        graph.add('d', 'undefined + c')
+        self.assertRaises(NameError, graph.evaluate)
+        self.symtable['undefined'] = 1
+        self.assertEqual(graph.evaluate(), ['d'])
+        self.assertEqual(graph['d'], 5)
+        graph.remove('a')
+        self.symtable['a'] = 10
+        self.assertEqual(graph.evaluate(), ['c', 'd'])
+        self.assertEqual(graph['d'], 21)
+
+    def test_common_subexpressions(self):
+        """expressions evaluated together share their subexpressions"""
+        graph = ExpressionGraph(self.interp, cse=True)
+        graph.add('a', 'exp(-x**2/2) + 1')
+        graph.add('b', '3*exp(-x**2/2)')
+        graph.add('c', 'a + b')
+        self.symtable['x'] = 2.0
+        self.assertEqual(sorted(graph.evaluate()), ['a', 'b', 'c'])
+        self.assertAlmostEqual(graph['c'], 4*math.exp(-2) + 1)
+        self.assertEqual(len(graph._batches), 1)
+        self.symtable['x'] = 1.0
+        self.assertEqual(sorted(graph.evaluate()), ['a', 'b', 'c'])
+        self.assertAlmostEqual(graph['b'], 3*math.exp(-0.5))
+        self.assertFalse(any(name.startswith('_cse_')
+                             for name in self.symtable))
+        # results bound to names are not shared
+        other = ExpressionGraph(Interpreter(use_numpy=False), cse=True)
+        other.add('p', 'u + v + w')
+        other.add('q', 'u + v + w')
+        other.interp.symtable.update({'u': [1], 'v': [2], 'w': [3]})
+        other.evaluate()
+        self.assertFalse(other['p'] is other['q'])
+        # a failing batch is evaluated one by one
+        graph.add('d', 'undefined + exp(-x**2/2)')
+        graph.add('e', 'exp(-x**2/2)')
+        self.assertRaises(NameError, graph.evaluate)
+        self.symtable['undefined'] = 1
+        self.assertEqual(graph.evaluate(), ['d'])
+        self.assertAlmostEqual(graph['d'], 1 + math.exp(-0.5))
+
+
+class TestProgramCache(unittest.TestCase):
+    """testing of the on-disk program cache"""
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='astevaltest')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_persist(self):
+        """programs written by one cache are found by another"""
+        exprs = ['x = %d\nx*y + sqrt(x)' % i for i in range(50)]
+        with ProgramCache(self.path, flush_every=20) as cache:
+            interp = Interpreter(parse_cache=cache)
+            interp.symtable['y'] = 2
+            self.assertEqual(interp(exprs[4]), 10)
+            for expr in exprs:
+                interp(expr)
+            self.assertEqual(len(cache.pending), 10)
+        cache = ProgramCache(self.path, maxsize=4)
+        self.assertEqual(len(cache), 50)
+        program = cache.get_program(exprs[7])
+        self.assertEqual(program.usage.reads, set(['x', 'y', 'sqrt']))
+        self.assertEqual(program.usage.writes, set(['x']))
+        self.assertEqual(program.usage.calls, set(['sqrt']))
+        self.assertTrue(cache.get('x + 1') is None)
+        interp = Interpreter(parse_cache=cache)
+        interp.symtable['y'] = 3
+        self.assertEqual(interp(exprs[9]), 30)
+        self.assertEqual(interp(program), 7*3 + math.sqrt(7))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        # entries flushed by another cache are seen after a miss
+        other = ProgramCache(self.path)
+        other.put('z - 1', ast.parse('z - 1'))
+        other.close()
+        self.assertTrue(cache.get('z - 1') is not None)
+        self.assertEqual(len(cache), 51)
+        cache.close()
+
+
+class TestParseCache(unittest.TestCase):
+    """testing of the LRU parse cache"""
+
+    def test_parse_cache(self):
+        """repeated parses hit the cache, shared between interpreters"""
+        cache = LRUCache(maxsize=8)
+        interp1 = Interpreter(parse_cache=cache)
+        interp2 = Interpreter(parse_cache=cache)
+        interp1("x = 3")
+        self.assertEqual(interp1("x*2 + 1"), 7)
+        interp2("x = 4")
+        self.assertEqual(interp2("x*2 + 1"), 9)
+        stats = cache.stats()
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['entries'], 3)
+        self.assertTrue(interp1.parse('x = 3') is interp2.parse('x = 3'))
+
+    def test_parse_cache_evict(self):
+        """entry and byte limits evict least recently used entries"""
+        cache = LRUCache(maxsize=2)
+        interp = Interpreter(parse_cache=cache)
+        for expr in ('1', '2', '1', '3'):
+            interp(expr)
+        self.assertTrue('1' in cache)
+        self.assertFalse('2' in cache)
+        self.assertEqual(cache.evictions, 1)
+        cache = LRUCache(maxsize=None, maxbytes=2000)
+        interp = Interpreter(parse_cache=cache)
+        for i in range(20):
+            interp("x = %d + %d" % (i, i))
+        self.assertTrue(cache.nbytes <= 2000)
+        self.assertTrue(cache.evictions > 0)
+
+    def test_parse_cache_invalidate(self):
+        """explicit invalidation"""
+        cache = LRUCache()
+        interp = Interpreter(parse_cache=cache)
+        interp("a = 1")
+        interp("b = 2")
+        cache.invalidate("a = 1")
+        self.assertFalse("a = 1" in cache)
+        self.assertTrue("b = 2" in cache)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
+
+
 if __name__ == '__main__':  # pragma: no cover
     for suite in (TestEval,):
         suite = unittest.TestLoader().loadTestsFromTestCase(suite)